@@ -0,0 +1,218 @@
+"""Align GPT entity excerpts back onto the dream text they were taken from."""
+
+from collections import defaultdict, deque
+from difflib import SequenceMatcher
+
+import numpy as np
+import pandas as pd
+
+
+# Characters that ChatGPT tends to swap for each other when quoting an excerpt.
+QUOTE_MAP = str.maketrans({
+    '"': "'",
+    "‘": "'",
+    "’": "'",
+    "“": "'",
+    "”": "'",
+    "`": "'",
+})
+
+
+def normalize_text(text: str) -> tuple[str, np.ndarray]:
+    """
+    Normalize text for matching and keep a map back to the original characters.
+    Normalization casefolds, unifies quote characters, collapses every run of
+    whitespace into a single space, and strips leading/trailing whitespace.
+    Args:
+        text (str): The text to normalize.
+    Returns:
+        tuple[str, np.ndarray]: The normalized text and an integer array where
+            element i is the position in `text` of normalized character i.
+    """
+
+    chars = []
+    offsets = []
+    in_space = True  # Treat the start as whitespace so leading spaces are dropped.
+    for i, c in enumerate(text.translate(QUOTE_MAP)):
+        if c.isspace():
+            if not in_space:
+                chars.append(" ")
+                offsets.append(i)
+            in_space = True
+        else:
+            folded = c.casefold()
+            chars.extend(folded)
+            offsets.extend([i] * len(folded))
+            in_space = False
+    if chars and chars[-1] == " ":
+        chars.pop()
+        offsets.pop()
+    return "".join(chars), np.asarray(offsets, dtype=np.int64)
+
+
+class AhoCorasick:
+    """
+    Multi-pattern string matcher (Aho-Corasick automaton).
+    All patterns are located in a single left-to-right pass over the text,
+    instead of one `str.index` scan per pattern.
+    Args:
+        patterns (list[str]): The patterns to search for. Empty patterns are ignored.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pid, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            node = 0
+            for c in pattern:
+                if c not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][c] = len(self.goto) - 1
+                node = self.goto[node][c]
+            self.out[node].append(pid)
+        # Breadth-first pass to set failure links and merge outputs.
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(c, 0)
+                self.fail[child] = target if target != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def finditer(self, text: str):
+        """Yield (start, end, pattern_id) for every (overlapping) match in `text`."""
+        node = 0
+        for i, c in enumerate(text):
+            while node and c not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(c, 0)
+            for pid in self.out[node]:
+                yield i + 1 - len(self.patterns[pid]), i + 1, pid
+
+    def findall(self, text: str) -> dict:
+        """Return a dictionary of pattern_id -> sorted list of match start positions."""
+        matches = defaultdict(list)
+        for start, _, pid in self.finditer(text):
+            matches[pid].append(start)
+        return matches
+
+
+def fuzzy_find(
+    text: str, pattern: str, min_ratio: float = 0.85, max_length: int = 2000
+) -> tuple[int, int] | None:
+    """
+    Locate the window of `text` that best matches `pattern`, if it is close enough.
+    The search is bounded: patterns longer than `max_length` are not attempted,
+    and only the window anchored on the longest common block is scored.
+    Args:
+        text (str): The (normalized) text to search.
+        pattern (str): The (normalized) pattern to look for.
+        min_ratio (float): Minimum `SequenceMatcher.ratio` to accept a window.
+        max_length (int): Longest pattern, in characters, to try to match.
+    Returns:
+        tuple[int, int] | None: The (start, end) of the window in `text`, or None.
+    """
+
+    if not pattern or len(pattern) > max_length or len(pattern) > len(text):
+        return None
+    matcher = SequenceMatcher(None, text, pattern, autojunk=False)
+    block = matcher.find_longest_match(0, len(text), 0, len(pattern))
+    if block.size == 0:
+        return None
+    start = min(max(block.a - block.b, 0), len(text) - len(pattern))
+    end = start + len(pattern)
+    if SequenceMatcher(None, text[start:end], pattern, autojunk=False).ratio() < min_ratio:
+        return None
+    return start, end
+
+
+def align_entities(
+    text: str, entities: list[dict], fuzzy: bool = True, **fuzzy_kwargs
+) -> list[dict]:
+    """
+    Place every entity excerpt of one dream onto the dream text.
+    All excerpts are normalized (see `normalize_text`) and matched in one
+    Aho-Corasick pass. Repeated excerpts are assigned to successive occurrences
+    rather than all landing on the first one, and excerpts that still are not
+    found fall back to a bounded fuzzy search (see `fuzzy_find`).
+    Args:
+        text (str): The dream text.
+        entities (list[dict]): Entities with "value" and "label" keys, as returned
+            by the annotate task.
+        fuzzy (bool): If True, try a fuzzy match for excerpts not found exactly.
+        **fuzzy_kwargs: Additional keyword arguments passed to `fuzzy_find`.
+    Returns:
+        list[dict]: One dictionary per entity with "label", "value", "start" and
+            "end" (character positions in `text`, None if unaligned) and "method"
+            ("exact", "normalized", "fuzzy" or "failed").
+    """
+
+    norm_text, offsets = normalize_text(text)
+    norm_values = [normalize_text(str(e["value"]))[0] for e in entities]
+    unique_values = list(dict.fromkeys(v for v in norm_values if v))
+    pattern_ids = {v: i for i, v in enumerate(unique_values)}
+    matches = AhoCorasick(unique_values).findall(norm_text)
+    used = defaultdict(set)
+    cursor = 0  # Excerpts are usually listed in reading order.
+    spans = []
+    for e, value in zip(entities, norm_values):
+        span = {"label": e["label"], "value": e["value"], "start": None, "end": None}
+        method = "failed"
+        norm_span = None
+        if value:
+            pid = pattern_ids[value]
+            candidates = [s for s in matches.get(pid, []) if s not in used[pid]]
+            if candidates:
+                after_cursor = [s for s in candidates if s >= cursor]
+                norm_start = (after_cursor or candidates)[0]
+                used[pid].add(norm_start)
+                norm_span = (norm_start, norm_start + len(value))
+                method = "normalized"
+            elif fuzzy:
+                norm_span = fuzzy_find(norm_text, value, **fuzzy_kwargs)
+                method = "fuzzy" if norm_span is not None else "failed"
+        if norm_span is not None:
+            start = int(offsets[norm_span[0]])
+            end = int(offsets[norm_span[1] - 1]) + 1
+            if method == "normalized" and text[start:end] == e["value"]:
+                method = "exact"
+            span.update(start=start, end=end)
+            cursor = norm_span[0]
+        span["method"] = method
+        spans.append(span)
+    return spans
+
+
+def alignment_report(spans: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarize how entity excerpts were aligned, for each label.
+    Args:
+        spans (pd.DataFrame): Aligned entities with "label" and "method" columns.
+    Returns:
+        pd.DataFrame: Counts of each alignment method per label, plus the total
+            and the failure rate.
+    """
+
+    methods = ["exact", "normalized", "fuzzy", "failed"]
+    if spans.empty:
+        return pd.DataFrame(columns=[*methods, "total", "failure_rate"], index=pd.Index([], name="label"))
+    report = (
+        spans.groupby("label")["method"]
+        .value_counts()
+        .unstack(fill_value=0)
+        .reindex(columns=methods, fill_value=0)
+        .rename_axis(columns=None)
+    )
+    report["total"] = report.sum(axis=1)
+    report["failure_rate"] = report["failed"] / report["total"]
+    return report
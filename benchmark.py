@@ -0,0 +1,199 @@
+"""Time the loaders, parsers and aggregations on synthetic data at several scales.
+
+Every stage runs on the synthetic files of synthetic.py (generated on first
+use), by pointing `utils.source_dir` and `utils.deriv_dir` at them. Timings are
+appended to a results file with the current commit and compared with the
+previous run, so a slowdown shows up as a ratio above the tolerance.
+
+```shell
+python benchmark.py                                  #> ../derivatives/benchmarks.csv
+python benchmark.py --n 10000 100000 1000000 --repeat 1
+python benchmark.py --stages parse_annotate bin_spans --baseline 3021b1c --check
+```
+"""
+
+import argparse
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import synthetic
+import utils
+from spans import make_span_table, make_timecourse_cube, parse_annotate_completions
+from themes import THEMES, parse_theme_completions
+
+
+results_path = utils.deriv_dir / "benchmarks.csv"
+
+
+@contextmanager
+def data_dirs(dirs: dict):
+    """Point the loaders of utils at other source and derivatives directories."""
+    previous = utils.source_dir, utils.deriv_dir
+    utils.source_dir, utils.deriv_dir = dirs["sourcedata"], dirs["derivatives"]
+    try:
+        yield
+    finally:
+        utils.source_dir, utils.deriv_dir = previous
+
+
+def _raw_dreamviews_texts(n: int) -> tuple:
+    texts = pd.read_table(utils.source_dir / "dreamviews.tsv", usecols=["post_clean"])["post_clean"].dropna()
+    return (texts,), len(texts)
+
+
+def _completions(n: int, task: str) -> tuple:
+    completions = utils.load_json(utils.deriv_dir / f"data-dreamviews_task-{task}_responses.json")
+    return (completions,), len(completions)
+
+
+def _aligned_spans(n: int) -> tuple:
+    (completions,), n = _completions(n, "annotate")
+    aligned, dreams, _ = parse_annotate_completions(completions)
+    return (aligned, dreams), n
+
+
+def _liwc_inputs(n: int) -> tuple:
+    lucidity = utils.load_dreamviews()["lucidity"]
+    return (lucidity,), len(lucidity)
+
+
+def score_liwc(lucidity: pd.Series) -> pd.DataFrame:
+    """Mean LIWC scores of lucid and non-lucid dreams, as in plot_liwc.py."""
+    liwc = pd.concat([utils.load_liwc("dreamviews", dic) for dic in synthetic.LIWC_CATEGORIES], axis=1)
+    liwc["vestib"] = liwc[synthetic.LIWC_CATEGORIES["vestibular"]].sum(axis=1)
+    liwc = liwc.droplevel("Segment").join(lucidity, how="inner")
+    return liwc.groupby("lucidity").mean()
+
+
+def _bin_spans(aligned: pd.DataFrame, dreams: pd.DataFrame) -> np.ndarray:
+    return make_timecourse_cube(make_span_table(aligned, dreams), dreams)
+
+
+# Every stage: a setup that prepares its (untimed) inputs from the synthetic data
+# of a size and returns them with their number of rows, and the timed function.
+STAGES = {
+    "load_sourcedata": (
+        lambda n: ((), min(n, synthetic.FLYING_MAX_ROWS)),
+        lambda: utils.load_sourcedata(dreams_only=False, record_manifest=False),
+    ),
+    "load_sddb": (lambda n: ((), n), utils.load_sddb),
+    "load_dreamviews": (lambda n: ((), n), utils.load_dreamviews),
+    "clean_dream_column": (_raw_dreamviews_texts, utils.clean_dream_column),
+    "parse_lucidity": (lambda n: ((), n), lambda: utils.load_gpt_lucidity_codes("dreamviews")),
+    "parse_themes": (
+        lambda n: _completions(n, "thematicT"),
+        lambda completions: parse_theme_completions(completions, list(THEMES["T"])),
+    ),
+    "parse_annotate": (lambda n: _completions(n, "annotate"), parse_annotate_completions),
+    "bin_spans": (_aligned_spans, _bin_spans),
+    "liwc_scores": (_liwc_inputs, score_liwc),
+}
+
+
+def time_stage(name: str, n: int, repeat: int = 3) -> dict:
+    """
+    Time one stage on the current data directories.
+    Args:
+        name (str): The stage, a key of `STAGES`.
+        n (int): Rows per dataset of the data.
+        repeat (int): Number of timed runs.
+    Returns:
+        dict: The number of input rows and the best and median run time in seconds.
+    """
+
+    setup, stage = STAGES[name]
+    inputs, rows = setup(n)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage(*inputs)
+        seconds.append(time.perf_counter() - start)
+    return {"rows": rows, "best": min(seconds), "median": float(np.median(seconds))}
+
+
+def current_commit() -> str:
+    """Short hash of the checked out commit, marked -dirty with uncommitted changes."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(sizes: list, stages: list = None, repeat: int = 3, root: Path = None) -> pd.DataFrame:
+    """
+    Time every stage at every size, generating missing synthetic data first.
+    Args:
+        sizes (list): Rows per dataset of each scale.
+        stages (list): The stages to time (default: all of `STAGES`).
+        repeat (int): Number of timed runs of each stage.
+        root (Path): Directory of the synthetic data (see synthetic.py).
+    Returns:
+        pd.DataFrame: One row per stage and size with the run date, commit,
+            input rows, and best and median seconds.
+    """
+
+    run_id = pd.Timestamp.now().isoformat(timespec="seconds")
+    commit = current_commit()
+    records = []
+    for n in sizes:
+        dirs = synthetic.generate(n, root)
+        with data_dirs(dirs):
+            for name in stages or list(STAGES):
+                timing = time_stage(name, n, repeat)
+                print(f"{name:<20} n={n:<8} {timing['best']:8.3f}s  ({timing['rows'] / timing['best']:,.0f} rows/s)")
+                records.append({"run": run_id, "commit": commit, "stage": name, "n": n} | timing)
+    return pd.DataFrame(records)
+
+
+def compare(results: pd.DataFrame, current: pd.DataFrame, baseline: str = None) -> pd.DataFrame:
+    """
+    Compare the timings of a run with an earlier one.
+    Args:
+        results (pd.DataFrame): All stored results.
+        current (pd.DataFrame): The timings of the new run.
+        baseline (str): Commit to compare with (default: the latest earlier run
+            of each stage and size).
+    Returns:
+        pd.DataFrame: Per stage and size, the best seconds of both runs and their ratio.
+    """
+
+    earlier = results[results["run"] < current["run"].iloc[0]]
+    if baseline is not None:
+        earlier = earlier[earlier["commit"].str.startswith(baseline)]
+    before = earlier.sort_values("run").groupby(["stage", "n"])["best"].last().rename("before")
+    table = current.set_index(["stage", "n"])["best"].rename("now").to_frame().join(before, how="inner")
+    table["ratio"] = table["now"] / table["before"]
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n", nargs="+", type=int, default=[10_000, 100_000], help="Rows per dataset of each scale.")
+    parser.add_argument("-s", "--stages", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Timed runs of each stage.")
+    parser.add_argument("--root", type=Path, default=None, help="Directory of the synthetic data.")
+    parser.add_argument("--baseline", type=str, default=None, help="Commit to compare with (default: previous run).")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="Slowdown ratio reported as a regression.")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if any stage regressed.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    current = run(args.n, args.stages, args.repeat, args.root)
+    results = pd.read_csv(results_path, dtype={"commit": str}) if results_path.exists() else current.iloc[:0]
+    table = compare(results, current, args.baseline)
+    pd.concat([results, current]).to_csv(results_path, index=False)
+
+    if not table.empty:
+        table["regressed"] = table["ratio"] > args.tolerance
+        print(table.round(3).to_string())
+        if args.check and table["regressed"].any():
+            raise SystemExit(1)
@@ -0,0 +1,200 @@
+"""Estimate the tokens, cost and wall time of a ChatGPT run before starting it.
+
+Used by `gpt_request.py --plan`.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils
+from textstore import TextStore
+
+
+# USD per 1000 (prompt, completion) tokens.
+PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+# Default account rate limits (requests and tokens per minute).
+RATE_LIMITS = {
+    "gpt-4": {"rpm": 200, "tpm": 10_000},
+    "gpt-4-32k": {"rpm": 200, "tpm": 20_000},
+    "gpt-3.5-turbo": {"rpm": 3_500, "tpm": 90_000},
+}
+
+# Tokens added by the chat format: per message, and to prime the reply.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Characters per token when no tokenizer is installed (OpenAI's rule of thumb for English).
+CHARS_PER_TOKEN = 4
+
+# Seconds per request when no past run of the task gives an estimate.
+DEFAULT_SECONDS_PER_REQUEST = 5.0
+
+
+def get_encoding(model: str):
+    """The tiktoken encoding of a model, or None if tiktoken is not installed."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_prompt_tokens(
+    store: TextStore,
+    dream_ids: pd.Index,
+    system_prompt: str,
+    user_prompt: str,
+    model: str = "gpt-4",
+    n_jobs: int = None,
+    chunk_size: int = 2000,
+) -> tuple[np.ndarray, bool]:
+    """
+    Count the prompt tokens of every request of a run.
+    With tiktoken installed, every user prompt is rendered and encoded in
+    chunks, each chunk spread over `n_jobs` threads (the encoder releases the
+    GIL, and threads avoid re-importing the calling script in new processes).
+    Otherwise the count is estimated from text lengths, without decoding.
+    Args:
+        store (TextStore): The dataset's texts.
+        dream_ids (pd.Index): The dreams that will be requested.
+        system_prompt (str): The system prompt.
+        user_prompt (str): The user prompt template with an <INSERT_DREAM> placeholder.
+        model (str): The model whose tokenizer to use.
+        n_jobs (int): Number of encoding threads (default: one per CPU).
+        chunk_size (int): Prompts rendered at once.
+    Returns:
+        tuple[np.ndarray, bool]: Prompt tokens per dream, and whether they
+            were counted exactly (False if estimated).
+    """
+
+    overhead = 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+    encoding = get_encoding(model)
+    if encoding is None:
+        template_chars = len(system_prompt) + len(user_prompt) - len("<INSERT_DREAM>")
+        text_bytes = np.diff(store.offsets)[store.locate(dream_ids)]
+        return np.ceil((template_chars + text_bytes) / CHARS_PER_TOKEN).astype(np.int64) + overhead, False
+    system_tokens = len(encoding.encode_ordinary(system_prompt))
+    counts = np.empty(len(dream_ids), dtype=np.int64)
+    for i in range(0, len(dream_ids), chunk_size):
+        chunk = dream_ids[i : i + chunk_size]
+        prompts = [user_prompt.replace("<INSERT_DREAM>", text) for _, text in store.items(chunk)]
+        tokens = encoding.encode_ordinary_batch(prompts, num_threads=n_jobs or os.cpu_count() or 1)
+        counts[i : i + len(chunk)] = [len(t) for t in tokens]
+    return counts + system_tokens + overhead, True
+
+
+def past_usage(task: str, dataset: str = None) -> dict:
+    """
+    Completion tokens and request durations observed in stored responses of a task.
+    Responses of the given dataset are used if there are any, otherwise those
+    of every dataset. Durations come from the timings file that gpt_request.py
+    writes next to the responses: the seconds of every successful request,
+    which do not depend on how many requests were in flight. Runs without one
+    predate concurrent requests, so their duration is estimated as the time
+    between consecutive `created` timestamps, ignoring pauses over a minute.
+    (In a run with c requests in flight, those gaps are about 1/c of a request.)
+    Args:
+        task (str): The task.
+        dataset (str): The preferred dataset.
+    Returns:
+        dict: n (number of responses used), completion_tokens_mean and
+            completion_tokens_p95 (per choice), and seconds_per_request
+            (median), each None if there is no data.
+    """
+
+    paths = sorted(utils.deriv_dir.glob(f"data-*_task-{task}_responses.json"))
+    preferred = [p for p in paths if p.name.startswith(f"data-{dataset}_")]
+    completion_tokens, durations = [], []
+    for path in preferred or paths:
+        completions = utils.load_json(path).values()
+        completion_tokens.extend(
+            c["usage"]["completion_tokens"] / len(c["choices"]) for c in completions if "usage" in c
+        )
+        timings_path = path.with_name(path.name.replace("_responses.json", "_timings.json"))
+        if timings_path.exists():
+            durations.extend(utils.load_json(timings_path).values())
+            continue
+        created = np.sort([c["created"] for c in completions if "created" in c])
+        gaps = np.diff(created)
+        durations.extend(gaps[(gaps > 0) & (gaps < 60)])
+    tokens = np.asarray(completion_tokens, dtype=float)
+    return {
+        "n": tokens.size,
+        "completion_tokens_mean": tokens.mean() if tokens.size else None,
+        "completion_tokens_p95": np.percentile(tokens, 95) if tokens.size else None,
+        "seconds_per_request": float(np.median(durations)) if durations else None,
+    }
+
+
+def plan(
+    prompt_tokens: np.ndarray,
+    usage: dict,
+    model: str = "gpt-4",
+    choices: int = 1,
+    rpm: int = None,
+    tpm: int = None,
+    concurrency: int = 1,
+) -> dict:
+    """
+    Totals, cost and expected wall time of a run.
+    The run takes as long as the tightest of three limits: requests per
+    minute, tokens per minute, and the number of requests in flight at once.
+    Args:
+        prompt_tokens (np.ndarray): Prompt tokens per request.
+        usage (dict): Past usage of the task (see `past_usage`).
+        model (str): The model to price the run with.
+        choices (int): Choices (answers) per request.
+        rpm (int): Requests per minute allowed (default: `RATE_LIMITS`).
+        tpm (int): Tokens per minute allowed (default: `RATE_LIMITS`).
+        concurrency (int): Requests in flight at once.
+    Returns:
+        dict: The plan figures.
+    """
+
+    limits = RATE_LIMITS.get(model, RATE_LIMITS["gpt-4"])
+    rpm = rpm or limits["rpm"]
+    tpm = tpm or limits["tpm"]
+    n_requests = prompt_tokens.size
+    output_per_request = (usage["completion_tokens_mean"] or 0) * choices
+    total_prompt = int(prompt_tokens.sum())
+    total_completion = int(round(output_per_request * n_requests))
+    price_prompt, price_completion = PRICES.get(model, PRICES["gpt-4"])
+    seconds_per_request = usage["seconds_per_request"] or DEFAULT_SECONDS_PER_REQUEST
+    minutes = {
+        "requests per minute": n_requests / rpm,
+        "tokens per minute": (total_prompt + total_completion) / tpm,
+        "concurrency": n_requests * seconds_per_request / concurrency / 60,
+    }
+    return {
+        "requests": n_requests,
+        "prompt_tokens": total_prompt,
+        "prompt_tokens_max": int(prompt_tokens.max()) if n_requests else 0,
+        "completion_tokens": total_completion,
+        "cost_usd": total_prompt / 1000 * price_prompt + total_completion / 1000 * price_completion,
+        "wall_minutes": max(minutes.values()),
+        "bottleneck": max(minutes, key=minutes.get),
+    }
+
+
+def print_plan(figures: dict, usage: dict, exact: bool) -> None:
+    """Print a plan from `plan`."""
+    counted = "counted with tiktoken" if exact else f"estimated at {CHARS_PER_TOKEN} characters per token"
+    if usage["n"]:
+        based_on = f"mean of {usage['n']} past responses; 95th percentile {usage['completion_tokens_p95']:.0f}"
+    else:
+        based_on = "no past responses of this task, not included"
+    print(f"{'Requests':>20}: {figures['requests']}")
+    print(f"{'Prompt tokens':>20}: {figures['prompt_tokens']:,} ({counted}; max {figures['prompt_tokens_max']} per request)")
+    print(f"{'Completion tokens':>20}: {figures['completion_tokens']:,} ({based_on})")
+    print(f"{'Cost':>20}: ${figures['cost_usd']:,.2f}")
+    print(f"{'Wall time':>20}: {figures['wall_minutes']:,.1f} min (limited by {figures['bottleneck']})")
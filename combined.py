@@ -0,0 +1,162 @@
+"""Split combined-task completions into per-task responses and compare them to single-task runs.
+
+The combined task codes isdream, islucid and the three thematic tasks of a
+dream in one request. Each combined completion is demultiplexed into the
+completion the single-task prompt would have produced, in the usual
+data-{dataset}_task-{task}_responses.json files.
+
+```shell
+python gpt_request.py --dataset flying --task combined    # Also adds uncoded dreams to the per-task files
+python combined.py --dataset flying                       # Agreement with the single-task runs
+python combined.py --dataset flying --demultiplex -o      # Replace the single-task codes
+```
+"""
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from themes import THEMES
+from validate import COMBINED_KEYS, check_completion, responses_path
+
+
+def demultiplex(completion: dict) -> dict:
+    """
+    Split one valid combined completion into single-task completions.
+    Each has the content the single-task prompt asks for ("True"/"False", or a
+    JSON object of themes) and keeps the combined completion's metadata, except
+    `usage`, which belongs to the combined request.
+    Args:
+        completion (dict): A combined completion that passed validation.
+    Returns:
+        dict: Task -> completion.
+    """
+
+    completions = {}
+    for task, key in COMBINED_KEYS.items():
+        choices = []
+        for choice in completion["choices"]:
+            answer = json.loads(choice["message"]["content"])[key]
+            if task.startswith("thematic"):
+                content = json.dumps({theme: answer[theme] for theme in THEMES[task[-1]]})
+            else:
+                content = str(answer)
+            choices.append(choice | {"message": choice["message"] | {"content": content}})
+        completions[task] = {k: v for k, v in completion.items() if k != "usage"} | {
+            "choices": choices,
+            "task": "combined",
+        }
+    return completions
+
+
+def demultiplex_responses(dataset: str, overwrite: bool = False) -> dict:
+    """
+    Write the demultiplexed combined completions of a dataset to the per-task responses files.
+    Args:
+        dataset (str): The dataset.
+        overwrite (bool): If True, replace existing single-task completions;
+            otherwise only add dreams missing from each file.
+    Returns:
+        dict: Task -> number of completions written.
+    """
+
+    combined = utils.load_json(responses_path(dataset, "combined"))
+    split = {task: {} for task in COMBINED_KEYS}
+    for dream_id, completion in combined.items():
+        if check_completion(completion, "combined") is None:
+            for task, c in demultiplex(completion).items():
+                split[task][dream_id] = c
+    written = {}
+    for task, completions in split.items():
+        path = responses_path(dataset, task)
+        existing = utils.load_json(path) if path.exists() else {}
+        new = completions if overwrite else {k: v for k, v in completions.items() if k not in existing}
+        utils.save_json(existing | new, path)
+        written[task] = len(new)
+    return written
+
+
+def _codes(completions: dict, task: str) -> pd.DataFrame:
+    """Boolean codes (dreams x items) of the valid completions of a single task."""
+    rows = {}
+    for dream_id, completion in completions.items():
+        if check_completion(completion, task) is None:
+            content = completion["choices"][0]["message"]["content"]
+            if task.startswith("thematic"):
+                ann = json.loads(content)
+                rows[dream_id] = [ann[theme] for theme in THEMES[task[-1]]]
+            else:
+                rows[dream_id] = [content == "True"]
+    columns = list(THEMES[task[-1]]) if task.startswith("thematic") else [task]
+    return pd.DataFrame.from_dict(rows, orient="index", columns=columns, dtype=bool)
+
+
+def cohen_kappa(a: np.ndarray, b: np.ndarray) -> float:
+    """Cohen's kappa of two boolean arrays of the same shape."""
+    observed = (a == b).mean()
+    expected = a.mean() * b.mean() + (1 - a.mean()) * (1 - b.mean())
+    return np.nan if expected == 1 else (observed - expected) / (1 - expected)
+
+
+def agreement(dataset: str) -> pd.DataFrame:
+    """
+    Agreement of the combined-task codes with the single-task codes of the same dreams.
+    Args:
+        dataset (str): The dataset.
+    Returns:
+        pd.DataFrame: One row per task, with the number of dreams coded by both,
+            the fraction of dreams whose codes all match, the fraction of
+            matching codes, and Cohen's kappa over all codes.
+    """
+
+    combined = {
+        dream_id: demultiplex(completion)
+        for dream_id, completion in utils.load_json(responses_path(dataset, "combined")).items()
+        if check_completion(completion, "combined") is None
+    }
+    results = {}
+    for task in COMBINED_KEYS:
+        path = responses_path(dataset, task)
+        if not path.exists():
+            continue
+        # Single-task completions only (demultiplexed ones are marked with their origin).
+        single = {k: v for k, v in utils.load_json(path).items() if v.get("task") != "combined"}
+        a = _codes(single, task)
+        b = _codes({k: v[task] for k, v in combined.items()}, task)
+        common = a.index.intersection(b.index)
+        a, b = a.loc[common].to_numpy(), b.loc[common].to_numpy()
+        results[task] = {
+            "n": common.size,
+            "dreams_identical": (a == b).all(axis=1).mean() if common.size else np.nan,
+            "codes_identical": (a == b).mean() if common.size else np.nan,
+            "kappa": cohen_kappa(a, b) if common.size else np.nan,
+        }
+    return pd.DataFrame.from_dict(results, orient="index").rename_axis("task")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", required=True, type=str, choices=["dreamviews", "flying", "sddb"])
+    parser.add_argument(
+        "--demultiplex",
+        action="store_true",
+        help="Add the combined codes to the per-task responses files.",
+    )
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="With --demultiplex, replace existing single-task completions.",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    print(agreement(args.dataset).round(3))
+    if args.demultiplex:
+        for task, n in demultiplex_responses(args.dataset, overwrite=args.overwrite).items():
+            print(f"{task:>10}: {n} completions written")
@@ -0,0 +1,117 @@
+"""Majority codes and agreement scores from completions with several choices per dream.
+
+`gpt_request.py --choices k` asks for k answers to the same prompt in one
+request (sampled at a non-zero temperature). The votes of all dreams are
+aggregated at once into a majority code and the fraction of valid choices
+that agree with it.
+
+```shell
+python gpt_request.py --dataset flying --task islucid --choices 5    #> data-flying_task-islucid_choices-5_responses.json
+python consistency.py --dataset flying --task islucid --choices 5    #> data-flying_task-islucid_choices-5_consistency.csv
+```
+"""
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from themes import THEMES
+from validate import check_content, choices_stem, responses_path
+
+
+def task_items(task: str) -> list:
+    """The codes a task gives each dream (its themes, or the task name for True/False tasks)."""
+    return list(THEMES[task[-1]]) if task.startswith("thematic") else [task]
+
+
+def vote_array(completions: dict, task: str) -> tuple[np.ndarray, pd.Index]:
+    """
+    Stack the codes of every choice of every completion into one array.
+    Args:
+        completions (dict): Completions keyed by dream ID.
+        task (str): The task (isdream, islucid or thematicX).
+    Returns:
+        tuple[np.ndarray, pd.Index]: A float array of shape (dreams, choices,
+            items) holding 1 or 0, and NaN for invalid or missing choices; and
+            the dream IDs of its rows.
+    """
+
+    dream_ids = pd.Index(list(completions), name="dream_id")
+    n_choices = max((len(c["choices"]) for c in completions.values()), default=0)
+    items = task_items(task)
+    votes = np.full((len(dream_ids), n_choices, len(items)), np.nan)
+    # Flatten all choices, keeping the valid ones with their (dream, choice) position.
+    rows, cols, contents = [], [], []
+    for i, completion in enumerate(completions.values()):
+        for j, choice in enumerate(completion["choices"]):
+            try:
+                assert choice["finish_reason"] == "stop"
+                check_content(choice["message"]["content"], task)
+            except (AssertionError, ValueError, KeyError, TypeError):
+                continue
+            rows.append(i)
+            cols.append(j)
+            contents.append(choice["message"]["content"])
+    if task.startswith("thematic"):
+        codes = pd.DataFrame([json.loads(c) for c in contents], columns=items).to_numpy(float)
+    else:
+        codes = (np.asarray(contents) == "True").astype(float)[:, None]
+    votes[np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)] = codes.reshape(len(rows), len(items))
+    return votes, dream_ids
+
+
+def aggregate_votes(votes: np.ndarray, dream_ids: pd.Index, items: list) -> pd.DataFrame:
+    """
+    Majority code and agreement of every dream and item.
+    Args:
+        votes (np.ndarray): Votes from `vote_array`, shape (dreams, choices, items).
+        dream_ids (pd.Index): The dream IDs of the rows.
+        items (list): The names of the items.
+    Returns:
+        pd.DataFrame: One row per dream with n_valid (valid choices), and per
+            item the majority code (ties count as True) and its agreement (the
+            fraction of valid choices that voted for it). Dreams without any
+            valid choice have missing codes.
+    """
+
+    n_valid = (~np.isnan(votes[:, :, 0])).sum(axis=1)
+    # Fraction of valid choices voting True (NaN without any valid choice).
+    with np.errstate(invalid="ignore", divide="ignore"):
+        share = np.nansum(votes, axis=1) / n_valid[:, None]
+    majority = share >= 0.5
+    agreement = np.where(majority, share, 1 - share)
+    df = pd.DataFrame({"n_valid": n_valid}, index=dream_ids)
+    for k, item in enumerate(items):
+        df[item] = pd.array(np.where(n_valid > 0, majority[:, k], pd.NA), dtype="boolean")
+        df[f"{item}_agreement"] = agreement[:, k]
+    return df
+
+
+def consistency(dataset: str, task: str, choices: int) -> pd.DataFrame:
+    """Majority codes and agreement of a run with several choices per request (see `aggregate_votes`)."""
+    completions = utils.load_json(responses_path(dataset, task, choices))
+    votes, dream_ids = vote_array(completions, task)
+    return aggregate_votes(votes, dream_ids, task_items(task))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", required=True, type=str, choices=["dreamviews", "flying", "sddb"])
+    parser.add_argument(
+        "-t", "--task", required=True, type=str, choices=["isdream", "islucid", "thematicD", "thematicM", "thematicT"]
+    )
+    parser.add_argument("-k", "--choices", required=True, type=int, help="Choices per request of the run.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    df = consistency(args.dataset, args.task, args.choices)
+    export_path = utils.deriv_dir / f"{choices_stem(args.dataset, args.task, args.choices)}_consistency.csv"
+    df.to_csv(export_path, index=True)
+    agreement = df.filter(like="_agreement")
+    print(f"{len(df)} dreams, {(df['n_valid'] == 0).sum()} without a valid choice")
+    print(agreement.describe().T[["mean", "min", "25%", "50%"]].round(3))
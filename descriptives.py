@@ -0,0 +1,120 @@
+"""Materialized aggregate cube behind the descriptive tables and figures.
+
+```shell
+python descriptives.py    #> data-flying_sample-cube.csv
+```
+"""
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+
+
+CUBE_DIMENSIONS = ["source_id", "subject_id", "sex", "report_type", "lucidity"]
+
+cube_path = utils.deriv_dir / "data-flying_sample-cube.csv"
+cube_meta_path = utils.deriv_dir / "data-flying_sample-cube.json"
+
+
+def _input_paths() -> list:
+    """Files the summary cube is built from."""
+    return [
+        utils.source_dir / "Flying Dreams Database.xlsx",
+        utils.deriv_dir / "data-flying_task-islucid_responses.json",
+    ]
+
+
+@profiling.stage("compute", "summary cube")
+def build_summary_cube() -> pd.DataFrame:
+    """
+    Aggregate the Flying database in one pass over all reports.
+    Returns:
+        pd.DataFrame: One row per combination of source_id, subject_id, sex,
+            report_type and GPT lucidity code (missing for comments and uncoded
+            dreams), with the number of reports and text length statistics.
+    """
+
+    df = utils.load_sourcedata(dreams_only=False).drop(columns="GPT_ID500")
+    lucidity = utils.load_gpt_lucidity_codes(dataset="flying")
+    df = df.join(lucidity[~lucidity.index.duplicated()], how="left")
+    length = df["dream_text"].str.len()
+    cube = (
+        df.assign(length=length, length_sq=length**2)
+        .groupby(CUBE_DIMENSIONS, dropna=False, sort=True)
+        .agg(
+            n=("length", "size"),
+            length_sum=("length", "sum"),
+            length_sumsq=("length_sq", "sum"),
+            length_min=("length", "min"),
+            length_max=("length", "max"),
+        )
+        .reset_index()
+    )
+    return cube
+
+
+def load_summary_cube(rebuild: bool = False) -> pd.DataFrame:
+    """
+    Load the cached summary cube, rebuilding it when any of its inputs changed.
+    Args:
+        rebuild (bool): If True, rebuild even when the cache is current.
+    Returns:
+        pd.DataFrame: The summary cube (see `build_summary_cube`).
+    """
+
+    fingerprints = {str(p): utils.hash_file(p) for p in _input_paths()}
+    if (
+        not rebuild
+        and cube_path.exists()
+        and cube_meta_path.exists()
+        and utils.load_json(cube_meta_path) == fingerprints
+    ):
+        return pd.read_csv(cube_path, dtype={"subject_id": str})
+    build_summary_cube().to_csv(cube_path, index=False)
+    utils.save_json(fingerprints, cube_meta_path)
+    return pd.read_csv(cube_path, dtype={"subject_id": str})
+
+
+def count_table(cube: pd.DataFrame, index: str, columns: str, order: list = None) -> pd.DataFrame:
+    """
+    Number of reports for each combination of two cube dimensions.
+    Rows are sorted by their total, largest first.
+    Args:
+        cube (pd.DataFrame): A (possibly filtered) summary cube.
+        index (str): Dimension for the rows.
+        columns (str): Dimension for the columns.
+        order (list): Optional column order (and selection).
+    Returns:
+        pd.DataFrame: The count table.
+    """
+
+    counts = cube.groupby([index, columns])["n"].sum().unstack(fill_value=0)
+    counts = counts.reindex(counts.sum(axis=1).sort_values(ascending=False).index)
+    return counts if order is None else counts.reindex(columns=order, fill_value=0)
+
+
+def length_stats(cube: pd.DataFrame, by: list) -> pd.DataFrame:
+    """Mean, standard deviation, minimum and maximum text length per group."""
+    grouped = cube.groupby(by).agg(
+        n=("n", "sum"),
+        length_sum=("length_sum", "sum"),
+        length_sumsq=("length_sumsq", "sum"),
+        length_min=("length_min", "min"),
+        length_max=("length_max", "max"),
+    )
+    mean = grouped["length_sum"] / grouped["n"]
+    var = (grouped["length_sumsq"] - grouped["n"] * mean**2) / (grouped["n"] - 1)
+    return pd.DataFrame({
+        "n": grouped["n"],
+        "mean": mean,
+        "std": np.sqrt(var),
+        "min": grouped["length_min"],
+        "max": grouped["length_max"],
+    })
+
+
+if __name__ == "__main__":
+    profiling.setup()
+    load_summary_cube(rebuild=True)
@@ -0,0 +1,190 @@
+"""Find near-duplicate dreams across datasets with MinHash and locality-sensitive hashing.
+
+```shell
+python duplicates.py    #> data-all_duplicates.csv
+```
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from tokens import TokenStore, load_all
+
+
+def dataset_of(dream_ids: pd.Index) -> pd.Series:
+    """Name of the dataset each dream ID comes from, based on its prefix."""
+    dream_ids = pd.Index(dream_ids)
+    dataset = np.where(
+        dream_ids.str.startswith("DV-"),
+        "dreamviews",
+        np.where(dream_ids.str.startswith("SDDB-"), "sddb", "flying"),
+    )
+    return pd.Series(dataset, index=dream_ids, name="dataset")
+
+
+def shingle_hashes(tokens: TokenStore, k: int = 3) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Hash the word k-grams (shingles) of every text.
+    Each run of k consecutive token IDs is combined into one 32-bit hash.
+    Args:
+        tokens (TokenStore): The tokenized texts.
+        k (int): Number of words per shingle.
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The concatenated shingle hashes of all texts,
+            and the offset of each text's first shingle (length len(texts) + 1).
+            Texts shorter than k words get a single shingle of all their words.
+    """
+
+    codes = np.asarray(tokens.ids).astype(np.uint64) + np.uint64(1)
+    counts = tokens.lengths()
+    n_shingles = np.maximum(counts - k + 1, 1)
+    offsets = np.concatenate([[0], np.cumsum(n_shingles)])
+    # Position of the first word of every shingle, and the number of words it spans.
+    doc = np.repeat(np.arange(len(tokens)), n_shingles)
+    first = tokens.offsets[doc] + (np.arange(offsets[-1]) - offsets[doc])
+    span = np.minimum(counts[doc], k)
+    hashes = np.zeros(offsets[-1], dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j in range(k):
+            valid = j < span
+            hashes[valid] = hashes[valid] * np.uint64(1_000_003) + codes[first[valid] + j]
+    return hashes.astype(np.uint32), offsets
+
+
+def minhash_signatures(
+    hashes: np.ndarray, offsets: np.ndarray, num_perm: int = 128, seed: int = 32
+) -> np.ndarray:
+    """
+    MinHash signature of every text from its shingle hashes.
+    Each hash function is x -> (a * x + b) mod 2**32 with odd a, which permutes
+    32-bit values and only needs wrap-around uint32 arithmetic. Every function
+    is applied to all shingles at once and reduced per text with `reduceat`.
+    Args:
+        hashes (np.ndarray): Concatenated shingle hashes (from `shingle_hashes`).
+        offsets (np.ndarray): Offset of each text's first shingle; every text
+            must have at least one shingle.
+        num_perm (int): Number of hash functions (signature length).
+        seed (int): Seed for drawing the hash functions.
+    Returns:
+        np.ndarray: A uint32 array of shape (texts, num_perm).
+    """
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**32, size=num_perm, dtype=np.uint32) | np.uint32(1)
+    b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint32)
+    signatures = np.empty((offsets.size - 1, num_perm), dtype=np.uint32)
+    permuted = np.empty_like(hashes)
+    for i in range(num_perm):
+        np.multiply(hashes, a[i], out=permuted)
+        permuted += b[i]
+        signatures[:, i] = np.minimum.reduceat(permuted, offsets[:-1])
+    return signatures
+
+
+def lsh_candidates(signatures: np.ndarray, bands: int = 16) -> np.ndarray:
+    """
+    Pairs of texts whose signatures are identical in at least one band.
+    Args:
+        signatures (np.ndarray): MinHash signatures, shape (texts, num_perm).
+        bands (int): Number of bands; num_perm must be divisible by it.
+    Returns:
+        np.ndarray: Unique candidate pairs (i < j), shape (pairs, 2).
+    """
+
+    n_texts, num_perm = signatures.shape
+    assert num_perm % bands == 0, "Signature length must be divisible by the number of bands."
+    rows = num_perm // bands
+    pairs = []
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows : (band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, bucket, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        shared = sizes[bucket] > 1
+        if not shared.any():
+            continue
+        members = np.flatnonzero(shared)
+        order = members[np.argsort(bucket[members], kind="stable")]
+        groups = np.split(order, np.flatnonzero(np.diff(bucket[order])) + 1)
+        for group in groups:
+            i, j = np.triu_indices(group.size, k=1)
+            pairs.append(np.column_stack([group[i], group[j]]))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def connected_components(n: int, pairs: np.ndarray) -> np.ndarray:
+    """Label each of n items with the smallest index of its connected component."""
+    labels = np.arange(n)
+    # Propagate minimum labels along edges until nothing changes.
+    while pairs.size:
+        low = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        new = labels.copy()
+        np.minimum.at(new, pairs[:, 0], low)
+        np.minimum.at(new, pairs[:, 1], low)
+        new = new[new]  # Pointer jumping
+        if np.array_equal(new, labels):
+            break
+        labels = new
+    return labels
+
+
+@profiling.stage("compute", "duplicates")
+def find_duplicates(
+    tokens: TokenStore, threshold: float = 0.8, num_perm: int = 128, bands: int = 16, k: int = 3
+) -> pd.DataFrame:
+    """
+    Group near-duplicate texts into clusters.
+    Candidates from LSH are kept when their estimated Jaccard similarity of
+    word shingles is at least `threshold`, then linked into clusters.
+    Args:
+        tokens (TokenStore): The tokenized texts.
+        threshold (float): Minimum estimated Jaccard similarity of a duplicate pair.
+        num_perm (int): MinHash signature length.
+        bands (int): Number of LSH bands.
+        k (int): Number of words per shingle.
+    Returns:
+        pd.DataFrame: One row per dream that has at least one near-duplicate,
+            with its dataset and cluster ID (the first dream ID of the cluster).
+    """
+
+    hashes, offsets = shingle_hashes(tokens, k=k)
+    signatures = minhash_signatures(hashes, offsets, num_perm=num_perm)
+    pairs = lsh_candidates(signatures, bands=bands)
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[similarity >= threshold]
+    labels = connected_components(len(tokens), pairs)
+    in_cluster = np.zeros(len(tokens), dtype=bool)
+    in_cluster[pairs.ravel()] = True
+    dream_ids = np.asarray(tokens.dream_ids)
+    clusters = pd.DataFrame(
+        {"cluster_id": dream_ids[labels[in_cluster]]},
+        index=pd.Index(dream_ids[in_cluster], name="dream_id"),
+    )
+    clusters.insert(0, "dataset", dataset_of(clusters.index).to_numpy())
+    return clusters.sort_values(["cluster_id", "dataset"])
+
+
+def duplicated_across(clusters: pd.DataFrame, dataset: str, other: str) -> pd.Index:
+    """Dream IDs of `dataset` that are near-duplicates of a dream in `other`."""
+    has_other = clusters.groupby("cluster_id")["dataset"].transform(lambda x: (x == other).any())
+    return clusters.index[clusters["dataset"].eq(dataset) & has_other]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.8, help="Minimum Jaccard similarity."
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    clusters = find_duplicates(load_all(), threshold=args.threshold)
+    export_path = utils.deriv_dir / "data-all_duplicates.csv"
+    clusters.to_csv(export_path, index=True)
+    print(clusters.groupby("cluster_id")["dataset"].agg(lambda x: "+".join(sorted(set(x)))).value_counts())
@@ -0,0 +1,182 @@
+"""Rebuild only the figures whose inputs or code changed.
+
+```shell
+python figures.py                       # Rebuild outdated figures
+python figures.py timecourses --force   # Rebuild one figure script regardless
+python figures.py --dry-run             # Show what is outdated
+```
+"""
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import profiling
+import utils
+
+
+repo_dir = Path(__file__).parent
+state_path = utils.deriv_dir / "figures_state.json"
+
+source_flying = utils.source_dir / "Flying Dreams Database.xlsx"
+
+
+def responses(dataset: str, task: str) -> Path:
+    """Path of a ChatGPT responses file."""
+    return utils.deriv_dir / f"data-{dataset}_task-{task}_responses.json"
+
+
+def liwc(dataset: str, dic: str, nsegs: int = 1) -> Path:
+    """Path of a LIWC output file."""
+    return utils.deriv_dir / f"data-{dataset}_liwc-{dic}_nsegs-{nsegs}.csv"
+
+
+# Each figure script, the artifacts it reads and the files it writes.
+FIGURES = {
+    "descriptives": {
+        "script": "plot_descriptives.py",
+        "inputs": [source_flying, responses("flying", "islucid")],
+        "outputs": [
+            utils.deriv_dir / f"data-flying_sample-{x}.png"
+            for x in ["type", "lucidity", "sex", "authors", "ld4all"]
+        ],
+    },
+    "themes": {
+        "script": "plot_themes_lucidity.py",
+        "inputs": [responses("flying", f"thematic{x}") for x in "TMD"]
+        + [responses("flying", "islucid")],
+        "outputs": [utils.deriv_dir / "data-flying_themes-techniq_lucidity.png"],
+    },
+    "timecourses": {
+        "script": "plot_timecourses.py",
+        "inputs": [source_flying, responses("flying", "annotate"), responses("flying", "islucid")],
+        "outputs": [
+            utils.deriv_dir / f"data-flying_task-annotate_{x}.png"
+            for x in ["supp", "lucidity", "bars", "bars_flying", "bars_lucidity"]
+        ],
+    },
+    "liwc": {
+        "script": "plot_liwc.py",
+        "inputs": [
+            source_flying,
+            utils.source_dir / "dreamviews.tsv",
+            utils.source_dir / "SDDb.csv",
+            responses("flying", "islucid"),
+        ]
+        + [
+            liwc(dataset, dic)
+            for dataset in ["flying", "dreamviews", "sddb"]
+            for dic in ["22", "bigtwo", "vestibular"]
+        ],
+        "outputs": [
+            utils.deriv_dir / f"liwc-{x}_dreamviews.png" for x in ["Agency", "insight", "emo_pos"]
+        ],
+    },
+}
+
+
+def local_modules(script: str) -> list:
+    """
+    Find the repository modules a script depends on, following imports recursively.
+    Args:
+        script (str): File name of a script in the repository directory.
+    Returns:
+        list: Sorted file names of the script and every local module it imports.
+    """
+
+    found = set()
+    stack = [script]
+    while stack:
+        name = stack.pop()
+        if name in found:
+            continue
+        found.add(name)
+        tree = ast.parse((repo_dir / name).read_text(encoding="utf-8"))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                filename = module.split(".")[0] + ".py"
+                if (repo_dir / filename).exists():
+                    stack.append(filename)
+    return sorted(found)
+
+
+def fingerprint(inputs: list, code: list) -> dict:
+    """Content hashes of a target's input artifacts and code files."""
+    return {str(p): utils.hash_file(p) for p in [*inputs, *(repo_dir / c for c in code)]}
+
+
+def outdated(name: str, state: dict) -> bool:
+    """Whether a figure must be rebuilt, given the fingerprints of its last build."""
+    figure = FIGURES[name]
+    current = fingerprint(figure["inputs"], local_modules(figure["script"]))
+    return state.get(name) != current or not all(p.exists() for p in figure["outputs"])
+
+
+def render(name: str) -> tuple[str, int, float, str]:
+    """Run a figure script in its own process on the non-interactive Agg backend."""
+    env = os.environ | {"MPLBACKEND": "Agg"}
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, FIGURES[name]["script"]],
+        cwd=repo_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    return name, proc.returncode, time.perf_counter() - t0, proc.stderr
+
+
+def build(names: list = None, force: bool = False, jobs: int = None, dry_run: bool = False) -> list:
+    """
+    Rebuild the outdated figures, rendering independent scripts in parallel.
+    Args:
+        names (list): Figures to consider (all by default).
+        force (bool): Rebuild even if up to date.
+        jobs (int): Maximum number of scripts rendering at once (default: one per figure).
+        dry_run (bool): Only report which figures would be rebuilt.
+    Returns:
+        list: Names of the figures that were (or would be) rebuilt.
+    """
+
+    names = list(FIGURES) if not names else names
+    state = utils.load_json(state_path) if state_path.exists() else {}
+    todo = [name for name in names if force or outdated(name, state)]
+    for name in names:
+        print(f"{name:>15}: {'outdated' if name in todo else 'up to date'}")
+    if dry_run or not todo:
+        return todo
+    with ThreadPoolExecutor(max_workers=jobs or len(todo)) as pool:
+        for name, returncode, seconds, stderr in pool.map(render, todo):
+            if returncode == 0:
+                figure = FIGURES[name]
+                state[name] = fingerprint(figure["inputs"], local_modules(figure["script"]))
+                print(f"{name:>15}: rebuilt in {seconds:.1f}s")
+            else:
+                print(f"{name:>15}: FAILED after {seconds:.1f}s\n{stderr}")
+    utils.save_json(state, state_path)
+    return todo
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help=f"Figures to build ({', '.join(FIGURES)}).")
+    parser.add_argument("-f", "--force", action="store_true", help="Rebuild even if up to date.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Parallel render processes.")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only show what is outdated.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+    if unknown := set(args.names) - set(FIGURES):
+        parser.error(f"unknown figures: {', '.join(sorted(unknown))}")
+    build(args.names, force=args.force, jobs=args.jobs, dry_run=args.dry_run)
@@ -2,12 +2,25 @@
 
 import argparse
 import os
-from time import sleep
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import openai
+import pandas as pd
 from tqdm import tqdm
 
+import budget
+import combined
+import consistency
+import profiling
+import retry
+import routing
+import sequential
 import utils
+import validate
+from textstore import TextStore
 
 
 available_datasets = ["dreamviews", "flying", "sddb"]
@@ -19,6 +32,7 @@ available_tasks = [
     "thematicD",
     "thematicM",
     "thematicT",
+    "combined",
 ]
 
 parser = argparse.ArgumentParser()
@@ -32,13 +46,102 @@ parser.add_argument(
     action="store_true",
     help="Overwrite output file if it already exists.",
 )
+parser.add_argument(
+    "-m",
+    "--refresh-modified",
+    action="store_true",
+    help="Re-request dreams whose text changed since their response was stored.",
+)
 parser.add_argument("--test", action="store_true", help="Just run on 10 samples.")
+parser.add_argument(
+    "-r",
+    "--repair",
+    action="store_true",
+    help="Only re-request the dreams in the repair queue written by validate.py.",
+)
+parser.add_argument(
+    "--strict",
+    action="store_true",
+    help="Append a stricter format instruction to the prompt (for --repair).",
+)
+parser.add_argument(
+    "--max-tokens", type=int, default=None, help="Maximum number of tokens per completion."
+)
+parser.add_argument(
+    "-k",
+    "--choices",
+    type=int,
+    default=1,
+    help="Answers per request for self-consistency (saved to a separate responses file).",
+)
+parser.add_argument(
+    "--temperature",
+    type=float,
+    default=None,
+    help="Sampling temperature (default: 0, or 1 with several choices).",
+)
+parser.add_argument(
+    "-p",
+    "--plan",
+    action="store_true",
+    help="Only report the tokens, cost and wall time of the requests this run would make.",
+)
+parser.add_argument("--rpm", type=int, default=None, help="Requests per minute allowed (for --plan).")
+parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute allowed (for --plan).")
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=None,
+    help="Requests in flight at once on every model route (default: from config.yaml).",
+)
+parser.add_argument(
+    "--confidence",
+    type=str,
+    default=None,
+    help="CSV of per-dream agreement scores for routes with min_confidence (e.g., from consistency.py).",
+)
+parser.add_argument(
+    "-e",
+    "--estimate-by",
+    nargs="*",
+    default=None,
+    help="Request dreams in stratified random order and stop once the prevalence of True per group of these columns is precise enough (without columns: the dataset's default, see sequential.py).",
+)
+parser.add_argument(
+    "--precision",
+    type=float,
+    default=0.05,
+    help="Largest margin of the 95%% confidence interval of every prevalence (for --estimate-by).",
+)
+parser.add_argument(
+    "--max-attempts",
+    type=int,
+    default=6,
+    help="Attempts per dream before it goes to the dead-letter file (see retry.py).",
+)
+parser.add_argument(
+    "--timeout", type=float, default=120, help="Seconds before a request is abandoned and retried."
+)
+profiling.add_argument(parser)
 args = parser.parse_args()
+profiling.setup(args.profile)
+if args.estimate_by is not None and args.task not in ["isdream", "islucid"]:
+    parser.error("--estimate-by only works with True/False tasks")
+if args.choices > 1 and (args.repair or args.task in ["annotate", "combined"]):
+    parser.error("--choices only works with True/False and thematic tasks, without --repair")
 
 dataset = args.dataset
 overwrite = args.overwrite
+refresh_modified = args.refresh_modified
+repair = args.repair
 task = args.task
 testing = args.test
+planning = args.plan
+n_choices = args.choices
+if args.temperature is None:
+    temperature = 0 if n_choices == 1 else 1
+else:
+    temperature = args.temperature
 
 
 # Set OpenAI API key.
@@ -52,6 +155,13 @@ elif dataset == "dreamviews":
 elif dataset == "sddb":
     df = utils.load_sddb()
 
+# Check the estimation groups against the dataset's columns.
+if args.estimate_by is not None:
+    estimate_by = args.estimate_by or sequential.DEFAULT_GROUPS[dataset]
+    unknown = [c for c in estimate_by if c not in df.columns]
+    if unknown:
+        parser.error(f"{dataset} has no column {', '.join(unknown)}, choose from {', '.join(df.columns)}")
+
 # For testing, just use a small sample of the data.
 if testing:
     df = df.sample(n=100, random_seed=32)
@@ -59,27 +169,43 @@ if testing:
 assert df.index.name == "dream_id"
 assert df.index.is_unique
 
-# Get the dream text from the DataFrame.
-ser = df["dream_text"]
+# Hash the dream text, then read it from the memory-mapped text store rather
+# than keeping a second copy of the corpus in the DataFrame.
+dream_ids = df.index
+text_hashes = utils.hash_rows(df["dream_text"]).to_dict()
+df = df.drop(columns="dream_text")
+store = TextStore.load(dataset)
 
 # Load the ChatGPT prompt text.
 system_prompt = utils.load_txt(f"./prompt-system_task-{task}.txt")
 user_prompt = utils.load_txt(f"./prompt-user_task-{task}.txt")
+if args.strict:
+    user_prompt += validate.STRICT_INSTRUCTIONS[task]
 
 # Set the export path for the OpenAI responses.
-export_path = utils.deriv_dir / f"data-{dataset}_task-{task}_responses.json"
+export_path = utils.deriv_dir / f"{consistency.choices_stem(dataset, task, n_choices)}_responses.json"
+
+# Set the path for hashes of the dream text each response was requested with.
+hashes_path = utils.deriv_dir / f"{consistency.choices_stem(dataset, task, n_choices)}_hashes.json"
+
+# Set the path for how long each successful request took (see budget.past_usage).
+timings_path = utils.deriv_dir / f"{consistency.choices_stem(dataset, task, n_choices)}_timings.json"
+
+# Set the path for dreams whose requests failed permanently (see retry.py).
+deadletter_path = utils.deriv_dir / f"{consistency.choices_stem(dataset, task, n_choices)}_deadletter.json"
 
 # Set OpenAI/ChatGPT model parameters.
 model_kwargs = {
-    "model": "gpt-4",
-    "temperature": 0,  # Lower means more deterministic results
+    "model": routing.DEFAULT_ROUTE["model"],  # Replaced by each dream's route (see routing.py)
+    "temperature": temperature,  # Lower means more deterministic results
     "top_p": 1,  # Also impacts determinism, but don't modify this and temperature
-    "n": 1,  # Number of responses
+    "n": n_choices,  # Number of responses (choices), billed for the prompt only once
     "stream": False,
     "stop": None,
-    "max_tokens": None,  # The maximum number of tokens to generate in the chat completion
+    "max_tokens": args.max_tokens,  # The maximum number of tokens to generate in the chat completion
     "presence_penalty": 0,  # Penalizes tokens for occurring (or being absent if negative)
     "frequency_penalty": 0,
+    "request_timeout": args.timeout,  # Hung requests raise a Timeout and are retried
 }
 
 # Load existing responses if they exist.
@@ -89,26 +215,183 @@ else:
     # Initialize an empty dictionary to hold OpenAI responses/completions/results.
     responses = {}
 
+# Load the text hashes of existing responses.
+if hashes_path.exists() and not overwrite:
+    request_hashes = utils.load_json(hashes_path)
+else:
+    request_hashes = {}
+
+# Load the request durations of earlier runs.
+if timings_path.exists() and not overwrite:
+    timings = utils.load_json(timings_path)
+else:
+    timings = {}
+
+# Load the dead letters of earlier runs. They are requested again, and dropped once they succeed.
+if deadletter_path.exists() and not overwrite:
+    dead_letters = utils.load_json(deadletter_path)
+else:
+    dead_letters = {}
+# Responses from before hashes were recorded are assumed to match the current text.
+for dream_id in responses:
+    if dream_id in text_hashes:
+        request_hashes.setdefault(dream_id, text_hashes[dream_id])
+
+# Drop responses to dreams whose text changed, so only those get requested again.
+if refresh_modified:
+    modified = [
+        dream_id
+        for dream_id in responses
+        if dream_id in text_hashes and request_hashes.get(dream_id) != text_hashes[dream_id]
+    ]
+    print(f"Re-requesting {len(modified)} modified dreams.")
+    for dream_id in modified:
+        del responses[dream_id]
+
+# Re-request only the dreams whose stored completion failed validation. Their old
+# completions are kept until replaced, so an interrupted repair loses nothing.
+redo = set()
+if repair:
+    queue = validate.repair_path(dataset, task)
+    assert queue.exists(), f"No repair queue, run validate.py --dataset {dataset} --task {task} first."
+    redo = set(utils.load_json(queue)) & set(dream_ids)
+    dream_ids = dream_ids[dream_ids.isin(list(redo))]
+    print(f"Repairing {len(redo)} dreams.")
+
+# Order dreams for sequential estimation: stratified by the estimation groups,
+# sex and text length, with a fixed seed so later runs continue the same order.
+estimating = args.estimate_by is not None
+if estimating:
+    lengths = pd.Series(np.diff(store.offsets)[store.locate(dream_ids)], index=dream_ids)
+    strata = df[[c for c in [*estimate_by, "sex"] if c in df]].assign(length=sequential.length_bins(lengths))
+    dream_ids = sequential.stratified_order(strata.loc[dream_ids], seed=0)
+    groups = df.loc[dream_ids, estimate_by].astype(str).agg("|".join, axis=1)
+    codes = sequential.current_codes(responses, task, dream_ids)
+
+# Route every dream still to request to a model, based on its cleaned text
+# length (cleaned texts are ASCII, so bytes are characters) and the task.
+todo = dream_ids[~dream_ids.isin(list(responses)) | dream_ids.isin(list(redo))]
+routes = routing.load_routes()
+if args.concurrency:
+    routes = [route | {"concurrency": args.concurrency} for route in routes]
+lengths = np.diff(store.offsets)[store.locate(todo)]
+confidence = routing.load_confidence(args.confidence, todo) if args.confidence else None
+route_of = routing.assign_routes(routes, task, lengths, confidence)
+
+# Report what the remaining requests would cost on each route, without making them.
+if planning:
+    usage = budget.past_usage(task, dataset)
+    for i, route in enumerate(routes):
+        if not (route_of == i).any():
+            continue
+        prompt_tokens, exact = budget.count_prompt_tokens(
+            store, todo[route_of == i], system_prompt, user_prompt, model=route["model"]
+        )
+        figures = budget.plan(
+            prompt_tokens,
+            usage,
+            model=route["model"],
+            choices=n_choices,
+            rpm=args.rpm,
+            tpm=args.tpm,
+            concurrency=route["concurrency"],
+        )
+        print(f"Route {i}: {route['model']}")
+        budget.print_plan(figures, usage, exact)
+    sys.exit()
+
 # Initialize the ChatGPT messages.
 system_message = dict(role="system", content=system_prompt)
-user_message = dict(role="user")
-
-# Iterate over the dream reports and ask ChatGPT to identify lucidity.
-for dream_id, dream_report in tqdm(ser.items(), total=ser.size, desc="Dreams"):
-    if dream_id not in responses:
-        # Add this dream report to the ChatGPT prompt.
-        user_content = user_prompt.replace("<INSERT_DREAM>", dream_report)
-        # Update ChatGPT model parameters with the updated user prompt.
-        user_message.update(content=user_content)
-        model_kwargs.update(messages=[system_message, user_message])
-        # Request a response from OpenAI/ChatGPT.
-        move_on = False
-        while not move_on:
-            try:
-                responses[dream_id] = openai.ChatCompletion.create(**model_kwargs)
-                move_on = True
-            except openai.error.RateLimitError:
-                print("Rate Limit Error, backing off and trying again...")
-                sleep(1.0)
-        # Write cumulative results to file.
-        utils.save_json(responses, export_path)
+
+
+def request_completion(dream_id: str, route: int) -> tuple:
+    """
+    Request the completion of one dream on a route (run in the route's thread pool).
+    Returns the dream ID, either its completion or the `retry.GiveUp` failure,
+    and the seconds the successful attempt took (without retries and backoff).
+    """
+    # Add this dream report to the ChatGPT prompt.
+    user_content = user_prompt.replace("<INSERT_DREAM>", store[dream_id])
+    user_message = dict(role="user", content=user_content)
+    kwargs = model_kwargs | {"model": routes[route]["model"], "messages": [system_message, user_message]}
+    # Request a response from OpenAI/ChatGPT, retrying throttled and transient errors.
+    # The response records the model that answered.
+    seconds = []
+
+    def create():
+        start = time.perf_counter()
+        response = openai.ChatCompletion.create(**kwargs)
+        seconds.append(time.perf_counter() - start)
+        return response
+
+    try:
+        with profiling.stage("request", routes[route]["model"]):
+            response = retry.call(create, throttles[route], max_attempts=args.max_attempts, log=tqdm.write)
+    except retry.GiveUp as failure:
+        return dream_id, failure, None
+    return dream_id, response, seconds[-1]
+
+
+def estimate() -> bool:
+    """Print the current prevalence estimates and return whether they are precise enough."""
+    table = sequential.prevalence(codes, groups)
+    tqdm.write(table[["n", "N", "p", "margin"]].round(3).to_string())
+    return sequential.precise_enough(table, args.precision)
+
+
+# Request every dream on its route's pool, so each model gets its own concurrency.
+# When estimating, dreams are requested in small batches until the estimates are precise enough.
+pools = [ThreadPoolExecutor(max_workers=route["concurrency"]) for route in routes]
+throttles = [retry.Throttle() for route in routes]
+batch_size = 2 * sum(route["concurrency"] for route in routes) if estimating else max(len(todo), 1)
+progress = tqdm(total=len(todo), desc="Dreams")
+try:
+    for start in range(0, len(todo), batch_size):
+        if estimating and estimate():
+            tqdm.write(f"All prevalences within ±{args.precision}, stopping.")
+            break
+        batch = slice(start, start + batch_size)
+        futures = [
+            pools[r].submit(request_completion, dream_id, r)
+            for dream_id, r in zip(todo[batch], route_of[batch])
+        ]
+        for future in as_completed(futures):
+            dream_id, response, seconds = future.result()
+            progress.update()
+            # Set permanently failing dreams aside instead of blocking the run.
+            if isinstance(response, retry.GiveUp):
+                dead_letters[dream_id] = response.record()
+                utils.save_json(dead_letters, deadletter_path)
+                continue
+            if dead_letters.pop(dream_id, None) is not None:
+                utils.save_json(dead_letters, deadletter_path)
+            responses[dream_id] = response
+            request_hashes[dream_id] = text_hashes[dream_id]
+            timings[dream_id] = round(seconds, 3)
+            # Write cumulative results to file.
+            utils.save_json(responses, export_path)
+            utils.save_json(request_hashes, hashes_path)
+            utils.save_json(timings, timings_path, indent=None)
+            redo.discard(dream_id)
+            if estimating:
+                codes[dream_id] = sequential.current_codes({dream_id: response}, task, [dream_id]).iloc[0]
+    else:
+        if estimating:
+            estimate()
+finally:
+    progress.close()
+    for pool in pools:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+if dead_letters:
+    print(f"{len(dead_letters)} dreams failed permanently, see {deadletter_path.name}.")
+
+# Re-validate the repaired dreams, keeping those that still fail in the queue.
+if repair:
+    failures = validate.update_repair_queue(dataset, task)
+    print(f"{len(failures)} dreams still fail validation.")
+
+# Split combined-task codes into the per-task responses files (without replacing existing ones).
+if task == "combined":
+    for subtask, n in combined.demultiplex_responses(dataset).items():
+        print(f"{subtask}: {n} completions added")
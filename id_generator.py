@@ -1,28 +1,205 @@
+"""Allocate unique fly-xxxx dream IDs from a persistent registry.
+
+IDs are drawn from a seeded random stream and kept if they start with a
+letter, contain a digit and spell no month abbreviation. Candidates are drawn
+and checked in vectorized batches against the registry of allocated IDs, and
+the registry records how far the stream was read. New dreams therefore get new
+IDs without regenerating or reshuffling existing ones. With the default seed
+and length, the first 6876 IDs are the original ones.
+
+```shell
+python id_generator.py --total 6876                # The original IDs   #> dream_ids.json, ./ids.csv
+python id_generator.py --add 250                   # IDs for 250 new dreams
+python id_generator.py --add 50000 --length 6      # Longer IDs once 4 hex digits run short
+```
+"""
+
+import argparse
 import calendar
 import random
-import uuid
+from pathlib import Path
+
+import numpy as np
+
+import profiling
+import utils
+
+
+PREFIX = "fly-"
+SEED = 32
+DEFAULT_LENGTH = 4
+MAX_LENGTH = 16  # Hex digits that fit the uint64 codes
+
+# Month abbreviations that hex digits can spell (the others contain other letters).
+MONTHS = [m.lower() for m in calendar.month_abbr[1:] if set(m.lower()) <= set("abcdef")]
+
+registry_path = utils.source_dir / "dream_ids.json"
+export_path = Path("./ids.csv")
+
+
+def capacity(length: int) -> int:
+    """Number of valid IDs with `length` hex digits."""
+    # Count strings digit by digit, keeping the last two digits (enough to
+    # spot a three-letter month) and whether a number was seen.
+    words = [tuple(int(c, 16) for c in m) for m in MONTHS]
+    counts = {((), False): 1}
+    for position in range(length):
+        updated = {}
+        for (tail, has_number), count in counts.items():
+            for digit in range(10, 16) if position == 0 else range(16):
+                window = tail + (digit,)
+                if any(window[-len(w):] == w for w in words if len(window) >= len(w)):
+                    continue
+                key = (window[-2:], has_number or digit < 10)
+                updated[key] = updated.get(key, 0) + count
+        counts = updated
+    return sum(count for (_, has_number), count in counts.items() if has_number)
+
+
+def draw_candidates(rng: random.Random, n: int, length: int) -> np.ndarray:
+    """
+    Draw the hex digits of the next `n` candidates of the stream at once.
+    Each candidate is the first `length` hex digits of a 128-bit draw, as in
+    `uuid.UUID(int=rng.getrandbits(128)).hex[:length]`. One call for n * 128
+    bits returns the same bits as n calls for 128 bits.
+    Args:
+        rng (random.Random): The seeded stream.
+        n (int): Number of candidates.
+        length (int): Hex digits per candidate.
+    Returns:
+        np.ndarray: The digits (0-15), shape (n, length).
+    """
+
+    bits = rng.getrandbits(128 * n).to_bytes(16 * n, "little")
+    # Bytes of every draw, most significant first.
+    top = np.frombuffer(bits, np.uint8).reshape(n, 16)[:, ::-1][:, : (length + 1) // 2]
+    return np.stack([top >> 4, top & 15], axis=2).reshape(n, -1)[:, :length]
+
+
+def is_valid(digits: np.ndarray) -> np.ndarray:
+    """Whether candidates start with a letter, contain a number and spell no month."""
+    letters = digits >= 10
+    valid = letters[:, 0] & ~letters.all(axis=1)
+    for month in MONTHS:
+        word = np.array([int(c, 16) for c in month])
+        if digits.shape[1] >= len(word):
+            windows = np.lib.stride_tricks.sliding_window_view(digits, len(word), axis=1)
+            valid &= ~(windows == word).all(axis=2).any(axis=1)
+    return valid
+
+
+def to_codes(digits: np.ndarray) -> np.ndarray:
+    """Integer code of every candidate, for set operations."""
+    shifts = 4 * np.arange(digits.shape[1] - 1, -1, -1, dtype=np.uint64)
+    return (digits.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+
+class IDRegistry:
+    """
+    Allocated dream IDs and the position of the random stream they came from.
+    Args:
+        ids (list): Allocated IDs, in allocation order.
+        seed (int): Seed of the stream.
+        length (int): Hex digits of new IDs.
+        draws (int): Number of candidates read from the stream so far.
+    """
+
+    def __init__(self, ids: list = None, seed: int = SEED, length: int = DEFAULT_LENGTH, draws: int = 0):
+        assert 1 <= length <= MAX_LENGTH, f"IDs have 1 to {MAX_LENGTH} hex digits."
+        self.ids = list(ids or [])
+        self.seed = seed
+        self.length = length
+        self.draws = draws
+
+    @classmethod
+    def load(cls, path: Path = None):
+        """
+        Load the registry.
+        Without a registry, the IDs of an ids.csv written by an earlier version
+        are taken over as allocated, so they are never handed out again.
+        """
+        path = path or registry_path
+        if path.exists():
+            state = utils.load_json(path)
+            return cls(state["ids"], state["seed"], state["length"], state["draws"])
+        if export_path.exists():
+            return cls(export_path.read_text(encoding="utf-8").split())
+        return cls()
+
+    def save(self, path: Path = None) -> None:
+        """Save the registry."""
+        path = path or registry_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        state = {"seed": self.seed, "length": self.length, "draws": self.draws, "ids": self.ids}
+        utils.save_json(state, path, indent=None)
 
+    def __len__(self) -> int:
+        return len(self.ids)
 
-rd = random.Random()
-rd.seed(32)
+    def available(self) -> int:
+        """Number of IDs of the current length that are not allocated yet."""
+        return capacity(self.length) - sum(len(x) == len(PREFIX) + self.length for x in self.ids)
 
-months = [x.lower() for x in calendar.month_abbr[1:]]
+    def allocate(self, n: int) -> list:
+        """
+        Allocate `n` new IDs.
+        Args:
+            n (int): Number of IDs.
+        Returns:
+            list: The new IDs, also appended to `ids`.
+        Raises:
+            ValueError: If fewer than `n` IDs of the current length are left.
+        """
 
-export_path = "./ids.csv"
-n = 6876
+        available = self.available()
+        if n > available:
+            raise ValueError(f"Only {available} IDs of {self.length} hex digits are left, use a longer length.")
+        # Continue the stream where the last allocation stopped.
+        rng = random.Random(self.seed)
+        if self.draws:
+            rng.getrandbits(128 * self.draws)
+        taken = to_codes(np.array(
+            [[int(c, 16) for c in x[len(PREFIX):]] for x in self.ids if len(x) == len(PREFIX) + self.length],
+            dtype=np.uint8,
+        ).reshape(-1, self.length))
+        new = np.empty(0, dtype=np.uint64)
+        while len(new) < n:
+            # Draw enough candidates for the rest, given how many are still free.
+            rate = max(available - len(new), 1) / 16**self.length
+            batch = int(min((n - len(new)) / rate * 1.2 + 64, 1_000_000))
+            digits = draw_candidates(rng, batch, self.length)
+            position = np.flatnonzero(is_valid(digits))
+            codes = to_codes(digits[position])
+            # Keep the first draw of every code that is not taken yet, in stream order.
+            _, first = np.unique(codes, return_index=True)
+            keep = np.zeros(len(codes), dtype=bool)
+            keep[first] = True
+            keep &= ~np.isin(codes, taken) & ~np.isin(codes, new)
+            accepted = np.flatnonzero(keep)[: n - len(new)]
+            new = np.concatenate([new, codes[accepted]])
+            # Only count the draws up to the last accepted one, so the next allocation continues from there.
+            self.draws += int(position[accepted[-1]]) + 1 if len(new) == n else batch
+        ids = [f"{PREFIX}{code:0{self.length}x}" for code in new.tolist()]
+        self.ids.extend(ids)
+        return ids
 
-ids = []
 
-while len(ids) < n:
-    h = uuid.UUID(int=rd.getrandbits(128)).hex[:4]
-    if (
-        h.isidentifier()
-        and any(x.isnumeric() for x in h)
-        and h not in ids
-        and not any(x in h for x in months)
-    ):
-        ids.append(h)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-a", "--add", type=int, help="Allocate this many new IDs.")
+    group.add_argument("-n", "--total", type=int, help="Allocate IDs until there are this many.")
+    parser.add_argument("-l", "--length", type=int, default=None, help="Hex digits of new IDs (kept for later runs).")
+    parser.add_argument("-o", "--export", type=Path, default=export_path, help="Text file of all IDs, one per line.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
 
-ids = [f"fly-{x}" for x in ids]
-with open(export_path, "w", encoding="utf-8") as f:
-    f.writelines("\n".join(ids))
+    registry = IDRegistry.load()
+    if args.length is not None:
+        registry.length = args.length
+    n = args.add if args.add is not None else max(args.total - len(registry), 0)
+    new_ids = registry.allocate(n)
+    registry.save()
+    args.export.write_text("\n".join(registry.ids), encoding="utf-8")
+    print(f"{len(new_ids)} new IDs, {len(registry)} in total, {registry.available()} of {registry.length} hex digits left.")
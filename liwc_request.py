@@ -5,7 +5,9 @@ import os
 import subprocess
 from time import sleep
 
+import profiling
 import utils
+from textstore import TextStore
 
 
 available_datasets = ["dreamviews", "flying", "sddb"]
@@ -39,7 +41,9 @@ parser.add_argument(
     action="store_true",
     help="Overwrite output file if it already exists.",
 )
+profiling.add_argument(parser)
 args = parser.parse_args()
+profiling.setup(args.profile)
 
 dataset = args.dataset
 overwrite = args.overwrite
@@ -72,17 +76,11 @@ exclude_categories = ",".join(
 p = subprocess.Popen("C:\\Program Files\\LIWC-22\\LIWC-22.exe")
 sleep(10)  # Give it a few seconds to open up.
 
-if dataset == "flying":
-    df = utils.load_sourcedata(dreams_only=False)
-elif dataset == "dreamviews":
-    df = utils.load_dreamviews()
-elif dataset == "sddb":
-    df = utils.load_sddb()
-
+# Stream the texts from the memory-mapped store to a (dream_id, dream_text) file.
 temp_file_path = "./temp.csv"
-df.to_csv(temp_file_path, index=True)
+TextStore.load(dataset).to_csv(temp_file_path)
 
-column_indices = 1 + df.reset_index().columns.tolist().index("dream_text")
+column_indices = 2
 row_id_indices = 1
 
 for dictx_id, dictx_path in dictionaries.items():
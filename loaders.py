@@ -0,0 +1,135 @@
+"""Load several datasets and derivative files at once.
+
+Loads run concurrently, so a script that needs several datasets waits about as
+long as its slowest load. Reading files and parsing CSV and JSON release the
+GIL and overlap on a thread pool, the default. Cleaning dream texts and parsing
+the Flying spreadsheet (openpyxl) run in Python and hold it, so loads of whole
+datasets only overlap in worker processes (`processes=True`, their frames are
+pickled back). Workers are forked, so scripts without a main guard work too;
+where fork is not available (Windows), loads run on threads.
+
+Loaders are looked up by name when they run. Inside the analysis server
+(server.py) loads always run on threads, so they go through its cache.
+
+```python
+import loaders
+frames = loaders.load_many({
+    "flying": loaders.request("sourcedata", dreams_only=True),
+    "dreamviews": loaders.request("dreamviews"),
+    ("liwc", "sddb", "22"): loaders.request("liwc", "sddb", "22"),
+})
+```
+"""
+
+import importlib
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import profiling
+
+
+# Loader names and the module attributes they resolve to.
+LOADERS = {
+    "sourcedata": "utils.load_sourcedata",
+    "dreamviews": "utils.load_dreamviews",
+    "sddb": "utils.load_sddb",
+    "lucidity": "utils.load_gpt_lucidity_codes",
+    "liwc": "utils.load_liwc",
+    "tokens": "tokens.load_all",
+    "themes": "themes.ThemeMatrix.load",
+    "timecourses": "spans.Timecourses.load",
+    "summary": "descriptives.load_summary_cube",
+}
+
+
+class LoadError(Exception):
+    """
+    Raised when some of the requested loads failed.
+    Args:
+        errors (dict): The exception of every failed request, by key.
+    """
+
+    def __init__(self, errors: dict):
+        self.errors = errors
+        details = "\n".join(f"  {key!r}: {type(e).__name__}: {e}" for key, e in errors.items())
+        super().__init__(f"{len(errors)} load(s) failed:\n{details}")
+
+
+def request(loader: str, *args, **kwargs) -> tuple:
+    """
+    A load to pass to `submit` or `load_many`.
+    Args:
+        loader (str): A name of `LOADERS`.
+        *args, **kwargs: The loader's arguments.
+    Returns:
+        tuple: The loader name, arguments and keyword arguments.
+    """
+
+    if loader not in LOADERS:
+        raise ValueError(f"Unknown loader {loader}, choose from {', '.join(LOADERS)}.")
+    return loader, args, kwargs
+
+
+def _call(loader: str, args: tuple, kwargs: dict):
+    """Resolve a loader by name and call it (importable, so worker processes can run it)."""
+    module, *attrs = LOADERS[loader].split(".")
+    func = importlib.import_module(module)
+    for attr in attrs:
+        func = getattr(func, attr)
+    with profiling.stage("load", loader):
+        return func(*args, **kwargs)
+
+
+def submit(requests: dict, executor) -> dict:
+    """
+    Start every load on an executor.
+    Args:
+        requests (dict): Loads (see `request`) by any hashable key.
+        executor (concurrent.futures.Executor): The pool to run them on.
+    Returns:
+        dict: A future of every load, by the same keys.
+    """
+
+    return {key: executor.submit(_call, *spec) for key, spec in requests.items()}
+
+
+def load_many(requests: dict, jobs: int = None, processes: bool = False, errors: str = "raise") -> dict:
+    """
+    Run loads concurrently and wait for all of them.
+    Args:
+        requests (dict): Loads (see `request`) by any hashable key.
+        jobs (int): Maximum number of loads at once (default: all of them,
+            or one per CPU with processes).
+        processes (bool): Run the loads in forked worker processes instead of
+            threads (ignored inside the analysis server and without fork).
+        errors (str): "raise" to raise a `LoadError` with every failure once
+            all loads finished, or "return" to return failures' exceptions in
+            place of their results.
+    Returns:
+        dict: The result of every load, by the same keys.
+    Raises:
+        LoadError: If any load failed and `errors` is "raise".
+    """
+
+    assert errors in ["raise", "return"], "errors is 'raise' or 'return'."
+    if not requests:
+        return {}
+    # Worker processes would miss the analysis server's cache. Spawned workers
+    # would re-run scripts that load at module level, so only fork is used.
+    server = sys.modules.get("server")
+    if processes and getattr(server, "cache", None) is None and "fork" in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(
+            max_workers=min(jobs or os.cpu_count() or 1, len(requests)),
+            mp_context=multiprocessing.get_context("fork"),
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=min(jobs or len(requests), len(requests)))
+    with executor:
+        futures = submit(requests, executor)
+        wait(futures.values())
+    failed = {key: f.exception() for key, f in futures.items() if f.exception() is not None}
+    if failed and errors == "raise":
+        raise LoadError(failed) from next(iter(failed.values()))
+    return {key: failed[key] if key in failed else f.result() for key, f in futures.items()}
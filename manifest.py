@@ -0,0 +1,37 @@
+"""List dreams added, removed or modified since the previous source data load.
+
+```shell
+python manifest.py --reload    # Reload the spreadsheet, then diff against the previous manifest
+```
+"""
+
+import argparse
+
+import profiling
+import utils
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-r",
+    "--reload",
+    action="store_true",
+    help="Reload the source data first, recording a new manifest if anything changed.",
+)
+parser.add_argument("-v", "--verbose", action="store_true", help="List every dream ID.")
+profiling.add_argument(parser)
+args = parser.parse_args()
+profiling.setup(args.profile)
+
+if args.reload:
+    utils.load_sourcedata(dreams_only=False)
+
+current_path, previous_path = utils.manifest_paths("flying")
+if not previous_path.exists():
+    print("No previous manifest to compare against.")
+else:
+    diff = utils.diff_manifests(utils.load_json(previous_path), utils.load_json(current_path))
+    for kind, dream_ids in diff.items():
+        print(f"{kind:>9}: {len(dream_ids)}")
+        if args.verbose and dream_ids:
+            print("    " + " ".join(dream_ids))
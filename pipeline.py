@@ -0,0 +1,270 @@
+"""Run the whole study (GPT coding, LIWC, parsing, plotting) as a dependency graph.
+
+Each step is re-run only if the content of its inputs or code changed since
+its last successful run, and independent steps run concurrently.
+
+```shell
+python pipeline.py --dry-run                # Show what would run
+python pipeline.py                          # Run everything that is outdated
+python pipeline.py fig-timecourses          # Run one step and whatever it needs
+python pipeline.py --limit openai=2         # Cap concurrent steps using a resource
+```
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import profiling
+import utils
+from figures import FIGURES, fingerprint, liwc, local_modules, repo_dir, responses
+from textstore import TextStore, source_files
+
+
+state_path = utils.deriv_dir / "pipeline_state.json"
+
+# How many steps using each resource may run at once.
+RESOURCE_LIMITS = {
+    "openai": 3,  # Concurrent API runs (they share the same rate limits)
+    "liwc": 1,  # The LIWC-22 desktop app can only serve one run at a time
+    "cpu": os.cpu_count() or 1,
+}
+
+# Dataset x task combinations coded with ChatGPT.
+GPT_RUNS = [
+    ("flying", "isdream"),
+    ("dreamviews", "islucid"),
+    ("flying", "islucid"),
+    ("sddb", "islucid"),
+    ("flying", "thematicT"),
+    ("flying", "thematicM"),
+    ("flying", "thematicD"),
+    ("flying", "annotate"),
+]
+
+
+def make_steps() -> dict:
+    """
+    Define every step of the pipeline.
+    Returns:
+        dict: Step name -> dictionary with the command to run, its input and
+            output files, code files, and the resources it occupies.
+    """
+
+    steps = {}
+    for dataset in source_files:
+        steps[f"texts-{dataset}"] = {
+            "command": ["textstore.py", "--dataset", dataset],
+            "inputs": [source_files[dataset]],
+            "outputs": list(TextStore.paths(dataset).values()),
+            "resources": {"cpu": 1},
+        }
+    for dataset, task in GPT_RUNS:
+        steps[f"gpt-{dataset}-{task}"] = {
+            "command": ["gpt_request.py", "--dataset", dataset, "--task", task],
+            "inputs": [
+                source_files[dataset],
+                *TextStore.paths(dataset).values(),
+                repo_dir / f"prompt-system_task-{task}.txt",
+                repo_dir / f"prompt-user_task-{task}.txt",
+            ],
+            "outputs": [responses(dataset, task)],
+            "resources": {"openai": 1},
+        }
+    for dataset in source_files:
+        steps[f"liwc-{dataset}"] = {
+            "command": ["liwc_request.py", "--dataset", dataset],
+            "inputs": [source_files[dataset], *TextStore.paths(dataset).values()],
+            "outputs": [liwc(dataset, dic) for dic in ["22", "bigtwo", "vestibular"]],
+            "resources": {"liwc": 1},
+        }
+    steps["spans"] = {
+        "command": ["spans.py", "--dataset", "flying"],
+        "inputs": [
+            source_files["flying"],
+            *TextStore.paths("flying").values(),
+            responses("flying", "annotate"),
+            responses("flying", "islucid"),
+        ],
+        "outputs": [utils.deriv_dir / "data-flying_task-annotate_timecourses.npz"],
+        "resources": {"cpu": 1},
+    }
+    steps["themes"] = {
+        "command": ["themes.py", "--dataset", "flying"],
+        "inputs": [responses("flying", f"thematic{x}") for x in "TMD"],
+        "outputs": [utils.deriv_dir / "data-flying_themes.npz"],
+        "resources": {"cpu": 1},
+    }
+    steps["descriptives"] = {
+        "command": ["descriptives.py"],
+        "inputs": [source_files["flying"], responses("flying", "islucid")],
+        "outputs": [utils.deriv_dir / "data-flying_sample-cube.csv"],
+        "resources": {"cpu": 1},
+    }
+    for name, figure in FIGURES.items():
+        steps[f"fig-{name}"] = {
+            "command": [figure["script"]],
+            "inputs": figure["inputs"],
+            "outputs": figure["outputs"],
+            "resources": {"cpu": 1},
+        }
+    # Figure scripts also read the caches built by the parsing steps.
+    steps["fig-timecourses"]["inputs"] = steps["fig-timecourses"]["inputs"] + steps["spans"]["outputs"]
+    steps["fig-themes"]["inputs"] = steps["fig-themes"]["inputs"] + steps["themes"]["outputs"]
+    steps["fig-descriptives"]["inputs"] = steps["fig-descriptives"]["inputs"] + steps["descriptives"]["outputs"]
+    for step in steps.values():
+        step["code"] = local_modules(step["command"][0])
+    return steps
+
+
+def dependencies(steps: dict) -> dict:
+    """Map each step to the steps producing any of its inputs."""
+    producers = {str(p): name for name, step in steps.items() for p in step["outputs"]}
+    return {
+        name: sorted({producers[str(p)] for p in step["inputs"] if str(p) in producers} - {name})
+        for name, step in steps.items()
+    }
+
+
+def select(targets: list, deps: dict) -> list:
+    """Return the targets and all their upstream steps, in topological order."""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        assert name not in visiting, f"Dependency cycle at {name}."
+        visiting.add(name)
+        for dep in deps[name]:
+            visit(dep)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def is_outdated(step: dict, state: dict, name: str) -> bool:
+    """Whether a step's inputs or code changed since its last run, or an output is missing."""
+    current = fingerprint(step["inputs"], step["code"])
+    return state.get(name) != current or not all(p.exists() for p in step["outputs"])
+
+
+def execute(name: str, step: dict) -> tuple[str, int, float, str]:
+    """Run one step in its own process."""
+    env = os.environ | {"MPLBACKEND": "Agg"}
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *step["command"]], cwd=repo_dir, env=env, capture_output=True, text=True
+    )
+    return name, proc.returncode, time.perf_counter() - t0, proc.stderr
+
+
+def run(
+    targets: list = None,
+    dry_run: bool = False,
+    force: bool = False,
+    limits: dict = None,
+) -> dict:
+    """
+    Run the outdated steps needed for the given targets.
+    Steps start as soon as all their upstream steps finished and the resources
+    they need are free. A step whose upstream step failed is skipped.
+    Args:
+        targets (list): Steps to bring up to date (all by default).
+        dry_run (bool): Only report which steps would run.
+        force (bool): Run every selected step, even if up to date.
+        limits (dict): Overrides of `RESOURCE_LIMITS`.
+    Returns:
+        dict: Step name -> status ("up to date", "would run", "done", "failed" or "skipped").
+    """
+
+    steps = make_steps()
+    deps = dependencies(steps)
+    order = select(targets or list(steps), deps)
+    state = utils.load_json(state_path) if state_path.exists() else {}
+    limits = RESOURCE_LIMITS | (limits or {})
+
+    if dry_run:
+        status = {}
+        for name in order:
+            upstream_runs = any(status[d] == "would run" for d in deps[name])
+            if force or upstream_runs or is_outdated(steps[name], state, name):
+                status[name] = "would run"
+            else:
+                status[name] = "up to date"
+            print(f"{name:>25}: {status[name]}")
+        return status
+
+    status = {}
+    in_use = dict.fromkeys(limits, 0)
+    pending = list(order)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(order))) as pool:
+        while pending or running:
+            for name in list(pending):
+                if any(d in pending or d in running.values() for d in deps[name]):
+                    continue
+                if any(status.get(d) in ("failed", "skipped") for d in deps[name]):
+                    status[name] = "skipped"
+                    pending.remove(name)
+                    print(f"{name:>25}: skipped (upstream failure)")
+                    continue
+                step = steps[name]
+                if not force and not is_outdated(step, state, name):
+                    status[name] = "up to date"
+                    pending.remove(name)
+                    continue
+                if any(in_use[r] + n > limits[r] for r, n in step["resources"].items()):
+                    continue
+                for r, n in step["resources"].items():
+                    in_use[r] += n
+                pending.remove(name)
+                running[pool.submit(execute, name, step)] = name
+                print(f"{name:>25}: started")
+            if not running:
+                if pending:
+                    raise RuntimeError(f"Resource limits too low to start: {', '.join(pending)}")
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                _, returncode, seconds, stderr = future.result()
+                for r, n in steps[name]["resources"].items():
+                    in_use[r] -= n
+                if returncode == 0:
+                    status[name] = "done"
+                    state[name] = fingerprint(steps[name]["inputs"], steps[name]["code"])
+                    utils.save_json(state, state_path)
+                    print(f"{name:>25}: done in {seconds:.1f}s")
+                else:
+                    status[name] = "failed"
+                    print(f"{name:>25}: FAILED after {seconds:.1f}s\n{stderr}")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*", help="Steps to bring up to date (default: all).")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only show what would run.")
+    parser.add_argument("-f", "--force", action="store_true", help="Run steps even if up to date.")
+    parser.add_argument(
+        "-l",
+        "--limit",
+        action="append",
+        default=[],
+        metavar="RESOURCE=N",
+        help=f"Concurrency limit per resource ({', '.join(RESOURCE_LIMITS)}).",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+    names = make_steps()
+    if unknown := set(args.targets) - set(names):
+        parser.error(f"unknown steps: {', '.join(sorted(unknown))}")
+    limits = {k: int(v) for k, v in (x.split("=") for x in args.limit)}
+    run(args.targets, dry_run=args.dry_run, force=args.force, limits=limits)
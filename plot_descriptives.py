@@ -4,14 +4,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.lines import Line2D
 
+import profiling
 import utils
+from descriptives import count_table, load_summary_cube
+
+# Profile this run if asked to (see profiling.py).
+profiling.setup()
 
 # Load matplotlib settings.
 utils.load_matplotlib_settings()
 
-# Load data.
-df = utils.load_sourcedata(dreams_only=False).drop(columns="GPT_ID500")
-assert df[["source_id", "subject_id", "report_type", "dream_text"]].notna().all().all()
+# Load the summary cube (rebuilt only if the source data or lucidity codes changed).
+cube = load_summary_cube()
+assert cube[["source_id", "subject_id", "report_type"]].notna().all().all()
 
 
 ################################################################################
@@ -20,9 +25,7 @@ assert df[["source_id", "subject_id", "report_type", "dream_text"]].notna().all(
 
 # Count number of dreams and comments for each source.
 order = ["dream", "comment"]
-counts = df.groupby("source_id")["report_type"].value_counts(dropna=False).unstack(fill_value=0)
-counts = counts.reindex(counts.sum(axis=1).sort_values(ascending=False).index)
-counts = counts[order]
+counts = count_table(cube, "source_id", "report_type", order)
 
 # Save counts to CSV.
 counts2 = counts.rename_axis(columns=None)
@@ -73,7 +76,8 @@ legend._legend_box.align = "left"
 
 # Save plot.
 export_path = utils.deriv_dir / "data-flying_sample-type.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -92,15 +96,12 @@ plt.close()
 #     .map({"True": "lucid", "False": "non-lucid"})
 # )
 
-# Load lucidity codes.
-ser = utils.load_gpt_lucidity_codes(dataset="flying")
-drms = df.join(ser, how="inner")
+# Keep dreams that have lucidity codes.
+drms = cube[cube["lucidity"].notna()]
 
 # Count lucid and non-lucid dreams for each source.
 order = ["non-lucid", "lucid"]
-counts = drms.groupby("source_id")["lucidity"].value_counts(dropna=False).unstack(fill_value=0)
-counts = counts.reindex(counts.sum(axis=1).sort_values(ascending=False).index)
-counts = counts[order]
+counts = count_table(drms, "source_id", "lucidity", order)
 
 # Save counts to CSV.
 counts2 = counts.rename_axis(columns=None)
@@ -151,7 +152,8 @@ legend._legend_box.align = "left"
 
 # Save plot.
 export_path = utils.deriv_dir / "data-flying_sample-lucidity.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -160,14 +162,12 @@ plt.close()
 ################################################################################
 
 # Reduce to dreams and drop duplicates to get unique authors.
-dreams = df.query("report_type=='dream'")
-dream_subjects = dreams.drop_duplicates("subject_id")
+dreams = cube.query("report_type=='dream'")
+dream_subjects = dreams.drop_duplicates("subject_id").assign(n=1)
 
 # Count number of authors for each source.
 order = ["female", "male", "they", "unspecified"]
-counts = dream_subjects.groupby("source_id")["sex"].value_counts(dropna=False).unstack(fill_value=0)
-counts = counts.reindex(counts.sum(axis=1).sort_values(ascending=False).index)
-counts = counts[order]
+counts = count_table(dream_subjects, "source_id", "sex", order)
 
 # Save counts to CSV.
 counts2 = counts.rename_axis(columns=None)
@@ -218,7 +218,8 @@ legend._legend_box.align = "left"
 
 # Save plot.
 export_path = utils.deriv_dir / "data-flying_sample-sex.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -236,7 +237,7 @@ markers = {
 }
 
 # Count number of dreams and authors for each source.
-counts = dreams.groupby("source_id")["subject_id"].agg(["nunique", "count"])
+counts = dreams.groupby("source_id").agg(nunique=("subject_id", "nunique"), count=("n", "sum"))
 
 # Save counts to CSV.
 counts2 = counts.rename_axis(columns=None)
@@ -286,7 +287,8 @@ legend._legend_box.align = "left"
 
 # Save plot.
 export_path = utils.deriv_dir / "data-flying_sample-authors.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -295,7 +297,7 @@ plt.close()
 ################################################################################
 
 # Count number of dreams per author for LD4all.
-counts = dreams.query("source_id=='LD4all'")["subject_id"].value_counts()
+counts = dreams.query("source_id=='LD4all'").groupby("subject_id")["n"].sum()
 
 # Plot histogram.
 fig, ax = plt.subplots(figsize=(3, 2), constrained_layout=True)
@@ -313,5 +315,6 @@ ax.text(1, 1, "LD4all sample", ha="right", va="top", fontsize=10, transform=ax.t
 
 # Save plot.
 export_path = utils.deriv_dir / "data-flying_sample-ld4all.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
@@ -4,9 +4,16 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
+import loaders
+import profiling
 import utils
+from duplicates import duplicated_across, find_duplicates
+from tokens import load_all
 
 
+# Profile this run if asked to (see profiling.py).
+profiling.setup()
+
 # Load custom matplotlib settings
 utils.load_matplotlib_settings()
 
@@ -21,34 +28,26 @@ liwc_dicts = [
     "vestibular",
 ]
 
-# Load and preprocess the flying dataset
-flying = utils.load_sourcedata(dreams_only=True).drop(columns="GPT_ID500")
-flying_lucid_ser = utils.load_gpt_lucidity_codes(dataset="flying")
-flying = flying.join(flying_lucid_ser, how="inner")
-
-# Load additional datasets
-dreamviews = utils.load_dreamviews()
-sddb = utils.load_sddb()
-
-# Load LIWC results
-def load_liwc_file(dataset, dic, nsegs=n_segments):
-    import_name = f"data-{dataset}_liwc-{dic}_nsegs-{nsegs}.csv"
-    import_path = utils.deriv_dir / import_name
-    return (
-        pd.read_csv(import_path)
-        .rename(columns={"Row ID": "dream_id"})
-        .set_index(["dream_id", "Segment"])
-        # .drop(columns="dream")
-    )
-
-# Load LIWC data for the flying dataset using all specified dictionaries
-flying_liwc = pd.concat([load_liwc_file("flying", d) for d in liwc_dicts], axis=1)
-# Load LIWC data for the DreamViews dataset using all specified dictionaries
-dreamviews_liwc = pd.concat(
-    [load_liwc_file("dreamviews", d) for d in liwc_dicts], axis=1
-)
-# Load LIWC data for the SDDb dataset using all specified dictionaries
-sddb_liwc = pd.concat([load_liwc_file("sddb", d) for d in liwc_dicts], axis=1)
+# Load the datasets, lucidity codes and LIWC results concurrently
+datasets = ["flying", "dreamviews", "sddb"]
+frames = loaders.load_many({
+    "flying": loaders.request("sourcedata", dreams_only=True),
+    "flying_lucidity": loaders.request("lucidity", "flying"),
+    "dreamviews": loaders.request("dreamviews"),
+    "sddb": loaders.request("sddb"),
+    **{(ds, d): loaders.request("liwc", ds, d, n_segments) for ds in datasets for d in liwc_dicts},
+})
+
+# Preprocess the flying dataset
+flying = frames["flying"].drop(columns="GPT_ID500")
+flying = flying.join(frames["flying_lucidity"], how="inner")
+dreamviews = frames["dreamviews"]
+sddb = frames["sddb"]
+
+# Combine the LIWC dictionaries of every dataset
+flying_liwc, dreamviews_liwc, sddb_liwc = [
+    pd.concat([frames[ds, d] for d in liwc_dicts], axis=1) for ds in datasets
+]
 
 # List of vestibular-related categories
 vestibular_cats = [
@@ -70,6 +69,13 @@ vestibular_cats = [
     "whirl",
 ]
 
+# Drop SDDb dreams that also appear (near-duplicated) in the Flying database
+all_dreams = flying.index.append([dreamviews.index, sddb.index])
+clusters = find_duplicates(load_all().take(all_dreams))
+sddb_liwc = sddb_liwc.drop(
+    index=duplicated_across(clusters, "sddb", "flying"), level="dream_id", errors="ignore"
+)
+
 # Calculate the sum of vestibular-related categories for each dataset
 flying_liwc["vestib"] = flying_liwc[vestibular_cats].sum(axis=1)
 dreamviews_liwc["vestib"] = dreamviews_liwc[vestibular_cats].sum(axis=1)
@@ -105,13 +111,6 @@ sddb_melt["dataset"] = "SDDb"
 flying_and_dv = pd.concat([fly_melt, dv_melt], axis=0)
 flying_and_sddb = pd.concat([fly_melt.drop(columns="lucidity"), sddb_melt], axis=0)
 
-# flying_sddb_dreams = df.query("source_id=='SDDb'")["dream"].tolist()
-# sddb["flying"] = sddb["answer_text"].apply(
-#     lambda x: x in flying_sddb_dreams
-# )
-# sddb = sddb[sddb["flying"] == False]
-# sddb = sddb.drop(columns=["Row ID", "answer_text", "flying"])
-
 ################################################################################
 # Plots
 ################################################################################
@@ -147,7 +146,8 @@ ax.set_ylabel(f"{category}-related word frequency".capitalize())
 export_path = utils.deriv_dir / f"liwc-{category}_dreamviews.png"
 
 # Save the plot
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 # Repeat the same process for other categories (copy/pasted garbage)
@@ -168,7 +168,8 @@ sns.barplot(
 ax.set_xlabel("Dataset")
 ax.set_ylabel(f"{category}-related word frequency".capitalize())
 export_path = utils.deriv_dir / f"liwc-{category}_dreamviews.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 category = "emo_pos"
@@ -187,7 +188,8 @@ sns.barplot(
 ax.set_xlabel("Dataset")
 ax.set_ylabel("Positive emotion word frequency".capitalize())
 export_path = utils.deriv_dir / f"liwc-{category}_dreamviews.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 category = "emo_pos"
@@ -206,7 +208,8 @@ sns.barplot(
 ax.set_xlabel("Dataset")
 ax.set_ylabel(f"{category}-related word frequency".capitalize())
 export_path = utils.deriv_dir / f"liwc-{category}_dreamviews.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 # def plot(category):
@@ -1,15 +1,16 @@
 """Plot spans of lucidity and flying."""
 
-import json
-
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import pingouin as pg
-from scipy import stats
 
+import resample
+import profiling
 import utils
+from spans import Timecourses
+
 
+# Profile this run if asked to (see profiling.py).
+profiling.setup()
 
 # Load custom matplotlib settings.
 utils.load_matplotlib_settings(interactive=True)
@@ -18,70 +19,17 @@ utils.load_matplotlib_settings(interactive=True)
 dataset = "flying"
 task = "annotate"
 
-# Define the import/export paths.
-import_name = f"data-{dataset}_task-{task}_responses.json"
-export_name = f"data-{dataset}_lucidVsFlying.png"
-import_path = utils.deriv_dir / import_name
-export_path = utils.deriv_dir / export_name
-
-# Load the responses/completions from ChatGPT.
-completions = utils.load_json(import_path)
-
-# Set expected labels and normalization parameters.
-expected_labels = ["flying", "lucidity", "supplement"]
-norm_length = 100
-norm_index = np.linspace(0, 1, num=norm_length)
-
-# Initialize the results dictionary.
-badcounts = 0
-results = {}
-
-# Iterate over the completions and extract the annotations.
-for dream_id, completion in completions.items():
-    try:
-        choices = completion["choices"]
-        assert len(choices) == 1, "Expected only 1 response from ChatGPT."
-        choice = choices[0]
-        assert choice["finish_reason"] == "stop"
-        content = choice["message"]["content"]
-        assert content.startswith("{") and content.endswith("}")
-        ann = json.loads(content)
-        assert len(ann.keys()) == 2
-        assert all(k in ["text", "entities"] for k in ann)
-        dream_report = ann["text"]
-        entities = ann["entities"]
-        assert isinstance(entities, list)
-        if len(entities) > 0:
-            unique_labels = set(e["label"] for e in entities)
-            assert all(label in expected_labels for label in unique_labels)
-            n_total_characters = len(dream_report)
-            masks = {
-                label: np.zeros(n_total_characters, dtype=int) for label in expected_labels
-            }
-            for e in entities:
-                entity_text = e["value"]
-                entity_label = e["label"]
-                try:
-                    start = dream_report.index(entity_text)
-                except ValueError:
-                    print("wrong value")
-                    continue
-                end = start + len(entity_text)
-                window = np.arange(start, end)
-                masks[entity_label][window] = 1
-            old_index = np.linspace(0, 1, num=n_total_characters)
-            masks = {k: np.interp(norm_index, old_index, v) for k, v in masks.items()}
-            # masks = {k: interp1d(old_index, v, kind="nearest")(norm_index) for k, v in masks.items()}
-            results[dream_id] = masks
-    except:
-        badcounts += 1
-
-print(f"THIS MANY LOADING ERRORS: {badcounts}")
-
-# Convert to a dataframe with themes as columns and cells as 1 or 0.
-flying = np.stack([v["flying"] for v in results.values()])
-supplement = np.stack([v["supplement"] for v in results.values()])
-lucidity = np.stack([v["lucidity"] for v in results.values()])
+# Load the annotate timecourses, parsing the ChatGPT responses only if they changed.
+timecourses = Timecourses.load(dataset)
+norm_length = timecourses.cube.shape[2]
+
+# Number of bootstrap replicates for the 95% confidence bands.
+n_boot = 5000
+
+# Get (dreams x bins) matrices for each label.
+flying = timecourses.select("flying")
+supplement = timecourses.select("supplement")
+lucidity = timecourses.select("lucidity")
 
 
 ################################################################################
@@ -99,10 +47,10 @@ x = np.arange(norm_length)
 fig, ax = plt.subplots(figsize=(3, 2), constrained_layout=True)
 for label, data in zip(["supplement", "flying"], [supplement, flying]):
     mean = data.mean(axis=0)
-    sem = stats.sem(data, axis=0)
+    lower, upper = resample.bootstrap_ci(data, n_boot=n_boot, seed=0)
     color = palette[label]
     z = zorder[label]
-    ax.fill_between(x, mean - sem, mean + sem, color=color, zorder=z, **fbetween_kwargs)
+    ax.fill_between(x, lower, upper, color=color, zorder=z, **fbetween_kwargs)
     ax.plot(x, mean, color=color, label=label, zorder=z, **plot_kwargs)
 
 # Set the plot labels and limits.
@@ -137,7 +85,8 @@ legend._legend_box.align = "left"
 
 # Save the plot.
 export_path = utils.deriv_dir / f"data-{dataset}_task-{task}_supp.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -153,13 +102,13 @@ palette = utils.colors.copy()
 zorder = dict(flying=3, lucidity=2, supplement=1)
 x = np.arange(norm_length)
 
-idx = lucidity.max(axis=1) > 0
+idx = timecourses.has("lucidity")
 for label, data in zip(["lucidity", "flying"], [lucidity[idx], flying[idx]]):
     mean = data.mean(axis=0)
-    sem = stats.sem(data, axis=0)
+    lower, upper = resample.bootstrap_ci(data, n_boot=n_boot, seed=0)
     color = palette[label]
     z = zorder[label]
-    ax.fill_between(x, mean - sem, mean + sem, color=color, zorder=z, **fbetween_kwargs)
+    ax.fill_between(x, lower, upper, color=color, zorder=z, **fbetween_kwargs)
     ax.plot(x, mean, color=color, label=label, zorder=z, **plot_kwargs)
 
 ax.set_ylabel("Percentage of dreams")
@@ -193,7 +142,8 @@ legend._legend_box.align = "left"
 # legend._legend_box.sep = 5 # brings title up farther on top of handles/labels
 
 export_path = utils.deriv_dir / f"data-{dataset}_task-{task}_lucidity.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -201,9 +151,11 @@ plt.close()
 # heatmap of lucid vs flying?
 ################################################################################
 
-flying_onsets = np.argmax(flying[idx], axis=1)
-lucidity_onsets = np.argmax(lucidity[idx], axis=1)
-onsets = pd.DataFrame({"flying": flying_onsets, "lucidity": lucidity_onsets})
+# Get exact onsets (as percentage of the dream) in dreams with both lucidity and flying.
+events = timecourses.events(["flying", "lucidity"])
+both = events["flying_present"] & events["lucidity_present"]
+onsets = 100 * events.loc[both, ["flying_onset", "lucidity_onset"]]
+onsets.columns = ["flying", "lucidity"]
 
 bar_kwargs = dict(lw=1, edgecolor="black", height=0.7)
 errorbar_kwargs = dict(fmt="-o", color="black", lw=1, markersize=3)
@@ -227,10 +179,10 @@ ax.xaxis.set(
 ax.set_ylim(-0.7, 1.7)
 # ax.yaxis.set(major_locator=plt.MultipleLocator(0.1), minor_locator=plt.MultipleLocator(0.02))
 
-stats = pg.wilcoxon(
-    onsets["lucidity"], onsets["flying"], correction=True, method="approx"
+perm = resample.permutation_test(
+    onsets["lucidity"], onsets["flying"], paired=True, n_perm=10000, seed=0
 )
-p = stats.at["Wilcoxon", "p-val"]
+p = perm["p"][0]
 stars = "*" * sum(p < cutoff for cutoff in [0.05, 0.01, 0.001])
 stars_x = np.max(means + sems)
 stars_x += 0.2
@@ -253,7 +205,8 @@ for l in lines:
 # ax.add_lines(l)
 
 export_path = utils.deriv_dir / f"data-{dataset}_task-{task}_bars.png"
-plt.savefig(export_path)
+with profiling.stage("render", export_path.name):
+    plt.savefig(export_path)
 plt.close()
 
 
@@ -261,7 +214,7 @@ plt.close()
 # heatmap of lucid vs flying?
 ################################################################################
 
-first_event = onsets.idxmin(axis=1)
+first_event = events.loc[both, "first_event"]
 lucid_first_onsets = onsets[first_event.eq("lucidity")].reset_index(drop=True)
 flying_first_onsets = onsets[first_event.eq("flying")].reset_index(drop=True)
 
@@ -308,5 +261,6 @@ for event in ["flying", "lucidity"]:
     )
     ax.set_ylim(-0.7, 1.7)
     export_path = utils.deriv_dir / f"data-{dataset}_task-{task}_bars_{event}.png"
-    plt.savefig(export_path)
+    with profiling.stage("render", export_path.name):
+        plt.savefig(export_path)
     plt.close()
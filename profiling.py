@@ -0,0 +1,153 @@
+"""Profile any script and time its stages.
+
+Every script accepts `--profile`, and profiles itself whenever the
+FLYING_PROFILE environment variable is set, so exporting it shows the hot paths
+of every run (including the scripts that pipeline.py and figures.py start). At
+exit, a profiled run prints its stage timings and writes to ../derivatives/profiles/:
+
+- {script}_{time}.prof: the cProfile statistics (for pstats or snakeviz);
+- {script}_{time}.txt: the stage timings, the peak traced memory with the lines
+  that allocated most, and the 30 functions with the highest cumulative time.
+
+Stage timings come from `stage` spans around the load, clean, parse, compute,
+render and save steps of utils and the scripts. Spans are always recorded (at
+about a microsecond each) and only reported when profiling. cProfile only sees
+the main thread, while spans are timed in every thread. Tracing memory slows
+allocation-heavy code down, so compare profiled runs with profiled runs.
+
+```shell
+python plot_liwc.py --profile
+FLYING_PROFILE=1 python pipeline.py
+```
+"""
+
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+ENV_VAR = "FLYING_PROFILE"
+
+# Calls, total and self seconds of every (kind, name) stage.
+_stages = {}
+_lock = threading.Lock()
+_local = threading.local()
+_profiler = None
+
+
+@contextmanager
+def stage(kind: str, name: str = ""):
+    """
+    Time a stage of a script.
+    The time of nested stages is subtracted from the self time of the stage
+    around them, so self times add up to the time spent in all stages.
+    Args:
+        kind (str): The kind of stage (load, clean, parse, compute, render or save).
+        name (str): What the stage works on, e.g., a dataset or file name.
+    """
+
+    if not hasattr(_local, "nested"):
+        _local.nested = []
+    _local.nested.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _local.nested.pop()
+        if _local.nested:
+            _local.nested[-1] += elapsed
+        with _lock:
+            calls, total, self_time = _stages.get((kind, name), (0, 0.0, 0.0))
+            _stages[kind, name] = (calls + 1, total + elapsed, self_time + elapsed - nested)
+
+
+def stage_table() -> str:
+    """The timings of all stages so far, by descending self time."""
+    rows = sorted(_stages.items(), key=lambda item: -item[1][2])
+    width = max([len(f"{k} {n}") for (k, n), _ in rows] + [5])
+    lines = [f"{'stage':<{width}} {'calls':>7} {'total s':>9} {'self s':>9}"]
+    for (kind, name), (calls, total, self_time) in rows:
+        lines.append(f"{f'{kind} {name}'.strip():<{width}} {calls:>7} {total:>9.3f} {self_time:>9.3f}")
+    return "\n".join(lines)
+
+
+def enable(script: str = None, directory: Path = None) -> None:
+    """
+    Start cProfile and tracemalloc, and write the report at exit.
+    Args:
+        script (str): Name of the report files (default: the running script).
+        directory (Path): Directory of the report files (default: ../derivatives/profiles).
+    """
+
+    global _profiler
+    if _profiler is not None:
+        return
+    # Scripts started from this one profile themselves too.
+    os.environ.setdefault(ENV_VAR, "1")
+    tracemalloc.start()
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    atexit.register(_report, script or Path(sys.argv[0]).stem, directory)
+
+
+def _report(script: str, directory: Path) -> None:
+    """Stop profiling and write the report files."""
+    _profiler.disable()
+    _, peak = tracemalloc.get_traced_memory()
+    top_lines = tracemalloc.take_snapshot().statistics("lineno")[:10]
+    tracemalloc.stop()
+    if directory is None:
+        import utils
+
+        directory = utils.deriv_dir / "profiles"
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = directory / f"{script}_{time.strftime('%Y%m%d-%H%M%S')}"
+    _profiler.dump_stats(f"{stem}.prof")
+
+    summary = f"{stage_table()}\n\nPeak traced memory: {peak / 2**20:.1f} MiB\n"
+    report = io.StringIO()
+    report.write(summary)
+    report.writelines(f"  {line}\n" for line in top_lines)
+    report.write("\n")
+    pstats.Stats(_profiler, stream=report).sort_stats("cumulative").print_stats(30)
+    Path(f"{stem}.txt").write_text(report.getvalue(), encoding="utf-8")
+    print(f"\n{summary}Profile written to {stem}.prof and .txt", file=sys.stderr)
+
+
+def add_argument(parser) -> None:
+    """Add the `--profile` flag to a script's argument parser (pass its value to `setup`)."""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Write a cProfile, memory and stage timing report at exit (or set {ENV_VAR}=1).",
+    )
+
+
+def setup(enabled: bool = None) -> bool:
+    """
+    Profile this run if `--profile` was given or the environment variable is set.
+    Args:
+        enabled (bool): The `--profile` flag of a script with an argument
+            parser (see `add_argument`). Scripts without one leave it to None,
+            and a `--profile` argument is then taken from the command line.
+    Returns:
+        bool: Whether this run is profiled.
+    """
+
+    if enabled is None:
+        enabled = "--profile" in sys.argv
+        if enabled:
+            sys.argv.remove("--profile")
+    if enabled or os.getenv(ENV_VAR, "").lower() not in ["", "0", "false", "no"]:
+        enable()
+        return True
+    return False
@@ -0,0 +1,215 @@
+"""Batched bootstrap and permutation statistics for (dreams x bins) matrices."""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import profiling
+
+
+# Default memory budget for the replicate weight matrices of a single chunk.
+MAX_BYTES = 256 * 1024**2
+
+
+def _as_matrix(data) -> np.ndarray:
+    """Return data as a float64 (observations x variables) matrix."""
+    data = np.asarray(data, dtype=np.float64)
+    return data[:, None] if data.ndim == 1 else data
+
+
+def _chunk_sizes(n_reps: int, n_obs: int, n_vars: int, max_bytes: int) -> list:
+    """Split replicates into chunks whose weight and result matrices fit the budget."""
+    size = max(1, int(max_bytes // (8 * (n_obs + 2 * n_vars))))
+    return [min(size, n_reps - i) for i in range(0, n_reps, size)]
+
+
+def _run_chunks(func, args: tuple, n_reps: int, n_obs: int, n_vars: int, seed, max_bytes: int, n_jobs: int) -> list:
+    """Run `func(*args, size, seed)` over chunks of replicates, optionally in worker processes."""
+    sizes = _chunk_sizes(n_reps, n_obs, n_vars, max_bytes)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_jobs == 1 or len(sizes) == 1:
+        return [func(*args, size, s) for size, s in zip(sizes, seeds)]
+    with ProcessPoolExecutor(max_workers=None if n_jobs < 0 else n_jobs) as pool:
+        futures = [pool.submit(func, *args, size, s) for size, s in zip(sizes, seeds)]
+        return [f.result() for f in futures]
+
+
+def _bootstrap_chunk(data: np.ndarray, size: int, seed) -> np.ndarray:
+    """Means of `size` bootstrap resamples of the rows of `data`."""
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    # Each row of weights counts how often every observation was drawn.
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=size)
+    return weights @ data / n
+
+
+def _t_stats(mean: np.ndarray, sumsq: np.ndarray, n: int) -> np.ndarray:
+    """One-sample t statistics from means and sums of squares over n observations."""
+    var = (sumsq - n * mean**2) / (n - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = mean / np.sqrt(var / n)
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _welch_t_stats(sum1, sumsq1, n1, sum0, sumsq0, n0) -> np.ndarray:
+    """Welch t statistics from per-group sums and sums of squares."""
+    m1, m0 = sum1 / n1, sum0 / n0
+    v1 = (sumsq1 - n1 * m1**2) / (n1 - 1)
+    v0 = (sumsq0 - n0 * m0**2) / (n0 - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (m1 - m0) / np.sqrt(v1 / n1 + v0 / n0)
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _cluster_masses(t: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Sum of t within every run of adjacent supra-threshold bins, for each row of `t`.
+    Returns an array of shape (rows, bins) where each cluster's mass is stored at
+    the position of its first bin and every other element is zero.
+    """
+    rows, n_bins = t.shape
+    masses = np.zeros((rows, n_bins))
+    for sign in (1, -1):
+        above = sign * t > threshold
+        starts = above & ~np.pad(above, ((0, 0), (1, 0)))[:, :-1]
+        cluster_ids = np.cumsum(starts, axis=1) * above
+        first_bins = np.flatnonzero(starts.ravel())
+        sums = np.zeros(rows * (n_bins + 1))
+        flat_ids = (np.arange(rows)[:, None] * (n_bins + 1) + cluster_ids)[above]
+        np.add.at(sums, flat_ids, t[above])
+        starts_ids = (np.arange(rows)[:, None] * (n_bins + 1) + cluster_ids).ravel()[first_bins]
+        masses.ravel()[first_bins] = sums[starts_ids]
+    return masses
+
+
+def _signflip_chunk(diffs: np.ndarray, threshold: float, size: int, seed) -> np.ndarray:
+    """Max |t| and max |cluster mass| of `size` sign-flip permutations."""
+    rng = np.random.default_rng(seed)
+    n = diffs.shape[0]
+    signs = rng.choice(np.array([-1.0, 1.0]), size=(size, n))
+    # Squared differences do not change with the signs.
+    t = _t_stats(signs @ diffs / n, np.broadcast_to((diffs**2).sum(axis=0), (size, diffs.shape[1])), n)
+    masses = _cluster_masses(t, threshold)
+    return np.column_stack([np.abs(t).max(axis=1), np.abs(masses).max(axis=1)])
+
+
+def _relabel_chunk(data: np.ndarray, n1: int, threshold: float, size: int, seed) -> np.ndarray:
+    """Max |t| and max |cluster mass| of `size` group-label permutations."""
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    # Random group memberships with the observed group sizes.
+    order = rng.random((size, n)).argsort(axis=1)
+    members = (order < n1).astype(np.float64)
+    total, total_sq = data.sum(axis=0), (data**2).sum(axis=0)
+    sum1, sumsq1 = members @ data, members @ data**2
+    t = _welch_t_stats(sum1, sumsq1, n1, total - sum1, total_sq - sumsq1, n - n1)
+    masses = _cluster_masses(t, threshold)
+    return np.column_stack([np.abs(t).max(axis=1), np.abs(masses).max(axis=1)])
+
+
+@profiling.stage("compute", "bootstrap")
+def bootstrap_ci(
+    data,
+    n_boot: int = 5000,
+    ci: float = 0.95,
+    seed: int = None,
+    max_bytes: int = MAX_BYTES,
+    n_jobs: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Percentile bootstrap confidence interval of the mean, for every column.
+    All replicates are drawn as batches of resampling weights and reduced with
+    a matrix product, chunked to stay within `max_bytes`.
+    Args:
+        data (array-like): A (dreams x bins) matrix or a 1D array.
+        n_boot (int): Number of bootstrap replicates.
+        ci (float): Confidence level of the interval.
+        seed (int): Seed for the random number generator.
+        max_bytes (int): Approximate memory budget of a single chunk of replicates.
+        n_jobs (int): Number of worker processes (-1 for all CPUs).
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The lower and upper bound for every column.
+    """
+
+    data = _as_matrix(data)
+    chunks = _run_chunks(_bootstrap_chunk, (data,), n_boot, *data.shape, seed, max_bytes, n_jobs)
+    means = np.concatenate(chunks)
+    alpha = (1 - ci) / 2
+    lower, upper = np.quantile(means, [alpha, 1 - alpha], axis=0)
+    return lower, upper
+
+
+@profiling.stage("compute", "permutation test")
+def permutation_test(
+    a,
+    b,
+    paired: bool = True,
+    n_perm: int = 5000,
+    threshold: float = None,
+    seed: int = None,
+    max_bytes: int = MAX_BYTES,
+    n_jobs: int = 1,
+) -> dict:
+    """
+    Permutation t-test of every column, with max-statistic and cluster-based correction.
+    Paired designs (e.g., lucidity vs flying onsets in the same dreams) permute
+    the signs of the differences. Between-group designs (e.g., lucid-first vs
+    flying-first dreams) permute group membership and use Welch's t.
+    Args:
+        a (array-like): A (dreams x bins) matrix or a 1D array.
+        b (array-like): Same shape as `a` if paired, else any number of rows.
+        paired (bool): Whether `a` and `b` are paired observations.
+        n_perm (int): Number of permutations.
+        threshold (float): |t| threshold for forming clusters of adjacent bins.
+            Defaults to the two-sided 0.05 critical t value.
+        seed (int): Seed for the random number generator.
+        max_bytes (int): Approximate memory budget of a single chunk of permutations.
+        n_jobs (int): Number of worker processes (-1 for all CPUs).
+    Returns:
+        dict: The observed "t" per column, "p" per column (corrected with the
+            maximum |t| across columns), and "clusters", a DataFrame with the
+            start, end, mass and p-value of every observed cluster.
+    """
+
+    a, b = _as_matrix(a), _as_matrix(b)
+    if paired:
+        assert a.shape == b.shape, "Paired data must have the same shape."
+        diffs = a - b
+        n = diffs.shape[0]
+        df = n - 1
+        t = _t_stats(diffs.mean(axis=0), (diffs**2).sum(axis=0), n)
+    else:
+        data = np.concatenate([a, b])
+        n1, n0 = a.shape[0], b.shape[0]
+        df = n1 + n0 - 2
+        t = _welch_t_stats(
+            a.sum(axis=0), (a**2).sum(axis=0), n1, b.sum(axis=0), (b**2).sum(axis=0), n0
+        )
+    if threshold is None:
+        threshold = stats.t.ppf(0.975, df)
+    if paired:
+        args, shape = (diffs, threshold), diffs.shape
+        chunks = _run_chunks(_signflip_chunk, args, n_perm, *shape, seed, max_bytes, n_jobs)
+    else:
+        args, shape = (data, n1, threshold), data.shape
+        chunks = _run_chunks(_relabel_chunk, args, n_perm, *shape, seed, max_bytes, n_jobs)
+    null = np.concatenate(chunks)
+    # Add the observed data as one of the permutations so p is never 0.
+    p = (1 + (null[:, 0][None, :] >= np.abs(t)[:, None]).sum(axis=1)) / (1 + n_perm)
+    masses = _cluster_masses(t[None, :], threshold)[0]
+    starts = np.flatnonzero(masses)
+    ends = []
+    for start in starts:
+        end = start + 1
+        while end < t.size and np.sign(t[start]) * t[end] > threshold:
+            end += 1
+        ends.append(end)
+    clusters = pd.DataFrame({
+        "start": starts,
+        "end": ends,
+        "mass": masses[starts],
+        "p": [(1 + (null[:, 1] >= abs(m)).sum()) / (1 + n_perm) for m in masses[starts]],
+    })
+    return {"t": t, "p": p, "clusters": clusters}
@@ -0,0 +1,209 @@
+"""Retry OpenAI requests with exponential backoff, jitter and the server's retry hints.
+
+Every error is sorted into one of four kinds:
+
+- throttled (rate limits): retried, and every request on the same route is
+  slowed down until the throttling stops;
+- transient (timeouts, connection resets, 5xx): retried with backoff;
+- invalid (the request itself is rejected, e.g., a too long prompt): not retried;
+- fatal (authentication, permissions, exhausted quota): the run stops.
+
+Dreams that are invalid or still fail after `max_attempts` are written to a
+dead-letter file instead of blocking the run. They are requested again by the
+next run, and leave the file once they succeed.
+
+```shell
+python gpt_request.py --dataset flying --task annotate --max-attempts 8    #> data-flying_task-annotate_deadletter.json
+```
+"""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import openai
+
+
+THROTTLED, TRANSIENT, INVALID, FATAL = "throttled", "transient", "invalid", "fatal"
+
+
+def classify(error: Exception) -> str:
+    """The kind of an error raised by a request (throttled, transient, invalid or fatal)."""
+    if isinstance(error, openai.error.RateLimitError):
+        details = error.json_body.get("error") if isinstance(error.json_body, dict) else None
+        details = details if isinstance(details, dict) else {}
+        # An exhausted quota is reported as a rate limit but never clears by waiting.
+        if "insufficient_quota" in [details.get("type"), details.get("code")]:
+            return FATAL
+        return THROTTLED
+    if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+        return FATAL
+    if isinstance(
+        error,
+        (
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.ServiceUnavailableError,
+            openai.error.TryAgain,
+        ),
+    ):
+        return TRANSIENT
+    if isinstance(error, openai.error.InvalidRequestError):
+        return INVALID
+    if isinstance(error, openai.error.OpenAIError):
+        status = error.http_status
+        return TRANSIENT if status is None or status >= 500 or status == 408 else INVALID
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return FATAL
+
+
+def retry_after(error: Exception) -> float:
+    """Seconds to wait before retrying, from the Retry-After headers of an error (None if absent)."""
+    headers = {str(k).lower(): v for k, v in dict(getattr(error, "headers", None) or {}).items()}
+    try:
+        return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+    except (KeyError, TypeError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date.
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 60.0, factor: float = 1.0) -> float:
+    """
+    Delay before the next attempt, with "full jitter".
+    The delay is drawn uniformly up to an exponentially growing ceiling, so
+    requests that failed together do not all retry at the same moment.
+    Args:
+        attempt (int): Number of failed attempts so far, minus one.
+        base (float): Ceiling of the first delay, in seconds.
+        cap (float): Largest ceiling, in seconds.
+        factor (float): Slowdown factor of the route (see `Throttle`).
+    Returns:
+        float: The delay, in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt) * factor)
+
+
+class Throttle:
+    """
+    Shared slowdown of the requests on one route.
+    Every throttled request doubles the route's slowdown factor and pauses the
+    whole route for its backoff, and every success shrinks the factor back
+    toward 1. While the factor is above 1, request starts are also spaced out,
+    so the route settles just under its rate limit instead of bursting into it.
+    """
+
+    def __init__(self, interval: float = 0.05, max_factor: float = 32.0, recovery: float = 0.9):
+        """
+        Args:
+            interval (float): Spacing of request starts per unit of slowdown, in seconds.
+            max_factor (float): Largest slowdown factor.
+            recovery (float): Factor the slowdown is multiplied by after every success.
+        """
+        self.interval = interval
+        self.max_factor = max_factor
+        self.recovery = recovery
+        self.factor = 1.0
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until this route may start another request."""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval * (self.factor - 1)
+        if start > now:
+            time.sleep(start - now)
+
+    def throttled(self, delay: float) -> None:
+        """Slow the route down after a rate limit error, pausing it for `delay` seconds."""
+        with self.lock:
+            self.factor = min(self.factor * 2, self.max_factor)
+            self.next_start = max(self.next_start, time.monotonic() + delay)
+
+    def succeeded(self) -> None:
+        """Speed the route back up after a successful request."""
+        with self.lock:
+            self.factor = max(self.factor * self.recovery, 1.0)
+
+
+class GiveUp(Exception):
+    """A request that was invalid or failed `max_attempts` times, with its last error."""
+
+    def __init__(self, error: Exception, kind: str, attempts: int):
+        super().__init__(f"{kind} error after {attempts} attempts: {error!r}")
+        self.error = error
+        self.kind = kind
+        self.attempts = attempts
+
+    def record(self) -> dict:
+        """Entry of the failure in a dead-letter file."""
+        return {
+            "kind": self.kind,
+            "error": type(self.error).__name__,
+            "message": str(self.error)[:500],
+            "attempts": self.attempts,
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+
+
+def call(
+    request,
+    throttle: Throttle,
+    max_attempts: int = 6,
+    base: float = 1.0,
+    cap: float = 60.0,
+    log=print,
+):
+    """
+    Make a request, retrying throttled and transient errors.
+    Args:
+        request (callable): Makes the request and returns its result.
+        throttle (Throttle): Slowdown shared by the requests of the same route.
+        max_attempts (int): Attempts before giving up.
+        base (float): Ceiling of the first backoff delay, in seconds.
+        cap (float): Largest backoff ceiling, in seconds.
+        log (callable): Called with a message before every retry.
+    Returns:
+        The result of `request`.
+    Raises:
+        GiveUp: If the request was invalid or failed `max_attempts` times.
+        Exception: Any fatal error, as raised by `request`.
+    """
+
+    for attempt in range(max_attempts):
+        throttle.wait()
+        try:
+            result = request()
+        except Exception as error:
+            kind = classify(error)
+            if kind == FATAL:
+                raise
+            if kind == INVALID or attempt + 1 == max_attempts:
+                raise GiveUp(error, kind, attempt + 1) from error
+            delay = backoff(attempt, base, cap, throttle.factor)
+            hint = retry_after(error)
+            if hint is not None:
+                # Honor the server's hint, with jitter so the retries do not collide.
+                delay = max(delay, hint * random.uniform(1.0, 1.2))
+            if kind == THROTTLED:
+                throttle.throttled(delay)
+            log(f"{type(error).__name__} ({kind}), retrying in {delay:.1f}s [{attempt + 1}/{max_attempts}]")
+            time.sleep(delay)
+        else:
+            throttle.succeeded()
+            return result
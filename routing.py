@@ -0,0 +1,93 @@
+"""Choose the model that codes each dream from the routing table in config.yaml.
+
+Routes are tried in order and a dream goes to the first route whose
+conditions it meets. A route without conditions catches every remaining
+dream; without any routing table, every dream goes to `DEFAULT_ROUTE`.
+
+```yaml
+routing:
+  - model: gpt-3.5-turbo
+    tasks: [isdream, islucid]   # Only for these tasks
+    max_length: 1500            # Only for dreams up to this many characters (after cleaning)
+    min_confidence: 0.8         # Only for dreams with at least this confidence (if scores are given)
+    concurrency: 8              # Requests in flight at once on this route
+  - model: gpt-4
+    concurrency: 2
+```
+"""
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+DEFAULT_ROUTE = {"model": "gpt-4", "concurrency": 1}
+
+
+def load_routes(config: dict = None) -> list:
+    """
+    Load the routing table.
+    Args:
+        config (dict): The configuration (default: config.yaml, if it exists).
+    Returns:
+        list: The routes, in order, ending with a route that accepts every dream.
+    """
+
+    if config is None:
+        try:
+            config = utils.load_config()
+        except FileNotFoundError:
+            config = {}
+    routes = [DEFAULT_ROUTE | route for route in (config or {}).get("routing") or []]
+    conditions = ["tasks", "max_length", "min_confidence"]
+    if not routes or any(key in routes[-1] for key in conditions):
+        routes.append(DEFAULT_ROUTE)
+    return routes
+
+
+def assign_routes(
+    routes: list, task: str, lengths: np.ndarray, confidence: np.ndarray = None
+) -> np.ndarray:
+    """
+    Route index of every dream.
+    Args:
+        routes (list): Routes from `load_routes`.
+        task (str): The task being requested.
+        lengths (np.ndarray): Length of every dream's cleaned text, in characters.
+        confidence (np.ndarray): Optional confidence score of every dream (NaN
+            if unknown, which fails any `min_confidence` condition).
+    Returns:
+        np.ndarray: The index in `routes` of the route of every dream.
+    """
+
+    lengths = np.asarray(lengths)
+    assigned = np.full(lengths.size, -1)
+    for i, route in enumerate(routes):
+        accepts = assigned < 0
+        if "tasks" in route and task not in route["tasks"]:
+            continue
+        if "max_length" in route:
+            accepts &= lengths <= route["max_length"]
+        if "min_confidence" in route:
+            if confidence is None:
+                continue
+            accepts &= np.nan_to_num(np.asarray(confidence, dtype=float), nan=-np.inf) >= route["min_confidence"]
+        assigned[accepts] = i
+    return assigned
+
+
+def load_confidence(filepath: str, dream_ids: pd.Index) -> np.ndarray:
+    """
+    Confidence of every dream from a table of agreement scores.
+    The lowest `*_agreement` column of each dream is used, so a
+    self-consistency table from consistency.py can be passed as is.
+    Args:
+        filepath (str): CSV file indexed by dream_id.
+        dream_ids (pd.Index): The dreams to get scores for.
+    Returns:
+        np.ndarray: The confidence of every dream (NaN if missing).
+    """
+
+    scores = pd.read_csv(filepath, index_col="dream_id").filter(like="_agreement")
+    return scores.min(axis=1).reindex(dream_ids).to_numpy(float)
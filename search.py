@@ -0,0 +1,275 @@
+"""Keyword, wildcard and phrase search over all dream corpora with an inverted index.
+
+```shell
+python search.py build                          #> data-all_search-index.npz
+python search.py update                         # Index new or edited dreams only
+python search.py query 'jetpack OR levitat*'    # Boolean (AND, OR, NOT, parentheses)
+python search.py query '"flew over" NOT lucid'  # Phrases in double quotes
+python -m doctest search.py                     # Run the examples of the query parser
+```
+"""
+
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from tokens import TokenStore, load_all, tokenize
+
+
+QUERY_PATTERN = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+index_path = utils.deriv_dir / "data-all_search-index.npz"
+
+
+class InvertedIndex:
+    """
+    Token -> (dream, position) postings for a collection of dream texts.
+    Postings are stored as flat arrays sorted by token, dream and position, and
+    `offsets[i]:offsets[i + 1]` delimits the postings of `vocab[i]`.
+    Args:
+        vocab (np.ndarray): Sorted array of unique tokens.
+        offsets (np.ndarray): Start of each token's postings (length len(vocab) + 1).
+        docs (np.ndarray): Dream (row number in `dream_ids`) of each posting.
+        positions (np.ndarray): Token position within the dream of each posting.
+        dream_ids (np.ndarray): Dream ID of each indexed dream.
+        hashes (np.ndarray): Hash of the indexed text of each dream.
+    """
+
+    def __init__(self, vocab, offsets, docs, positions, dream_ids, hashes):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.docs = docs
+        self.positions = positions
+        self.dream_ids = dream_ids
+        self.hashes = hashes
+
+    @classmethod
+    @profiling.stage("compute", "search index")
+    def build(cls, tokens: TokenStore):
+        """Index tokenized dreams (see `tokens.TokenStore`)."""
+        return cls._from_postings(
+            np.asarray(tokens.ids),
+            np.asarray(tokens.vocab),
+            tokens.docs(),
+            tokens.positions(),
+            np.asarray(tokens.dream_ids),
+            np.asarray(tokens.hashes),
+        )
+
+    @classmethod
+    def _from_postings(cls, codes, vocab, docs, positions, dream_ids, hashes):
+        """Sort raw (token code, doc, position) postings into an index."""
+        order = np.lexsort((positions, docs, codes))
+        offsets = np.searchsorted(codes[order], np.arange(len(vocab) + 1))
+        return cls(vocab, offsets, docs[order], positions[order], dream_ids, hashes)
+
+    def _codes(self, vocab: np.ndarray) -> np.ndarray:
+        """Position in `vocab` (a sorted superset of this index's vocabulary) of every posting's token."""
+        return np.repeat(np.searchsorted(vocab, self.vocab), np.diff(self.offsets))
+
+    @profiling.stage("compute", "search index")
+    def update(self, tokens: TokenStore):
+        """
+        Bring the index in line with `tokens`, re-indexing only what changed.
+        Dreams that are new or whose text hash changed are (re)indexed, and
+        dreams missing from `tokens` are removed.
+        Args:
+            tokens (TokenStore): The current tokens of all dreams.
+        Returns:
+            tuple[InvertedIndex, int, int]: The updated index, the number of
+                dreams (re)indexed and the number removed.
+        """
+        hashes = pd.Series(np.asarray(tokens.hashes), index=np.asarray(tokens.dream_ids))
+        old = pd.Series(self.hashes, index=self.dream_ids)
+        keep = old.index.isin(hashes.index) & (old.to_numpy() == hashes.reindex(old.index).to_numpy())
+        changed = hashes.index[~hashes.index.isin(old.index[keep])]
+        new = InvertedIndex.build(tokens.take(changed))
+        # Renumber the postings of kept dreams, then append the new dreams after them.
+        renumber = np.full(len(self.dream_ids), -1, dtype=np.int32)
+        renumber[keep] = np.arange(keep.sum(), dtype=np.int32)
+        kept_postings = renumber[self.docs] >= 0
+        vocab = np.union1d(self.vocab, new.vocab)
+        codes = np.concatenate([self._codes(vocab)[kept_postings], new._codes(vocab)])
+        docs = np.concatenate([renumber[self.docs][kept_postings], new.docs + keep.sum()])
+        positions = np.concatenate([self.positions[kept_postings], new.positions])
+        index = InvertedIndex._from_postings(
+            codes,
+            vocab,
+            docs.astype(np.int32),
+            positions,
+            np.concatenate([self.dream_ids[keep], new.dream_ids]),
+            np.concatenate([self.hashes[keep], new.hashes]),
+        )
+        n_removed = int((~old.index.isin(hashes.index)).sum())
+        return index, len(changed), n_removed
+
+    def save(self, filepath=index_path) -> None:
+        """Save the index arrays to a .npz file."""
+        np.savez(
+            filepath,
+            vocab=self.vocab,
+            offsets=self.offsets,
+            docs=self.docs,
+            positions=self.positions,
+            dream_ids=self.dream_ids,
+            hashes=self.hashes,
+        )
+
+    @classmethod
+    def load(cls, filepath=index_path):
+        """Load an index saved with `save`."""
+        with np.load(filepath) as npz:
+            return cls(*(npz[k] for k in ["vocab", "offsets", "docs", "positions", "dream_ids", "hashes"]))
+
+    def _postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Docs and positions of a token, or of all tokens starting with it if it ends with '*'."""
+        if term.endswith("*"):
+            prefix = term[:-1]
+            lo = np.searchsorted(self.vocab, prefix, side="left")
+            hi = np.searchsorted(self.vocab, prefix + "\U0010ffff", side="left")
+        else:
+            lo = np.searchsorted(self.vocab, term, side="left")
+            hi = lo + int(lo < self.vocab.size and self.vocab[lo] == term)
+        sl = slice(self.offsets[lo], self.offsets[hi])
+        return self.docs[sl], self.positions[sl]
+
+    def term(self, term: str) -> np.ndarray:
+        """Dreams containing a token (or a prefix ending with '*')."""
+        return np.unique(self._postings(term)[0])
+
+    def phrase(self, terms: list) -> np.ndarray:
+        """Dreams containing the terms as consecutive tokens."""
+        keys = None
+        for i, term in enumerate(terms):
+            docs, positions = self._postings(term)
+            # Encode (doc, position of the phrase's first token) as one integer.
+            term_keys = (docs.astype(np.int64) << 32) | (positions.astype(np.int64) - i) & 0xFFFFFFFF
+            keys = term_keys if keys is None else np.intersect1d(keys, term_keys)
+        return np.unique(keys >> 32).astype(np.int32) if keys is not None else np.empty(0, np.int32)
+
+    def search(self, query: str) -> np.ndarray:
+        """
+        Dream IDs matching a query.
+        Words are ANDed unless joined by OR; NOT excludes; parentheses group;
+        double quotes make a phrase; a trailing '*' matches any word with
+        that prefix (e.g., levitat*).
+        Args:
+            query (str): The query.
+        Returns:
+            np.ndarray: The matching dream IDs.
+        Raises:
+            AssertionError: If the query is malformed, e.g. has a word without
+                any searchable characters.
+
+        >>> texts = pd.Series(["I flew over a lake", "a lucid-dreaming flight"], index=["a", "b"])
+        >>> index = InvertedIndex.build(TokenStore.build(texts))
+        >>> index.search("lucid-dream* OR lake").tolist()
+        ['a', 'b']
+        >>> index.search("flew -")
+        Traceback (most recent call last):
+        AssertionError: '-' contains no searchable word.
+        """
+        return self.dream_ids[_QueryParser(self, query).parse()]
+
+
+class _QueryParser:
+    """Recursive-descent evaluation of a boolean query against an index."""
+
+    def __init__(self, index: InvertedIndex, query: str):
+        self.index = index
+        self.tokens = QUERY_PATTERN.findall(query)
+        self.i = 0
+
+    def parse(self) -> np.ndarray:
+        result = self._or()
+        assert self.i == len(self.tokens), f"Unexpected '{self.tokens[self.i]}' in query."
+        return result
+
+    def _peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def _or(self) -> np.ndarray:
+        result = self._and()
+        while self._peek() == "OR":
+            self.i += 1
+            result = np.union1d(result, self._and())
+        return result
+
+    def _and(self) -> np.ndarray:
+        result = self._not()
+        while self._peek() not in (None, "OR", ")"):
+            if self._peek() == "AND":
+                self.i += 1
+            result = np.intersect1d(result, self._not())
+        return result
+
+    def _not(self) -> np.ndarray:
+        if self._peek() == "NOT":
+            self.i += 1
+            return np.setdiff1d(np.arange(len(self.index.dream_ids)), self._not())
+        return self._atom()
+
+    def _atom(self) -> np.ndarray:
+        token = self._peek()
+        assert token is not None, "Query ended unexpectedly."
+        self.i += 1
+        if token == "(":
+            result = self._or()
+            assert self._peek() == ")", "Missing closing parenthesis in query."
+            self.i += 1
+            return result
+        terms = _query_terms(token.strip('"'))
+        assert terms, f"{token!r} contains no searchable word."
+        if token.startswith('"'):
+            return self.index.phrase(terms)
+        return self.index.term(terms[0]) if len(terms) == 1 else self.index.phrase(terms)
+
+
+def _query_terms(text: str) -> list:
+    """
+    Split query text into index tokens, keeping the trailing wildcard of a word on its last token.
+
+    >>> _query_terms("lucid-dream* flew")
+    ['lucid', 'dream*', 'flew']
+    >>> _query_terms("- *")
+    []
+    """
+    terms = []
+    for word in text.split():
+        tokens = tokenize(word)
+        if word.endswith("*") and tokens:
+            tokens[-1] += "*"
+        terms.extend(tokens)
+    return terms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Index all dreams from scratch.")
+    subparsers.add_parser("update", help="Index new and edited dreams, drop removed ones.")
+    query_parser = subparsers.add_parser("query", help="Search the index.")
+    query_parser.add_argument("query", type=str)
+    query_parser.add_argument("-n", "--limit", type=int, default=20, help="Dream IDs to list.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    if args.command == "build":
+        InvertedIndex.build(load_all()).save()
+    elif args.command == "update":
+        index, n_indexed, n_removed = InvertedIndex.load().update(load_all())
+        index.save()
+        print(f"Indexed {n_indexed} dreams, removed {n_removed}.")
+    elif args.command == "query":
+        index = InvertedIndex.load()
+        t0 = time.perf_counter()
+        matches = index.search(args.query)
+        elapsed = time.perf_counter() - t0
+        print(f"{matches.size} dreams ({1000 * elapsed:.1f} ms)")
+        print("\n".join(matches[: args.limit]))
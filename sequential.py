@@ -0,0 +1,150 @@
+"""Estimate prevalences from a stratified random subset of dreams, stopping once precise enough.
+
+`gpt_request.py --estimate-by source_id` requests dreams in a stratified random
+order and stops as soon as the prevalence of True answers (e.g., the fraction
+of lucid dreams) is known to the target precision in every group. Already
+coded dreams count toward the estimates, and a later run continues in the
+same order, so stopping early never loses work.
+
+```shell
+python gpt_request.py --dataset flying --task islucid --estimate-by source_id --precision 0.05
+python sequential.py --dataset flying --task islucid    # Current estimates, per source_id by default
+python -m doctest sequential.py                         # Check the intervals of (nearly) fully coded groups
+```
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import profiling
+import utils
+from consistency import aggregate_votes, task_items, vote_array
+
+
+# Columns that prevalences are estimated per group of, unless others are given.
+DEFAULT_GROUPS = {"flying": ["source_id"], "dreamviews": ["lucidity"], "sddb": ["survey"]}
+
+
+def length_bins(lengths: pd.Series, n_bins: int = 3) -> pd.Series:
+    """Quantile bin (0 = shortest) of every text length."""
+    return pd.qcut(lengths.rank(method="first"), n_bins, labels=False)
+
+
+def stratified_order(strata: pd.DataFrame, seed: int = 0) -> pd.Index:
+    """
+    Random order of dreams in which every stratum is sampled at the same rate.
+    Dreams are shuffled within their stratum and ordered by their relative
+    position in it, so any prefix of the order is close to a proportional
+    stratified sample.
+    Args:
+        strata (pd.DataFrame): The stratification variables, indexed by dream ID.
+        seed (int): Seed of the shuffle.
+    Returns:
+        pd.Index: The dream IDs in sampling order.
+    """
+
+    rng = np.random.default_rng(seed)
+    key = strata.astype(str).agg("|".join, axis=1)
+    shuffled = pd.Series(rng.random(len(key)), index=key.index)
+    position = shuffled.groupby(key).rank(method="first") - 0.5
+    size = key.map(key.value_counts())
+    # Break ties between strata at the same relative position at random.
+    rate = position / size + rng.random(len(key)) * 1e-9
+    return rate.sort_values(kind="stable").index
+
+
+def prevalence(codes: pd.Series, groups: pd.Series, confidence: float = 0.95) -> pd.DataFrame:
+    """
+    Prevalence of True codes per group and overall, with Wilson confidence intervals.
+    The finite population correction enters the Wilson formula through the
+    effective sample size n (N - 1) / (N - n), so the interval narrows onto p
+    as a group gets coded, and a group whose dreams were all coded has an
+    exact prevalence.
+    Args:
+        codes (pd.Series): Boolean code of every dream of the population (NA if not coded yet).
+        groups (pd.Series): Group of every dream, same index as `codes`.
+        confidence (float): Confidence level of the intervals.
+    Returns:
+        pd.DataFrame: One row per group plus "all", with the population size N,
+            coded dreams n, True codes k, prevalence p, lower and upper bounds,
+            and margin (half the interval width).
+
+    >>> codes = pd.Series([False] * 10 + [True] * 3 + [False] * 37 + [pd.NA] * 2, dtype="boolean")
+    >>> groups = pd.Series(["a"] * 10 + ["b"] * 42)
+    >>> prevalence(codes, groups)[["N", "n", "k", "p", "lower", "upper"]].round(3)  # doctest: +NORMALIZE_WHITESPACE
+            N   n  k      p  lower  upper
+    group
+    a      10  10  0  0.000  0.000  0.000
+    b      42  40  3  0.075  0.059  0.095
+    all    52  50  3  0.060  0.048  0.074
+    """
+
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    coded = codes.notna()
+    frame = pd.DataFrame({
+        "group": groups.astype(str),
+        "coded": coded,
+        "true": codes.fillna(False).astype(bool) & coded,
+    })
+    table = frame.groupby("group").agg(N=("coded", "size"), n=("coded", "sum"), k=("true", "sum"))
+    table.loc["all"] = table.sum()
+    N, n, k = (table[c].to_numpy(float) for c in ["N", "n", "k"])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = k / n
+        # z² / n_eff, with n_eff = n (N - 1) / (N - n) (infinite once all N are coded).
+        c = z**2 * np.clip(N - n, 0, None) / (n * np.maximum(N - 1, 1))
+        center = (p + c / 2) / (1 + c)
+        half = np.sqrt(c * p * (1 - p) + c**2 / 4) / (1 + c)
+    margin = np.where(n > 0, half, np.inf)
+    table["p"] = p
+    table["lower"] = np.clip(np.where(n > 0, center - margin, 0), 0, 1)
+    table["upper"] = np.clip(np.where(n > 0, center + margin, 1), 0, 1)
+    table["margin"] = margin
+    return table
+
+
+def precise_enough(table: pd.DataFrame, precision: float, min_n: int = 30) -> bool:
+    """Whether every group's margin is within `precision`, with at least `min_n` coded dreams (or all of them)."""
+    enough = table["n"] >= np.minimum(min_n, table["N"])
+    return bool(((table["margin"] <= precision) & enough).all())
+
+
+def current_codes(responses: dict, task: str, dream_ids: pd.Index) -> pd.Series:
+    """Majority True/False code of every dream of the population (NA if not coded or invalid)."""
+    population = set(dream_ids)
+    responses = {k: v for k, v in responses.items() if k in population}
+    if not responses:
+        return pd.Series(pd.NA, index=dream_ids, dtype="boolean")
+    votes, coded_ids = vote_array(responses, task)
+    codes = aggregate_votes(votes, coded_ids, task_items(task))[task]
+    return codes.reindex(dream_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", required=True, type=str, choices=["dreamviews", "flying", "sddb"])
+    parser.add_argument("-t", "--task", required=True, type=str, choices=["isdream", "islucid"])
+    parser.add_argument(
+        "-b", "--by", nargs="+", default=None, help="Columns to estimate per group of (default: per dataset)."
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    if args.dataset == "flying":
+        df = utils.load_sourcedata(dreams_only=True)
+    elif args.dataset == "dreamviews":
+        df = utils.load_dreamviews()
+    elif args.dataset == "sddb":
+        df = utils.load_sddb()
+    by = args.by or DEFAULT_GROUPS[args.dataset]
+    unknown = [c for c in by if c not in df.columns]
+    if unknown:
+        parser.error(f"{args.dataset} has no column {', '.join(unknown)}, choose from {', '.join(df.columns)}")
+    responses = utils.load_json(utils.deriv_dir / f"data-{args.dataset}_task-{args.task}_responses.json")
+    codes = current_codes(responses, args.task, df.index)
+    groups = df[by].astype(str).agg("|".join, axis=1)
+    print(prevalence(codes, groups).round(3))
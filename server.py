@@ -0,0 +1,340 @@
+"""Keep datasets and derivatives loaded in a long-running process between plot runs.
+
+The server wraps the loaders of utils and the cached derivatives (lucidity
+codes, theme matrices, timecourses, LIWC tables, the summary cube) so each
+result stays in memory until one of its input files changes. Plot scripts are
+rendered inside the server, with pandas and matplotlib already imported and
+every load a cache hit, so re-rendering after an edit takes well under a
+second instead of tens of seconds. Other processes can fetch the cached frames
+too. If library code (e.g., utils.py) changes, the changed modules are
+reloaded and the cache is cleared.
+
+The server listens on a Unix socket (localhost on Windows) that only accepts
+clients holding the key it writes to the user's temporary directory.
+
+```shell
+python server.py start                          # Keep running in one terminal
+python server.py render plot_timecourses.py     # Re-render from another, as often as needed
+python server.py status                         # What is cached
+python server.py stop
+```
+
+```python
+import server
+flying = server.fetch("load_sourcedata", dreams_only=True)    # Cached frame, or a local load without a server
+```
+"""
+
+import argparse
+import contextlib
+import getpass
+import importlib
+import io
+import os
+import runpy
+import sys
+import tempfile
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+
+repo_dir = Path(__file__).parent
+
+if os.name == "posix":
+    ADDRESS = str(Path(tempfile.gettempdir()) / f"flying-{getpass.getuser()}.sock")
+else:
+    ADDRESS = ("localhost", 48651)
+key_path = Path(tempfile.gettempdir()) / f"flying-{getpass.getuser()}.key"
+
+# The cache of the running server (None in clients).
+cache = None
+
+
+def fingerprint(paths: list) -> tuple:
+    """Modification time and size of every file (None for missing ones)."""
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append((str(path), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stats.append((str(path), None))
+    return tuple(stats)
+
+
+class Cache:
+    """
+    Results of loader calls, each kept until one of its input files changes.
+    Args:
+        loaders (dict): For every loader name, the loader, a function returning
+            the input files of a call, and whether callers get a copy of the
+            result (for DataFrames that scripts modify in place).
+    """
+
+    def __init__(self, loaders: dict):
+        self.loaders = loaders
+        self.entries = {}
+
+    def call(self, name: str, *args, **kwargs):
+        """Call a loader, or return its cached result if none of its inputs changed."""
+        func, inputs, copy = self.loaders[name]
+        key = repr((name, args, sorted(kwargs.items())))
+        current = fingerprint(inputs(*args, **kwargs))
+        entry = self.entries.get(key)
+        if entry is None or entry["fingerprint"] != current:
+            start = time.perf_counter()
+            value = func(*args, **kwargs)
+            entry = self.entries[key] = {
+                "fingerprint": current,
+                "value": value,
+                "loaded": time.time(),
+                "seconds": time.perf_counter() - start,
+            }
+        return entry["value"].copy() if copy else entry["value"]
+
+    def status(self) -> list:
+        """Every cached call with its load time and age, in seconds."""
+        now = time.time()
+        return [(key, e["seconds"], now - e["loaded"]) for key, e in self.entries.items()]
+
+
+def make_loaders() -> dict:
+    """The cached loaders and the files each call depends on."""
+    import descriptives
+    import spans
+    import themes
+    import utils
+
+    flying_path = lambda *args, name="Flying Dreams Database.xlsx", **kwargs: utils.source_dir / name
+    responses = lambda dataset, task: utils.deriv_dir / f"data-{dataset}_task-{task}_responses.json"
+    # The loaders themselves, not the cache's wrappers around them.
+    original = lambda func: getattr(func, "__wrapped__", func)
+    loaders = {
+        "load_sourcedata": (utils.load_sourcedata, lambda *a, **k: [flying_path(*a, **k)], True),
+        "load_dreamviews": (utils.load_dreamviews, lambda: [utils.source_dir / "dreamviews.tsv"], True),
+        "load_sddb": (utils.load_sddb, lambda: [utils.source_dir / "SDDb.csv"], True),
+        "load_gpt_lucidity_codes": (
+            utils.load_gpt_lucidity_codes,
+            lambda dataset: [responses(dataset, "islucid")],
+            True,
+        ),
+        "load_liwc": (
+            utils.load_liwc,
+            lambda dataset, dic, nsegs=1: [utils.deriv_dir / f"data-{dataset}_liwc-{dic}_nsegs-{nsegs}.csv"],
+            True,
+        ),
+        "load_summary_cube": (descriptives.load_summary_cube, lambda rebuild=False: descriptives._input_paths(), True),
+        "ThemeMatrix.load": (
+            themes.ThemeMatrix.load,
+            lambda dataset="flying", rebuild=False: [themes.ThemeMatrix.path(dataset)]
+            + [responses(dataset, f"thematic{family}") for family in themes.THEMES],
+            False,
+        ),
+        "Timecourses.load": (
+            spans.Timecourses.load,
+            lambda dataset="flying", rebuild=False, n_bins=spans.N_BINS: list(spans.Timecourses.paths(dataset).values()),
+            False,
+        ),
+    }
+    return {name: (original(func), inputs, copy) for name, (func, inputs, copy) in loaders.items()}
+
+
+def install(loaders: dict) -> None:
+    """Route every call of the loaders through the server's cache."""
+    global cache
+    import descriptives
+    import spans
+    import themes
+    import utils
+
+    cache = Cache(loaders)
+    owners = {"ThemeMatrix": themes.ThemeMatrix, "Timecourses": spans.Timecourses}
+    for name in loaders:
+        wrapper = lambda *args, _name=name, **kwargs: cache.call(_name, *args, **kwargs)
+        wrapper.__wrapped__ = loaders[name][0]
+        if "." in name:
+            owner, attr = name.split(".")
+            setattr(owners[owner], attr, staticmethod(wrapper))
+        elif name == "load_summary_cube":
+            descriptives.load_summary_cube = wrapper
+        else:
+            setattr(utils, name, wrapper)
+
+
+def _local_modules() -> dict:
+    """Source file modification times of the repository's imported modules."""
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and Path(path).parent == repo_dir and name not in ["__main__", "server"]:
+            modules[name] = os.stat(path).st_mtime_ns
+    return modules
+
+
+def reload_changed(known: dict) -> list:
+    """Reload the repository modules whose source changed, and start a new cache if any did."""
+    changed = [name for name, mtime in _local_modules().items() if known.get(name, mtime) != mtime]
+    for name in changed:
+        importlib.reload(sys.modules[name])
+    if changed:
+        install(make_loaders())
+    known.update(_local_modules())
+    return changed
+
+
+def render(script: str, argv: list = None) -> str:
+    """Run a plot script in the server process and return what it printed."""
+    import matplotlib.pyplot as plt
+
+    path = (repo_dir / script).resolve()
+    assert path.parent == repo_dir.resolve() and path.suffix == ".py", f"{script} is not a script of the repository."
+    output = io.StringIO()
+    saved_argv = sys.argv
+    sys.argv = [script, *(argv or [])]
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            runpy.run_path(str(path), run_name="__main__")
+    finally:
+        sys.argv = saved_argv
+        plt.close("all")
+    return output.getvalue()
+
+
+def handle(request: tuple, known: dict):
+    """Answer one request."""
+    command, *payload = request
+    changed = reload_changed(known)
+    if changed:
+        print(f"Reloaded {', '.join(changed)}, cache cleared.")
+    if command == "fetch":
+        name, args, kwargs = payload
+        return cache.call(name, *args, **kwargs)
+    if command == "render":
+        script, argv = payload
+        start = time.perf_counter()
+        printed = render(script, argv)
+        return f"{printed}{script} rendered in {time.perf_counter() - start:.2f}s"
+    if command == "status":
+        return cache.status()
+    raise ValueError(f"Unknown command {command}")
+
+
+def serve() -> None:
+    """Load the libraries, then answer requests until stopped."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    os.chdir(repo_dir)
+    # Scripts that import this module get the running one, with its cache.
+    sys.modules["server"] = sys.modules[__name__]
+    install(make_loaders())
+    known = _local_modules()
+    if running():
+        raise SystemExit(f"A server is already listening on {ADDRESS}.")
+    if os.name == "posix" and os.path.exists(ADDRESS):
+        os.remove(ADDRESS)  # Left behind by a server that did not stop cleanly
+    authkey = os.urandom(32)
+    with Listener(ADDRESS, authkey=authkey) as listener:
+        write_key(authkey)
+        print(f"Listening on {listener.address}")
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as error:  # A client with the wrong key
+                    print(f"Refused a connection: {error}")
+                    continue
+                with connection:
+                    request = connection.recv()
+                    if request == ("stop",):
+                        connection.send(("ok", "Stopped"))
+                        break
+                    try:
+                        connection.send(("ok", handle(request, known)))
+                    except Exception:
+                        connection.send(("error", traceback.format_exc()))
+        finally:
+            key_path.unlink(missing_ok=True)
+
+
+def write_key(authkey: bytes) -> None:
+    """Write the key for clients, readable by this user only from the start."""
+    key_path.unlink(missing_ok=True)
+    # O_EXCL fails rather than follow a file or link another user put there.
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+
+
+def running() -> bool:
+    """Whether a server is listening (with a key of this user or not)."""
+    try:
+        Client(ADDRESS).close()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    except Exception:
+        pass
+    return True
+
+
+def request(*message):
+    """
+    Send a request to the running server.
+    Raises:
+        ConnectionError: If no server is running.
+        RuntimeError: With the server's traceback, if the request failed.
+    """
+
+    try:
+        connection = Client(ADDRESS, authkey=key_path.read_bytes())
+    except (FileNotFoundError, ConnectionRefusedError) as error:
+        raise ConnectionError("No server running, start one with `python server.py start`.") from error
+    with connection:
+        connection.send(message)
+        status, payload = connection.recv()
+    if status == "error":
+        raise RuntimeError(payload)
+    return payload
+
+
+def fetch(name: str, *args, **kwargs):
+    """
+    Result of a cached loader, from the server if one is running, else loaded here.
+    Args:
+        name (str): The loader, e.g. "load_sourcedata" or "ThemeMatrix.load".
+        *args, **kwargs: Its arguments.
+    Returns:
+        The loader's result.
+    """
+
+    if cache is not None:
+        return cache.call(name, *args, **kwargs)
+    try:
+        return request("fetch", name, args, kwargs)
+    except ConnectionError:
+        func, _, _ = make_loaders()[name]
+        return func(*args, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("start", help="Run the server in this terminal.")
+    subparsers.add_parser("stop", help="Stop the running server.")
+    subparsers.add_parser("status", help="List the cached results.")
+    render_parser = subparsers.add_parser("render", help="Run plot scripts in the server.")
+    render_parser.add_argument("scripts", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        serve()
+    elif args.command == "stop":
+        print(request("stop"))
+    elif args.command == "status":
+        for key, seconds, age in request("status"):
+            print(f"{seconds:7.2f}s to load, {age / 60:6.1f} min ago  {key}")
+    elif args.command == "render":
+        for script in args.scripts:
+            print(request("render", script, []))
@@ -0,0 +1,84 @@
+"""Exact character-level event statistics computed from the annotate span table."""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+def merge_spans(spans: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge overlapping or touching spans of the same dream and label.
+    Args:
+        spans (pd.DataFrame): Span table with dream_id, label, start and end columns.
+    Returns:
+        pd.DataFrame: Non-overlapping spans with the same columns (plus
+            text_length if present), sorted by dream, label and start.
+    """
+
+    spans = spans.astype({"label": str}).sort_values(["dream_id", "label", "start"])
+    keys = ["dream_id", "label"]
+    # A span starts a new interval if it begins after every earlier span ended.
+    running_end = spans.groupby(keys)["end"].cummax()
+    prev_end = running_end.groupby([spans[k] for k in keys]).shift()
+    new_interval = prev_end.isna() | (spans["start"] > prev_end)
+    interval_id = new_interval.cumsum()
+    agg = {"dream_id": "first", "label": "first", "start": "min", "end": "max"}
+    if "text_length" in spans:
+        agg["text_length"] = "first"
+    return spans.groupby(interval_id).agg(agg).reset_index(drop=True)
+
+
+def event_table(spans: pd.DataFrame, dreams: pd.DataFrame, labels: list) -> pd.DataFrame:
+    """
+    Exact onset, offset, coverage, ordering and overlap of events in every dream.
+    Positions are normalized by the dream's text length, so 0 is the first
+    character and 1 is the end of the dream. Events that never occur in a dream
+    are missing (NaN) rather than 0, and are flagged in the `{label}_present`
+    columns.
+    Args:
+        spans (pd.DataFrame): Span table with dream_id, label, start and end columns.
+        dreams (pd.DataFrame): Dream table indexed by dream ID, with a text_length column.
+        labels (list): The labels to compute statistics for.
+    Returns:
+        pd.DataFrame: One row per dream with, for each label, `{label}_present`,
+            `{label}_onset`, `{label}_offset` and `{label}_coverage` (fraction of
+            characters covered); `first_event` (label with the earliest onset,
+            missing if no event occurs); and for each pair of labels,
+            `overlap_{a}_{b}` (fraction of characters covered by both).
+    """
+
+    lengths = dreams["text_length"]
+    merged = merge_spans(spans[spans["label"].isin(labels)])
+    merged["length"] = merged["end"] - merged["start"]
+    per_label = merged.groupby(["dream_id", "label"]).agg(
+        onset=("start", "min"), offset=("end", "max"), covered=("length", "sum")
+    )
+    per_label = per_label.reindex(
+        pd.MultiIndex.from_product([dreams.index, labels], names=["dream_id", "label"])
+    )
+    norm = per_label.div(lengths.reindex(per_label.index.get_level_values("dream_id")).to_numpy(), axis=0)
+    norm = norm.rename(columns={"covered": "coverage"}).unstack("label")
+    norm.columns = [f"{label}_{stat}" for stat, label in norm.columns]
+    table = pd.DataFrame(index=dreams.index)
+    for label in labels:
+        table[f"{label}_present"] = norm[f"{label}_onset"].notna()
+        for stat in ["onset", "offset", "coverage"]:
+            table[f"{label}_{stat}"] = norm[f"{label}_{stat}"]
+    onsets = table[[f"{label}_onset" for label in labels]]
+    onsets.columns = labels
+    first = np.nan_to_num(onsets.to_numpy(dtype=float), nan=np.inf).argmin(axis=1)
+    table["first_event"] = pd.Series(np.asarray(labels)[first], index=table.index).where(
+        onsets.notna().any(axis=1)
+    )
+    # Intersections of the merged spans of every pair of labels, within each dream.
+    for a, b in itertools.combinations(labels, 2):
+        pairs = merged[merged["label"] == a].merge(
+            merged[merged["label"] == b], on="dream_id", suffixes=("_a", "_b")
+        )
+        overlap = (
+            np.minimum(pairs["end_a"], pairs["end_b"]) - np.maximum(pairs["start_a"], pairs["start_b"])
+        ).clip(lower=0)
+        overlap = overlap.groupby(pairs["dream_id"]).sum()
+        table[f"overlap_{a}_{b}"] = (overlap / lengths).reindex(table.index).fillna(0)
+    return table
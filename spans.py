@@ -0,0 +1,302 @@
+"""Parse annotate responses into a persistent span table and timecourse cube.
+
+```shell
+python spans.py --dataset flying    #> data-flying_task-annotate_{spans.csv,dreams.csv,timecourses.npz}
+```
+"""
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import profiling
+import utils
+from align import align_entities, alignment_report
+from span_stats import event_table
+from textstore import TextStore
+
+
+LABELS = ["flying", "lucidity", "supplement"]
+N_BINS = 100
+
+
+@profiling.stage("parse", "annotate completions")
+def parse_annotate_completions(completions: dict, labels: list = LABELS, texts=None) -> tuple:
+    """
+    Parse annotate completions and align their entities onto the dream text.
+    Completions that do not follow the expected response format are skipped.
+    Args:
+        completions (dict): ChatGPT completions, keyed by dream ID.
+        labels (list): The entity labels the annotate prompt allows.
+        texts (TextStore): Optional source texts to align onto, instead of the
+            text echoed back in each completion (used for dreams it contains).
+    Returns:
+        tuple: A DataFrame of aligned entities (one row per entity, see
+            `align.align_entities`), a DataFrame with the text length and number
+            of entities of every successfully parsed dream, and the number of
+            completions that could not be parsed.
+    """
+
+    aligned = []
+    dreams = {}
+    badcounts = 0
+    for dream_id, completion in completions.items():
+        try:
+            choices = completion["choices"]
+            assert len(choices) == 1, "Expected only 1 response from ChatGPT."
+            choice = choices[0]
+            assert choice["finish_reason"] == "stop"
+            content = choice["message"]["content"]
+            assert content.startswith("{") and content.endswith("}")
+            ann = json.loads(content)
+            assert len(ann.keys()) == 2
+            assert all(k in ["text", "entities"] for k in ann)
+            dream_report = texts[dream_id] if texts is not None and dream_id in texts else ann["text"]
+            entities = ann["entities"]
+            assert isinstance(entities, list)
+            assert all(e["label"] in labels for e in entities)
+            spans = align_entities(dream_report, entities)
+        except Exception:
+            badcounts += 1
+            continue
+        dreams[dream_id] = {"text_length": len(dream_report), "n_entities": len(entities)}
+        aligned.extend({"dream_id": dream_id} | span for span in spans)
+    columns = ["dream_id", "label", "value", "start", "end", "method"]
+    aligned = pd.DataFrame(aligned, columns=columns)
+    dreams = pd.DataFrame.from_dict(
+        dreams, orient="index", columns=["text_length", "n_entities"]
+    ).rename_axis("dream_id")
+    return aligned, dreams, badcounts
+
+
+def make_span_table(aligned: pd.DataFrame, dreams: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce aligned entities to a compact span table.
+    Args:
+        aligned (pd.DataFrame): Aligned entities from `parse_annotate_completions`.
+        dreams (pd.DataFrame): Dream table from `parse_annotate_completions`.
+    Returns:
+        pd.DataFrame: One row per aligned span with columns dream_id, label,
+            start, end (character positions) and text_length.
+    """
+
+    table = (
+        aligned.query("method != 'failed'")
+        .loc[:, ["dream_id", "label", "start", "end"]]
+        .astype({"start": "int32", "end": "int32"})
+        .join(dreams["text_length"].astype("int32"), on="dream_id")
+        .reset_index(drop=True)
+    )
+    table["label"] = pd.Categorical(table["label"], categories=LABELS)
+    return table
+
+
+@profiling.stage("compute", "timecourse cube")
+def make_timecourse_cube(
+    spans: pd.DataFrame, dreams: pd.DataFrame, labels: list = LABELS, n_bins: int = N_BINS
+) -> np.ndarray:
+    """
+    Resample the character-level span masks of every dream to a fixed number of bins.
+    This gives the same values as building a binary mask over the characters
+    of each dream and `np.interp`-olating it at `n_bins` evenly spaced points,
+    but works on all spans at once instead of one dream at a time.
+    Args:
+        spans (pd.DataFrame): Span table from `make_span_table`.
+        dreams (pd.DataFrame): Dream table, its index gives the cube's dream order.
+        labels (list): Labels, in the order of the cube's second axis.
+        n_bins (int): Number of bins along the dream.
+    Returns:
+        np.ndarray: A float32 array of shape (dreams, labels, bins).
+    """
+
+    n_dreams = len(dreams)
+    lengths = dreams["text_length"].to_numpy()
+    # Fractional character position of every bin, for every dream.
+    positions = np.linspace(0, 1, n_bins)[None, :] * (lengths[:, None] - 1).clip(0)
+    lo = np.floor(positions).astype(np.int64)
+    hi = np.ceil(positions).astype(np.int64)
+    frac = (positions - lo).astype(np.float32)
+    # Which bins have their neighboring characters covered by each span.
+    d = dreams.index.get_indexer(spans["dream_id"])
+    l = pd.Index(labels).get_indexer(spans["label"])
+    start = spans["start"].to_numpy()[:, None]
+    end = spans["end"].to_numpy()[:, None]
+    covered_lo = np.zeros((n_dreams, len(labels), n_bins), dtype=np.uint8)
+    covered_hi = np.zeros((n_dreams, len(labels), n_bins), dtype=np.uint8)
+    np.maximum.at(covered_lo, (d, l), ((lo[d] >= start) & (lo[d] < end)).astype(np.uint8))
+    np.maximum.at(covered_hi, (d, l), ((hi[d] >= start) & (hi[d] < end)).astype(np.uint8))
+    frac = frac[:, None, :]
+    return (1 - frac) * covered_lo + frac * covered_hi
+
+
+def load_dream_metadata(dataset: str, dream_ids: pd.Index) -> pd.DataFrame:
+    """
+    Collect the dream-level metadata that timecourses get grouped by.
+    Args:
+        dataset (str): The dataset the dreams come from.
+        dream_ids (pd.Index): The dream IDs to get metadata for.
+    Returns:
+        pd.DataFrame: Source, subject, sex (where available) and GPT lucidity
+            code of each dream, indexed by dream ID.
+    """
+
+    assert dataset == "flying", "Only the flying dataset has been annotated."
+    meta = utils.load_sourcedata(dreams_only=True)[["source_id", "subject_id", "sex"]]
+    lucidity = utils.load_gpt_lucidity_codes(dataset)
+    lucidity = lucidity[~lucidity.index.duplicated()]
+    return meta.join(lucidity, how="outer").reindex(dream_ids)
+
+
+class Timecourses:
+    """
+    Annotate timecourses of a dataset, with dream-level metadata for slicing.
+    Args:
+        cube (np.ndarray): Array of shape (dreams, labels, bins).
+        dreams (pd.DataFrame): One row per dream of the cube, in the same order,
+            with text_length, n_entities, and metadata columns.
+        spans (pd.DataFrame): The span table the cube was built from.
+        labels (list): The labels along the second axis of the cube.
+    """
+
+    def __init__(self, cube: np.ndarray, dreams: pd.DataFrame, spans: pd.DataFrame, labels: list):
+        self.cube = cube
+        self.dreams = dreams
+        self.spans = spans
+        self.labels = list(labels)
+
+    @staticmethod
+    def paths(dataset: str) -> dict:
+        """Return the paths of the inputs and of the persisted span table, dream table and cube."""
+        stem = f"data-{dataset}_task-annotate"
+        return {
+            "responses": utils.deriv_dir / f"{stem}_responses.json",
+            # The dream table stores metadata from these two.
+            "sourcedata": utils.source_dir / "Flying Dreams Database.xlsx",
+            "lucidity": utils.deriv_dir / f"data-{dataset}_task-islucid_responses.json",
+            "spans": utils.deriv_dir / f"{stem}_spans.csv",
+            "dreams": utils.deriv_dir / f"{stem}_dreams.csv",
+            "cube": utils.deriv_dir / f"{stem}_timecourses.npz",
+        }
+
+    @classmethod
+    def build(cls, dataset: str = "flying", n_bins: int = N_BINS, verbose: bool = True):
+        """Parse the annotate responses of a dataset and save the results to disk."""
+        paths = cls.paths(dataset)
+        completions = utils.load_json(paths["responses"])
+        aligned, dreams, badcounts = parse_annotate_completions(completions, texts=TextStore.load(dataset))
+        if verbose:
+            print(f"THIS MANY LOADING ERRORS: {badcounts}")
+            print(alignment_report(aligned))
+        # Only dreams that received at least one annotation are used.
+        dreams = dreams.query("n_entities > 0")
+        dreams = dreams.join(load_dream_metadata(dataset, dreams.index))
+        spans = make_span_table(aligned, dreams)
+        cube = make_timecourse_cube(spans, dreams, n_bins=n_bins)
+        spans.to_csv(paths["spans"], index=False)
+        dreams.to_csv(paths["dreams"], index=True)
+        np.savez(paths["cube"], cube=cube, dream_ids=dreams.index.to_numpy(str), labels=LABELS, n_bins=n_bins)
+        return cls(cube, dreams, spans, LABELS)
+
+    @classmethod
+    def load(cls, dataset: str = "flying", rebuild: bool = False, n_bins: int = N_BINS):
+        """
+        Load persisted timecourses, building them first if missing or outdated.
+        They are outdated if the annotate responses, the source spreadsheet or
+        the islucid responses changed since, or the cube has another number of bins.
+        Args:
+            dataset (str): The dataset to load timecourses for.
+            rebuild (bool): If True, rebuild even when the saved files are current.
+            n_bins (int): Number of timecourse bins.
+        Returns:
+            Timecourses: The loaded timecourses.
+        """
+        paths = cls.paths(dataset)
+        inputs = [p for p in [paths["responses"], paths["sourcedata"], paths["lucidity"]] if p.exists()]
+        outputs = [paths["spans"], paths["dreams"], paths["cube"]]
+        if (
+            rebuild
+            or not all(p.exists() for p in outputs)
+            or min(p.stat().st_mtime for p in outputs) < max([p.stat().st_mtime for p in inputs], default=0)
+        ):
+            return cls.build(dataset, n_bins=n_bins)
+        with np.load(paths["cube"]) as npz:
+            cube = npz["cube"]
+            labels = npz["labels"].tolist()
+            dream_ids = npz["dream_ids"].tolist()
+            saved_bins = int(npz["n_bins"]) if "n_bins" in npz else cube.shape[-1]
+        if saved_bins != n_bins:
+            return cls.build(dataset, n_bins=n_bins)
+        dreams = pd.read_csv(paths["dreams"], index_col="dream_id").reindex(dream_ids)
+        spans = pd.read_csv(paths["spans"], dtype={"label": "category"})
+        return cls(cube, dreams, spans, labels)
+
+    def select(self, label: str, mask: np.ndarray = None) -> np.ndarray:
+        """Return the (dreams, bins) matrix of one label, optionally for a subset of dreams."""
+        data = self.cube[:, self.labels.index(label), :]
+        return data if mask is None else data[np.asarray(mask)]
+
+    def has(self, label: str) -> np.ndarray:
+        """Return a boolean mask of the dreams that contain the given label."""
+        return self.select(label).max(axis=1) > 0
+
+    def summarize(self, label: str, by: str = None, mask: np.ndarray = None) -> pd.DataFrame:
+        """
+        Mean and standard error of a label's timecourse, optionally per group.
+        Args:
+            label (str): The label to summarize.
+            by (str): A column of the dream table to group by (e.g., "source_id",
+                "sex", "lucidity"). If None, all dreams form one group.
+            mask (np.ndarray): Optional boolean mask restricting the dreams used.
+        Returns:
+            pd.DataFrame: One row per group and bin, with columns n, mean and sem.
+        """
+        keep = np.ones(len(self.dreams), dtype=bool) if mask is None else np.asarray(mask)
+        groups = pd.Series("all", index=self.dreams.index) if by is None else self.dreams[by]
+        data = self.select(label)
+        frames = []
+        for group, idx in groups[keep].groupby(groups[keep], dropna=True).indices.items():
+            rows = np.flatnonzero(keep)[idx]
+            frames.append(
+                pd.DataFrame({
+                    "group": group,
+                    "bin": np.arange(data.shape[1]),
+                    "n": rows.size,
+                    "mean": data[rows].mean(axis=0),
+                    "sem": stats.sem(data[rows], axis=0),
+                })
+            )
+        return pd.concat(frames, ignore_index=True).rename(columns={"group": by or "group"})
+
+    def events(self, labels: list = None) -> pd.DataFrame:
+        """Exact per-dream event statistics from the span table (see `span_stats.event_table`)."""
+        return event_table(self.spans, self.dreams, self.labels if labels is None else labels)
+
+    def onsets(self, label: str, by: str = None) -> pd.DataFrame:
+        """
+        First bin in which a label appears, for every dream that contains it.
+        Args:
+            label (str): The label to get onsets for.
+            by (str): Optional column of the dream table to include for grouping.
+        Returns:
+            pd.DataFrame: Onset bin per dream (indexed by dream ID), with the
+                grouping column if requested.
+        """
+        data = self.select(label)
+        present = data.max(axis=1) > 0
+        onsets = pd.DataFrame(
+            {"onset": np.argmax(data > 0, axis=1)}, index=self.dreams.index
+        )[present]
+        return onsets if by is None else onsets.join(self.dreams[by])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", type=str, default="flying", choices=["flying"])
+    parser.add_argument("-b", "--bins", type=int, default=N_BINS, help="Number of timecourse bins.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+    Timecourses.build(args.dataset, n_bins=args.bins)
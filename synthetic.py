@@ -0,0 +1,260 @@
+"""Synthetic source files, ChatGPT responses and LIWC outputs for performance work.
+
+The real source files are not shared, so slowdowns are reproduced on synthetic
+files with the same schemas: the Flying database spreadsheet, SDDb.csv and
+dreamviews.tsv, plus responses of every task and LIWC outputs for DreamViews
+(the largest dataset, so it is the one that scales). Text lengths follow the
+log-normal shape of real reports, including too short and too long ones, and a
+few non-ASCII characters and double quotes keep `clean_dream_column` busy.
+
+```shell
+python synthetic.py --n 100000    #> ../derivatives/synthetic/n-100000/{sourcedata,derivatives}/
+```
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from themes import THEMES
+
+
+# The Flying database is an Excel file, which is capped at about a million rows
+# and slow to write, so it grows only up to this size.
+FLYING_MAX_ROWS = 100_000
+
+WORDS = (
+    "i the a and to was in of it my me that we were he she they on with as but had "
+    "then so at there up out could like from all this into just be what when dream "
+    "dreamt dreaming flying fly flew float floating air sky ground above over down "
+    "house room door window street car people friend mother father someone woman man "
+    "lucid realized aware control wake woke remember felt feel feeling fast slow high "
+    "higher falling fall jumped jump arms wings wind clouds trees city water ocean "
+    "scared happy free amazing strange weird suddenly again around back looked saw "
+    "tried wanted knew started began didn't couldn't it's i'm don't "
+    "café naïve “flying” said \"stop\" 'okay'"
+).split()
+
+SOURCES = [
+    "Reddit r/LucidDreaming",
+    "Reddit r/Dreams",
+    "LD4all.com : Dream Journal",
+    "LD4all.com : Lucid adventures",
+    "DreamBank",
+    "SDDB Flying Dreams - Export",
+    "I Dream of Covid (IDoC)",
+    "Twitter : @CovidDreams 30mar2020_11jul2022 (33834) for Tobi v2",
+    "Alchemy forums",
+]
+
+# Output columns of the LIWC dictionaries that are read downstream.
+LIWC_CATEGORIES = {
+    "22": [
+        "WC", "Analytic", "Clout", "Authentic", "Tone", "WPS", "i", "we", "social",
+        "emo_pos", "emo_neg", "emo_anx", "insight", "cause", "motion", "space", "time",
+    ],
+    "bigtwo": ["Agency", "Communion"],
+    "vestibular": [
+        "ascend", "balance", "descend", "dizzy", "falling", "float", "fly", "gyrate",
+        "hover", "soar", "spin", "spinning", "swirl", "vertigo", "weightless", "whirl",
+    ],
+}
+
+
+def paths(n: int, root: Path = None) -> dict:
+    """Source and derivatives directories of the synthetic data with `n` rows."""
+    root = Path(root or utils.deriv_dir / "synthetic") / f"n-{n}"
+    return {"sourcedata": root / "sourcedata", "derivatives": root / "derivatives"}
+
+
+def make_texts(n: int, rng: np.random.Generator, median: int = 600, sigma: float = 0.9) -> np.ndarray:
+    """
+    Random dream reports with log-normally distributed lengths.
+    Every text is a slice of one long Zipf-distributed word stream, which
+    keeps generating a million reports to a couple of seconds.
+    Args:
+        n (int): Number of texts.
+        rng (np.random.Generator): Random generator.
+        median (int): Median length, in characters.
+        sigma (float): Spread of the log lengths.
+    Returns:
+        np.ndarray: The texts, of object dtype.
+    """
+
+    lengths = np.clip(rng.lognormal(np.log(median), sigma, n), 10, 8000).astype(int)
+    weights = 1 / np.arange(1, len(WORDS) + 1)
+    words = rng.choice(WORDS, size=2_000_000, p=weights / weights.sum())
+    # End about one word in twelve with a full stop.
+    words = np.where(rng.random(words.size) < 1 / 12, np.char.add(words, "."), words)
+    stream = " ".join(words.tolist()).encode("utf-8")
+    # Start every text at a word boundary.
+    boundaries = np.flatnonzero(np.frombuffer(stream, np.uint8) == ord(" "))
+    boundaries = boundaries[boundaries < len(stream) - lengths.max() - 1]
+    starts = rng.choice(boundaries, n) + 1
+    return np.array(
+        [stream[s:s + k].decode("utf-8", errors="ignore") for s, k in zip(starts, lengths)], dtype=object
+    )
+
+
+def flying_frame(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Rows of the Flying Dreams Database spreadsheet."""
+    return pd.DataFrame({
+        "dream_ID": [f"fly-{i:06x}" for i in range(n)],
+        "source": rng.choice(SOURCES, n),
+        "participant_ID": rng.integers(0, max(n // 4, 1), n).astype(str),
+        "user_info": None,
+        "sex": rng.choice(np.array([1, 2, 4, "Female", "unspecified", None], dtype=object), n, p=[.3, .4, .02, .03, .05, .2]),
+        "date": pd.Timestamp("2010-01-01") + pd.to_timedelta(rng.integers(0, 5000, n), unit="D"),
+        "report_type": rng.choice([1, 2], n, p=[.85, .15]),
+        "thread_keywords": rng.choice(["flying", "lucid flying", "dream journal", None], n),
+        "dream": make_texts(n, rng),
+        "GPT_ID500": rng.random(n) < 500 / max(n, 500),
+    })
+
+
+def sddb_frame(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Rows of SDDb.csv, with a few missing answers."""
+    texts = make_texts(n, rng, median=450)
+    texts[rng.random(n) < 0.01] = None
+    return pd.DataFrame({
+        "answer_id": np.arange(n),
+        "survey": rng.choice(["Flying dreams", "Most recent dream", "Lucid dreams"], n),
+        "respondent": rng.integers(0, max(n // 3, 1), n),
+        "question": "Please describe your dream.",
+        "dream_entry_title": rng.choice(["", "Flying", "Untitled"], n),
+        "answer_text": texts,
+    })
+
+
+def dreamviews_frame(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Rows of dreamviews.tsv, including posts that are neither lucid nor non-lucid."""
+    return pd.DataFrame({
+        "post_id": rng.permutation(n * 4)[:n],
+        "user_id": rng.integers(0, max(n // 10, 1), n),
+        "lucidity": rng.choice(["lucid", "nonlucid", "ambiguous", "unspecified"], n, p=[.45, .35, .1, .1]),
+        "post_clean": make_texts(n, rng, median=900),
+    })
+
+
+def _completion(content: str, rng: np.random.Generator, finish_reason: str = "stop") -> dict:
+    """A completion in the stored format, with usage."""
+    return {
+        "id": f"chatcmpl-{rng.integers(1 << 62):x}",
+        "object": "chat.completion",
+        "created": 1700000000 + int(rng.integers(0, 10_000_000)),
+        "model": "gpt-4-0613",
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+        ],
+        "usage": {"prompt_tokens": 400, "completion_tokens": len(content) // 4 + 1, "total_tokens": 400 + len(content) // 4 + 1},
+    }
+
+
+def make_responses(texts: pd.Series, task: str, rng: np.random.Generator, invalid: float = 0.01) -> dict:
+    """
+    Completions of a task for every dream, a fraction of them malformed or truncated.
+    Annotate entities are excerpts of the text, so they align like real ones.
+    Args:
+        texts (pd.Series): Dream texts, indexed by dream ID.
+        task (str): The task (isdream, islucid, annotate or thematicX).
+        rng (np.random.Generator): Random generator.
+        invalid (float): Fraction of completions that fail parsing.
+    Returns:
+        dict: Completions keyed by dream ID.
+    """
+
+    responses = {}
+    bad = rng.random(len(texts)) < invalid
+    for (dream_id, text), is_bad in zip(texts.items(), bad):
+        if task in ["isdream", "islucid"]:
+            content = str(rng.random() < 0.6)
+        elif task.startswith("thematic"):
+            content = json.dumps({theme: bool(rng.random() < 0.2) for theme in THEMES[task[-1]]})
+        elif task == "annotate":
+            entities = []
+            for _ in range(rng.integers(0, 4)):
+                start = int(rng.integers(0, max(len(text) - 40, 1)))
+                label = str(rng.choice(["flying", "lucidity", "supplement"]))
+                entities.append({"label": label, "value": text[start:start + int(rng.integers(10, 120))]})
+            content = json.dumps({"text": text, "entities": entities})
+        if is_bad:
+            responses[dream_id] = _completion(content[: len(content) // 2], rng, "length")
+        else:
+            responses[dream_id] = _completion(content, rng)
+    return responses
+
+
+def make_liwc(dream_ids: pd.Index, dic: str, rng: np.random.Generator, nsegs: int = 1) -> pd.DataFrame:
+    """LIWC output of a dictionary, one row per dream and segment."""
+    categories = LIWC_CATEGORIES[dic]
+    n_rows = len(dream_ids) * nsegs
+    values = rng.gamma(0.6, 1.5, size=(n_rows, len(categories))).round(6)
+    df = pd.DataFrame(values, columns=categories)
+    df.insert(0, "Segment", np.tile(np.arange(1, nsegs + 1), len(dream_ids)))
+    df.insert(0, "Row ID", np.repeat(np.asarray(dream_ids), nsegs))
+    return df
+
+
+def generate(n: int, root: Path = None, seed: int = 0, overwrite: bool = False) -> dict:
+    """
+    Write all synthetic files for `n` rows per dataset, unless they exist already.
+    Args:
+        n (int): Rows per dataset (the Flying database is capped at `FLYING_MAX_ROWS`).
+        root (Path): Directory holding the synthetic data of every size.
+        seed (int): Seed of the random generator.
+        overwrite (bool): Regenerate files that exist already.
+    Returns:
+        dict: The source and derivatives directories (see `paths`).
+    """
+
+    dirs = paths(n, root)
+    for d in dirs.values():
+        d.mkdir(parents=True, exist_ok=True)
+    source, deriv = dirs["sourcedata"], dirs["derivatives"]
+    # One generator per file, so a file comes out the same whether or not the others are regenerated.
+    rngs = iter(np.random.default_rng([seed, i]) for i in range(100))
+
+    files = {
+        source / "Flying Dreams Database.xlsx": lambda p, rng: flying_frame(min(n, FLYING_MAX_ROWS), rng).to_excel(p, index=False),
+        source / "SDDb.csv": lambda p, rng: sddb_frame(n, rng).to_csv(p, index=False),
+        source / "dreamviews.tsv": lambda p, rng: dreamviews_frame(n, rng).to_csv(p, sep="\t", index=False),
+    }
+    for (path, write), rng in zip(files.items(), rngs):
+        if overwrite or not path.exists():
+            write(path, rng)
+
+    # Responses and LIWC outputs of the DreamViews dreams, keyed like `utils.load_dreamviews`.
+    dreams = None
+    for task, rng in zip(["isdream", "islucid", "annotate", "thematicT", "thematicM", "thematicD"], rngs):
+        path = deriv / f"data-dreamviews_task-{task}_responses.json"
+        if overwrite or not path.exists():
+            if dreams is None:
+                dreams = pd.read_table(source / "dreamviews.tsv", usecols=["post_id", "post_clean"])
+                dreams = dreams.set_index(dreams["post_id"].map("DV-{}".format))["post_clean"].fillna("")
+            utils.save_json(make_responses(dreams, task, rng), path, indent=None)
+    for dic, rng in zip(LIWC_CATEGORIES, rngs):
+        path = deriv / f"data-dreamviews_liwc-{dic}_nsegs-1.csv"
+        if overwrite or not path.exists():
+            dream_ids = pd.read_table(source / "dreamviews.tsv", usecols=["post_id"])["post_id"].map("DV-{}".format)
+            make_liwc(pd.Index(dream_ids), dic, rng).to_csv(path, index=False)
+    return dirs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n", nargs="+", type=int, default=[10_000], help="Rows per dataset.")
+    parser.add_argument("--root", type=Path, default=None, help="Directory of the synthetic data.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Regenerate existing files.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    for n in args.n:
+        dirs = generate(n, args.root, args.seed, args.overwrite)
+        print(f"{n} rows: {dirs['sourcedata'].parent}")
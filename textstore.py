@@ -0,0 +1,200 @@
+"""Contiguous, memory-mapped store of the cleaned dream texts of each dataset.
+
+All texts of a dataset are written once as one UTF-8 buffer, with an array of
+byte offsets and the matching dream IDs. Readers map the buffer instead of
+loading it, so every process (and every worker of a pool) shares the same
+page-cached copy of the corpus, and slices of it are taken without copying.
+
+```shell
+python textstore.py --dataset flying    #> data-flying_texts.{bin,npz}
+```
+"""
+
+import argparse
+import csv
+import mmap
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+
+
+source_files = {
+    "flying": utils.source_dir / "Flying Dreams Database.xlsx",
+    "dreamviews": utils.source_dir / "dreamviews.tsv",
+    "sddb": utils.source_dir / "SDDb.csv",
+}
+
+
+def load_texts(dataset: str) -> pd.Series:
+    """Load the cleaned texts of a dataset (all Flying reports, not only dreams)."""
+    if dataset == "flying":
+        df = utils.load_sourcedata(dreams_only=False)
+    elif dataset == "dreamviews":
+        df = utils.load_dreamviews()
+    elif dataset == "sddb":
+        df = utils.load_sddb()
+    return df["dream_text"]
+
+
+class TextStore:
+    """
+    Read-only view of a dataset's texts stored in a contiguous UTF-8 buffer.
+    Text i occupies bytes `offsets[i]:offsets[i + 1]` of the buffer. The buffer
+    is mapped on first access, and pickling a store only sends its offsets and
+    dream IDs, so worker processes re-map the same file rather than receiving a copy.
+    Args:
+        dataset (str): The dataset name used in the file names.
+        offsets (np.ndarray): Byte offset of each text (length len(dream_ids) + 1).
+        dream_ids (pd.Index): Dream ID of each text.
+    """
+
+    def __init__(self, dataset: str, offsets: np.ndarray, dream_ids: pd.Index):
+        self.dataset = dataset
+        self.offsets = offsets
+        self.dream_ids = pd.Index(dream_ids, name="dream_id")
+        self._mmap = None
+
+    @staticmethod
+    def paths(dataset: str) -> dict:
+        """Return the paths of the text buffer and of its offsets and dream IDs."""
+        return {
+            "buffer": utils.deriv_dir / f"data-{dataset}_texts.bin",
+            "index": utils.deriv_dir / f"data-{dataset}_texts.npz",
+        }
+
+    @classmethod
+    def write(cls, texts: pd.Series, dataset: str):
+        """
+        Write texts to a dataset's store, replacing any previous one.
+        Args:
+            texts (pd.Series): The texts, indexed by dream ID.
+            dataset (str): The dataset name used in the file names.
+        Returns:
+            TextStore: The new store.
+        """
+        paths = cls.paths(dataset)
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # Write to temporary files first so readers never see a half-written store.
+        tmp_buffer = paths["buffer"].with_suffix(".bin.tmp")
+        tmp_index = paths["index"].with_suffix(".tmp.npz")
+        with open(tmp_buffer, "wb") as f:
+            f.write(b"".join(encoded))
+        np.savez(tmp_index, offsets=offsets, dream_ids=texts.index.to_numpy(str))
+        tmp_buffer.replace(paths["buffer"])
+        tmp_index.replace(paths["index"])
+        return cls(dataset, offsets, texts.index)
+
+    @classmethod
+    @profiling.stage("save", "text store")
+    def build(cls, dataset: str):
+        """Load a dataset's texts from the source data and write them to its store."""
+        return cls.write(load_texts(dataset), dataset)
+
+    @classmethod
+    def load(cls, dataset: str, rebuild: bool = False):
+        """
+        Open a dataset's store, building it first if missing or older than the source data.
+        Args:
+            dataset (str): The dataset to open the store of.
+            rebuild (bool): If True, rebuild even when the store is current.
+        Returns:
+            TextStore: The opened store.
+        """
+        paths = cls.paths(dataset)
+        source = source_files[dataset]
+        if (
+            rebuild
+            or not all(p.exists() for p in paths.values())
+            or (
+                source.exists()
+                and min(p.stat().st_mtime for p in paths.values()) < source.stat().st_mtime
+            )
+        ):
+            return cls.build(dataset)
+        with np.load(paths["index"]) as npz:
+            return cls(dataset, npz["offsets"], npz["dream_ids"])
+
+    @property
+    def buffer(self):
+        """The mapped buffer (mapped on first access)."""
+        if self._mmap is None:
+            if self.offsets[-1] == 0:
+                self._mmap = b""  # Empty files cannot be mapped.
+            else:
+                with open(self.paths(self.dataset)["buffer"], "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self) -> None:
+        """Unmap the buffer (it is mapped again on next access)."""
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = None
+
+    def __getstate__(self):
+        return {"dataset": self.dataset, "offsets": self.offsets, "dream_ids": self.dream_ids}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self) -> int:
+        return len(self.dream_ids)
+
+    def __contains__(self, dream_id) -> bool:
+        return dream_id in self.dream_ids
+
+    def locate(self, dream_ids) -> np.ndarray:
+        """Row numbers of dream IDs in the store (KeyError if any is missing)."""
+        rows = self.dream_ids.get_indexer(pd.Index(dream_ids))
+        if (rows < 0).any():
+            missing = pd.Index(dream_ids)[rows < 0]
+            raise KeyError(f"{len(missing)} dream IDs not in the {self.dataset} store, e.g. {missing[0]}")
+        return rows
+
+    def view(self, dream_id) -> memoryview:
+        """The UTF-8 bytes of one text, as a zero-copy slice of the buffer."""
+        i = self.dream_ids.get_loc(dream_id)
+        return memoryview(self.buffer)[self.offsets[i] : self.offsets[i + 1]]
+
+    def __getitem__(self, dream_id) -> str:
+        return str(self.view(dream_id), "utf-8")
+
+    def as_array(self) -> np.ndarray:
+        """The whole buffer as a read-only uint8 array (no copy)."""
+        return np.frombuffer(self.buffer, dtype=np.uint8)
+
+    def items(self, dream_ids=None):
+        """Iterate over (dream ID, text) pairs, in store order or for the given dream IDs."""
+        rows = np.arange(len(self)) if dream_ids is None else self.locate(dream_ids)
+        buffer = memoryview(self.buffer)
+        for i in rows:
+            yield self.dream_ids[i], str(buffer[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+    def to_series(self, dream_ids=None) -> pd.Series:
+        """Decode texts into a Series indexed by dream ID (this copies them)."""
+        dream_ids = self.dream_ids if dream_ids is None else pd.Index(dream_ids, name="dream_id")
+        texts = [text for _, text in self.items(dream_ids)]
+        return pd.Series(texts, index=dream_ids, name="dream_text", dtype=object)
+
+    def to_csv(self, filepath, dream_ids=None) -> None:
+        """Stream texts to a two-column (dream_id, dream_text) CSV file, one row at a time."""
+        with open(filepath, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["dream_id", "dream_text"])
+            writer.writerows(self.items(dream_ids))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", required=True, type=str, choices=list(source_files))
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    store = TextStore.build(args.dataset)
+    print(f"Stored {len(store)} texts ({store.offsets[-1] / 2**20:.1f} MiB).")
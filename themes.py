@@ -0,0 +1,322 @@
+"""Theme codes from the thematic tasks as one bit-packed dream x theme matrix.
+
+```shell
+python themes.py --dataset flying    #> data-flying_themes-associations.csv
+```
+"""
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import profiling
+import utils
+
+
+# Themes of each thematic task (T: techniques, M: motivations, D: difficulties),
+# mapped to the short names used in figures. Order follows the prompts.
+THEMES = {
+    "T": {
+        "wings": "wings",
+        "hovering/levitation": "hovering",
+        "running": "running",
+        "swimming-like movements": "swimming",
+        "spinning/rotation": "spinning",
+        "wind": "wind",
+        "falling forward/launching from a high place": "falling",
+        "focus/concentration": "focus",
+        "jetpacks/rockets/suits": "jetpacks",
+        "balloons": "balloons",
+        "breath-related flying": "breath",
+        "jumping/bouncing": "jumping",
+        "sorcery": "sorcery",
+        "flying objects": "objects",
+        "flying beings": "beings",
+        "flying vehicles": "vehicules",
+        "transformation": "transformation",
+        "climbing/stepping in the air": "climbing",
+        "superhero": "superhero",
+        "unspecified": "unspecified",
+    },
+    "M": {
+        "in response to fear": "fear",
+        "enjoyment": "fun",
+        "learning/practice": "learning",
+        "mean of transportation": "transport",
+        "involuntary flight": "unvoluntary",
+        "elicit a reaction in other people": "elicit reaction",
+        "helping/saving others": "helping",
+        "reality check": "rc",
+        "unspecified": "not specified",
+    },
+    "D": {
+        "bodily/physical limitations": "body",
+        "environmental constraints": "environment",
+        "fear/anxiety": "fear",
+        "lack of belief": "belief",
+        "lack of focus": "focus",
+        "waking up": "wake",
+        "technical failure": "tech",
+        "other beings": "beings",
+        "gravity/crash/falling": "crash",
+        "restricted speed/altitude": "slow",
+        "inability to initiate flight": "inability",
+        "no obstacles": "no obstacles",
+    },
+}
+
+
+@profiling.stage("parse", "theme completions")
+def parse_theme_completions(completions: dict, themes: list) -> tuple[pd.DataFrame, int]:
+    """
+    Parse thematic completions into a boolean dream x theme DataFrame.
+    Completions that do not follow the expected response format are skipped.
+    Args:
+        completions (dict): ChatGPT completions, keyed by dream ID.
+        themes (list): The themes the prompt asked about.
+    Returns:
+        tuple[pd.DataFrame, int]: Boolean codes (dreams x themes) and the number
+            of completions that could not be parsed.
+    """
+
+    results = {}
+    badcounts = 0
+    for dream_id, completion in completions.items():
+        try:
+            choices = completion["choices"]
+            assert len(choices) == 1, "Expected only 1 response from ChatGPT."
+            choice = choices[0]
+            assert choice["finish_reason"] == "stop", "Expected stop as the finish reason."
+            content = choice["message"]["content"]
+            assert content.startswith("{") and content.endswith("}"), "Expected JSON output."
+            ann = json.loads(content)
+            # Sometimes ChatGPT adds an extra theme, so remove it (ITS SO RARE, like once?)
+            ann = {k: v for k, v in ann.items() if k in themes}
+            assert len(ann.keys()) == len(themes)
+            assert all(isinstance(v, bool) for v in ann.values())
+        except Exception:
+            badcounts += 1
+            continue
+        results[dream_id] = ann
+    codes = (
+        pd.DataFrame.from_dict(results, orient="index", columns=themes)
+        .rename_axis("dream_id")
+        .astype(bool)
+    )
+    return codes, badcounts
+
+
+class ThemeMatrix:
+    """
+    Bit-packed boolean matrix of theme codes across thematic task families.
+    Each dream is one row of `bits`, with one bit per (family, theme) column.
+    A dream whose response of a family could not be parsed has no codes for
+    that family (its bits are 0 and `valid` is False there).
+    Args:
+        bits (np.ndarray): Packed uint8 array of shape (dreams, ceil(themes / 8)).
+        dream_ids (pd.Index): The dream IDs of the rows.
+        columns (pd.MultiIndex): The (family, theme) of each column, using short names.
+        valid (np.ndarray): Boolean array of shape (dreams, families), in the
+            order of the families in `columns` (default: all valid).
+    """
+
+    def __init__(self, bits: np.ndarray, dream_ids: pd.Index, columns: pd.MultiIndex, valid: np.ndarray = None):
+        self.bits = bits
+        self.dream_ids = pd.Index(dream_ids, name="dream_id")
+        self.columns = columns
+        self.families = columns.get_level_values("family").unique().tolist()
+        self.valid = np.ones((len(self.dream_ids), len(self.families)), dtype=bool) if valid is None else valid
+
+    @classmethod
+    def from_frame(cls, codes: pd.DataFrame):
+        """Pack a boolean DataFrame with (family, theme) columns, where missing codes mark invalid families."""
+        families = codes.columns.get_level_values("family").unique()
+        valid = np.stack([codes[family].notna().all(axis=1).to_numpy() for family in families], axis=1)
+        bits = np.packbits(codes.fillna(False).to_numpy(dtype=bool), axis=1)
+        return cls(bits, codes.index, codes.columns, valid.reshape(len(codes), len(families)))
+
+    @classmethod
+    def build(cls, dataset: str = "flying", families: str = "TMD", verbose: bool = True):
+        """
+        Load the thematic responses of every family and save the packed matrix.
+        Families without a responses file are skipped. Every dream that was
+        successfully coded in at least one family is kept, with its validity
+        per family.
+        Raises:
+            FileNotFoundError: If no family has a responses file.
+        """
+        frames = {}
+        for family in families:
+            import_path = utils.deriv_dir / f"data-{dataset}_task-thematic{family}_responses.json"
+            if not import_path.exists():
+                continue
+            codes, badcounts = parse_theme_completions(
+                utils.load_json(import_path), list(THEMES[family])
+            )
+            if verbose:
+                print(f"thematic{family}: {badcounts} responses could not be parsed.")
+            frames[family] = codes.rename(columns=THEMES[family])
+        if not frames:
+            raise FileNotFoundError(f"No thematic responses of {dataset} in {utils.deriv_dir}.")
+        codes = pd.concat(frames, axis=1, join="outer", names=["family", "theme"])
+        matrix = cls.from_frame(codes)
+        np.savez(
+            cls.path(dataset),
+            bits=matrix.bits,
+            valid=matrix.valid,
+            dream_ids=matrix.dream_ids.to_numpy(str),
+            families=codes.columns.get_level_values("family").to_numpy(str),
+            themes=codes.columns.get_level_values("theme").to_numpy(str),
+        )
+        return matrix
+
+    @staticmethod
+    def path(dataset: str):
+        """Return the path of the saved theme matrix."""
+        return utils.deriv_dir / f"data-{dataset}_themes.npz"
+
+    @classmethod
+    def load(cls, dataset: str = "flying", rebuild: bool = False):
+        """Load the saved theme matrix, building it if missing or older than any responses."""
+        path = cls.path(dataset)
+        responses = [
+            utils.deriv_dir / f"data-{dataset}_task-thematic{family}_responses.json"
+            for family in THEMES
+        ]
+        if (
+            rebuild
+            or not path.exists()
+            or any(p.exists() and p.stat().st_mtime > path.stat().st_mtime for p in responses)
+        ):
+            return cls.build(dataset)
+        with np.load(path) as npz:
+            columns = pd.MultiIndex.from_arrays(
+                [npz["families"].tolist(), npz["themes"].tolist()], names=["family", "theme"]
+            )
+            valid = npz["valid"] if "valid" in npz else None
+            return cls(npz["bits"], npz["dream_ids"].tolist(), columns, valid)
+
+    def unpack(self, dtype=np.uint8) -> np.ndarray:
+        """Return the unpacked (dreams x themes) matrix."""
+        return np.unpackbits(self.bits, axis=1, count=len(self.columns)).astype(dtype, copy=False)
+
+    def complete(self) -> np.ndarray:
+        """Boolean mask of the dreams coded in every family."""
+        return self.valid.all(axis=1)
+
+    def to_frame(self, family: str = None) -> pd.DataFrame:
+        """
+        Return the codes as an int DataFrame.
+        Args:
+            family (str): If given, only this family's codes, for every dream
+                coded in it. Otherwise all codes of the dreams coded in every family.
+        """
+        frame = pd.DataFrame(self.unpack(int), index=self.dream_ids, columns=self.columns)
+        if family is None:
+            return frame[self.complete()]
+        return frame[family][self.valid[:, self.families.index(family)]]
+
+    def prevalence(self) -> pd.Series:
+        """Fraction of dreams coded with each theme, among the dreams coded in its family."""
+        family = [self.families.index(f) for f in self.columns.get_level_values("family")]
+        valid = self.valid[:, family]
+        return pd.Series((self.unpack(np.float64) * valid).sum(axis=0) / valid.sum(axis=0), index=self.columns)
+
+    def cooccurrence(self) -> pd.DataFrame:
+        """Number of dreams coded with both themes, for every pair of themes (dreams coded in every family)."""
+        x = self.unpack(np.float64)[self.complete()]
+        counts = (x.T @ x).astype(np.int64)
+        return pd.DataFrame(counts, index=self.columns, columns=self.columns)
+
+    def associations(self) -> pd.DataFrame:
+        """
+        Association statistics for every pair of themes, within and across families.
+        All 2x2 tables are derived from a single co-occurrence matrix product
+        over the dreams coded in every family.
+        Returns:
+            pd.DataFrame: One row per pair of themes with the co-occurrence count,
+                lift, phi coefficient, chi-square statistic and p-value.
+        """
+        x = self.unpack(np.float64)[self.complete()]
+        n = x.shape[0]
+        n11 = x.T @ x
+        totals = np.diag(n11)
+        row, col = np.triu_indices(len(self.columns), k=1)
+        table = contingency_stats(n11[row, col], totals[row], totals[col], n)
+        a = self.columns[row].to_frame(index=False).add_suffix("_a")
+        b = self.columns[col].to_frame(index=False).add_suffix("_b")
+        return pd.concat([a, b, table], axis=1)
+
+    def against(self, groups: pd.Series) -> pd.DataFrame:
+        """
+        Prevalence of every theme within each group, with a chi-square test per theme.
+        Args:
+            groups (pd.Series): Group of each dream (e.g., lucidity or source_id),
+                indexed by dream ID. Dreams without a group, or not coded in
+                every family, are left out.
+        Returns:
+            pd.DataFrame: One row per theme with the prevalence in each group and
+                the chi-square statistic, degrees of freedom and p-value of the
+                theme x group contingency table.
+        """
+        groups = groups[~groups.index.duplicated()].reindex(self.dream_ids)
+        keep = groups.notna().to_numpy() & self.complete()
+        dummies = pd.get_dummies(groups[keep])
+        onehot = dummies.to_numpy(np.float64)
+        x = self.unpack(np.float64)[keep]
+        present = x.T @ onehot  # themes x groups
+        sizes = onehot.sum(axis=0)
+        observed = np.stack([present, sizes - present])  # (present/absent) x themes x groups
+        expected = observed.sum(axis=2, keepdims=True) * sizes / sizes.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chi2 = np.nansum((observed - expected) ** 2 / expected, axis=(0, 2))
+        dof = sizes.size - 1
+        result = pd.DataFrame(present / sizes, index=self.columns, columns=dummies.columns)
+        result["chi2"] = chi2
+        result["dof"] = dof
+        result["p"] = stats.chi2.sf(chi2, dof)
+        return result
+
+
+def contingency_stats(n11, n1_, n_1, n) -> pd.DataFrame:
+    """
+    Vectorized statistics of 2x2 contingency tables given their margins.
+    Args:
+        n11 (array-like): Number of dreams with both themes.
+        n1_ (array-like): Number of dreams with the first theme.
+        n_1 (array-like): Number of dreams with the second theme.
+        n (int): Total number of dreams.
+    Returns:
+        pd.DataFrame: The count, lift, phi coefficient, chi-square and p-value of each table.
+    """
+
+    n11, n1_, n_1 = (np.asarray(v, dtype=np.float64) for v in (n11, n1_, n_1))
+    n10, n01 = n1_ - n11, n_1 - n11
+    n00 = n - n11 - n10 - n01
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lift = n11 * n / (n1_ * n_1)
+        phi = (n11 * n00 - n10 * n01) / np.sqrt(n1_ * n_1 * (n - n1_) * (n - n_1))
+    chi2 = n * phi**2
+    return pd.DataFrame({
+        "n": n11.astype(np.int64),
+        "lift": lift,
+        "phi": phi,
+        "chi2": chi2,
+        "p": stats.chi2.sf(chi2, 1),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", type=str, default="flying", choices=["flying"])
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    matrix = ThemeMatrix.load(args.dataset, rebuild=True)
+    associations = matrix.associations().sort_values("p")
+    export_path = utils.deriv_dir / f"data-{args.dataset}_themes-associations.csv"
+    associations.to_csv(export_path, index=False)
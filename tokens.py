@@ -0,0 +1,203 @@
+"""Tokenize every dream once and store the token IDs for all downstream consumers.
+
+Texts from the text store are split into lowercase word tokens, mapped to
+integer IDs of a sorted vocabulary, and saved as a ragged array (one flat
+array of token IDs plus per-dream offsets). Search, near-duplicate detection
+and token counting read these arrays instead of re-tokenizing the text.
+
+Stores are versioned by the tokenizer rules: changing `TOKENIZER` writes to a
+new directory instead of mixing incompatible token IDs with old ones.
+
+```shell
+python tokens.py --dataset flying    #> data-flying_tokens-<version>/
+python tokens.py --dataset all       # All three datasets
+```
+"""
+
+import argparse
+import hashlib
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import utils
+from textstore import TextStore, source_files
+
+
+TOKENIZER = {"pattern": r"[a-z0-9']+", "lowercase": True}
+TOKENIZER_VERSION = hashlib.sha256(json.dumps(TOKENIZER, sort_keys=True).encode()).hexdigest()[:8]
+
+TOKEN_PATTERN = re.compile(TOKENIZER["pattern"])
+
+ARRAYS = ["vocab", "offsets", "ids", "dream_ids", "hashes"]
+
+
+def tokenize(text: str) -> list:
+    """Split a text into word tokens following `TOKENIZER`."""
+    if TOKENIZER["lowercase"]:
+        text = text.lower()
+    return TOKEN_PATTERN.findall(text)
+
+
+class TokenStore:
+    """
+    Token IDs of a collection of texts, as a ragged array.
+    The tokens of dream i are `vocab[ids[offsets[i]:offsets[i + 1]]]`.
+    Args:
+        vocab (np.ndarray): Sorted array of unique tokens.
+        offsets (np.ndarray): Start of each dream's tokens (length len(dream_ids) + 1).
+        ids (np.ndarray): Concatenated token IDs (uint32) of all dreams.
+        dream_ids (np.ndarray): Dream ID of each dream.
+        hashes (np.ndarray): Hash of the text each dream was tokenized from.
+    """
+
+    def __init__(self, vocab, offsets, ids, dream_ids, hashes):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.ids = ids
+        self.dream_ids = dream_ids
+        self.hashes = hashes
+
+    @staticmethod
+    def path(dataset: str):
+        """Directory of a dataset's token arrays for the current tokenizer version."""
+        return utils.deriv_dir / f"data-{dataset}_tokens-{TOKENIZER_VERSION}"
+
+    @classmethod
+    @profiling.stage("compute", "tokenize")
+    def build(cls, texts: pd.Series):
+        """Tokenize texts (a Series indexed by dream ID)."""
+        tokens = [tokenize(text) for text in texts]
+        counts = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        flat = np.concatenate([np.asarray(t, dtype=object) for t in tokens] + [np.empty(0, dtype=object)])
+        codes, vocab = pd.factorize(flat, sort=True)
+        return cls(
+            np.asarray(vocab, dtype=str),
+            np.concatenate([[0], np.cumsum(counts)]),
+            codes.astype(np.uint32),
+            texts.index.to_numpy(str),
+            utils.hash_rows(texts).to_numpy(str),
+        )
+
+    @profiling.stage("compute", "tokenize")
+    def update(self, texts: pd.Series):
+        """
+        Bring the store in line with `texts`, tokenizing only new or edited dreams.
+        Args:
+            texts (pd.Series): The current texts, indexed by dream ID.
+        Returns:
+            tuple[TokenStore, int]: The updated store (in the order of `texts`)
+                and the number of dreams that were tokenized.
+        """
+        hashes = utils.hash_rows(texts)
+        old = pd.Series(np.arange(len(self.dream_ids)), index=self.dream_ids)
+        rows = old.reindex(texts.index).fillna(-1).to_numpy(np.int64)
+        reuse = rows >= 0
+        reuse[reuse] = self.hashes[rows[reuse]] == hashes.to_numpy()[reuse]
+        new = TokenStore.build(texts[~reuse])
+        merged = TokenStore.concat([self.take(self.dream_ids[rows[reuse]]), new])
+        return merged.take(texts.index), int((~reuse).sum())
+
+    def save(self, dataset: str) -> None:
+        """Save the arrays as .npy files in the dataset's token directory."""
+        path = self.path(dataset)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        utils.save_json(TOKENIZER | {"version": TOKENIZER_VERSION}, path / "tokenizer.json")
+
+    @classmethod
+    def load(cls, dataset: str, rebuild: bool = False):
+        """
+        Load a dataset's tokens, (re)tokenizing only what changed in its text store.
+        The flat token IDs and offsets are memory-mapped, so processes reading
+        the same store share one copy.
+        Args:
+            dataset (str): The dataset to load the tokens of.
+            rebuild (bool): If True, tokenize every text again.
+        Returns:
+            TokenStore: The dataset's tokens, in text store order.
+        """
+        path = cls.path(dataset)
+        texts = TextStore.load(dataset)
+        exists = all((path / f"{name}.npy").exists() for name in ARRAYS)
+        if exists and not rebuild:
+            if (path / "ids.npy").stat().st_mtime >= TextStore.paths(dataset)["buffer"].stat().st_mtime:
+                return cls(*(np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS))
+            store, _ = cls(*(np.load(path / f"{name}.npy") for name in ARRAYS)).update(texts.to_series())
+        else:
+            store = cls.build(texts.to_series())
+        store.save(dataset)
+        return store
+
+    @classmethod
+    def concat(cls, stores: list):
+        """Concatenate stores, merging their vocabularies."""
+        vocab = np.unique(np.concatenate([s.vocab for s in stores]))
+        return cls(
+            vocab,
+            np.concatenate([[0], np.cumsum(np.concatenate([s.lengths() for s in stores]))]),
+            np.concatenate([np.searchsorted(vocab, s.vocab).astype(np.uint32)[s.ids] for s in stores]),
+            np.concatenate([s.dream_ids for s in stores]),
+            np.concatenate([s.hashes for s in stores]),
+        )
+
+    def take(self, dream_ids):
+        """A store with only the given dreams, in the given order (the vocabulary is kept)."""
+        rows = pd.Index(self.dream_ids).get_indexer(pd.Index(dream_ids))
+        if (rows < 0).any():
+            raise KeyError(f"{int((rows < 0).sum())} dream IDs have no tokens.")
+        lengths = self.lengths()[rows]
+        starts = np.repeat(self.offsets[rows], lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return TokenStore(
+            self.vocab,
+            np.concatenate([[0], np.cumsum(lengths)]),
+            np.asarray(self.ids)[starts + within],
+            np.asarray(self.dream_ids)[rows],
+            np.asarray(self.hashes)[rows],
+        )
+
+    def __len__(self) -> int:
+        return len(self.dream_ids)
+
+    def lengths(self) -> np.ndarray:
+        """Number of tokens of every dream."""
+        return np.diff(self.offsets)
+
+    def docs(self) -> np.ndarray:
+        """Dream (row number) of every token in `ids`."""
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.lengths())
+
+    def positions(self) -> np.ndarray:
+        """Position within its dream of every token in `ids`."""
+        lengths = self.lengths()
+        return (np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], lengths)).astype(np.int32)
+
+    def tokens(self, i: int) -> list:
+        """The tokens of the i-th dream as strings."""
+        return self.vocab[self.ids[self.offsets[i] : self.offsets[i + 1]]].tolist()
+
+
+def load_all(rebuild: bool = False) -> TokenStore:
+    """Load the tokens of the Flying, DreamViews and SDDb datasets as one store."""
+    return TokenStore.concat([TokenStore.load(dataset, rebuild=rebuild) for dataset in source_files])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d", "--dataset", required=True, type=str, choices=[*source_files, "all"]
+    )
+    parser.add_argument("-r", "--rebuild", action="store_true", help="Tokenize every text again.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+
+    datasets = list(source_files) if args.dataset == "all" else [args.dataset]
+    for dataset in datasets:
+        store = TokenStore.load(dataset, rebuild=args.rebuild)
+        print(f"{dataset}: {len(store)} dreams, {store.offsets[-1]} tokens, {store.vocab.size} types")
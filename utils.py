@@ -1,6 +1,9 @@
 """Utility functions."""
 
+import hashlib
 import json
+import os
+import threading
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -8,6 +11,8 @@ import pandas as pd
 import unidecode
 import yaml
 
+from profiling import stage
+
 
 SOURCE_DIR = "../sourcedata"
 DERIV_DIR = "../derivatives"
@@ -15,6 +20,24 @@ DERIV_DIR = "../derivatives"
 source_dir = Path(SOURCE_DIR).expanduser()
 deriv_dir = Path(DERIV_DIR).expanduser()
 
+# The spreadsheet and columns that the Flying manifest records.
+FLYING_FILE = "Flying Dreams Database.xlsx"
+FLYING_COLUMNS = [
+    "dream_ID",
+    "source",
+    "participant_ID",
+    # "user_info",
+    "sex",
+    "date",
+    "report_type",
+    "thread_keywords",
+    "dream",
+    "GPT_ID500",
+]
+
+# Serializes manifest updates of concurrent loads (see loaders.py).
+_manifest_lock = threading.Lock()
+
 colors = {
     "dream": "#1E71B5",
     "comment": "gainsboro",
@@ -48,17 +71,18 @@ def load_gpt_lucidity_codes(dataset: str) -> pd.Series:
     assert dataset in ["dreamviews", "flying", "sddb"]
     responses = {}
     completions = load_json(deriv_dir / f"data-{dataset}_task-islucid_responses.json")
-    for dream_id, completion in completions.items():
-        responses[dream_id] = [
-            choice["message"]["content"] for choice in completion["choices"]
-        ]
-    ser = (
-        pd.Series(responses)
-        .explode()
-        .rename("lucidity")
-        .rename_axis("dream_id")
-        .map({"True": "lucid", "False": "non-lucid"})
-    )
+    with stage("parse", f"{dataset} lucidity codes"):
+        for dream_id, completion in completions.items():
+            responses[dream_id] = [
+                choice["message"]["content"] for choice in completion["choices"]
+            ]
+        ser = (
+            pd.Series(responses)
+            .explode()
+            .rename("lucidity")
+            .rename_axis("dream_id")
+            .map({"True": "lucid", "False": "non-lucid"})
+        )
     return ser
 
 
@@ -89,11 +113,12 @@ def clean_dream_column(ser: pd.Series) -> pd.Series:
         pd.Series: A pandas Series with the cleaned text data.
     """
     
-    return (
-        ser.apply(unidecode.unidecode, errors="ignore", replace_str=None)
-        .str.replace('"', "'")
-        .str.strip()
-    )
+    with stage("clean", "dream text"):
+        return (
+            ser.apply(unidecode.unidecode, errors="ignore", replace_str=None)
+            .str.replace('"', "'")
+            .str.strip()
+        )
 
 
 def load_dreamviews() -> pd.DataFrame:
@@ -114,7 +139,8 @@ def load_dreamviews() -> pd.DataFrame:
     """
     
     import_path = source_dir / "dreamviews.tsv"
-    df = pd.read_table(import_path)
+    with stage("load", import_path.name):
+        df = pd.read_table(import_path)
     df = df[df["lucidity"].isin(["lucid", "nonlucid"])]
     df = (
         df.rename(columns={"post_id": "dream_id", "post_clean": "dream_text"})
@@ -143,15 +169,16 @@ def load_sddb() -> pd.DataFrame:
     """
     
     import_path = source_dir / "SDDb.csv"
-    df = (
-        pd.read_csv(
-            import_path,
-            usecols=["answer_text", "dream_entry_title", "respondent", "survey"],
-            low_memory=False,
+    with stage("load", import_path.name):
+        df = (
+            pd.read_csv(
+                import_path,
+                usecols=["answer_text", "dream_entry_title", "respondent", "survey"],
+                low_memory=False,
+            )
+            .rename(columns={"answer_text": "dream_text"})
+            .dropna(subset="dream_text")
         )
-        .rename(columns={"answer_text": "dream_text"})
-        .dropna(subset="dream_text")
-    )
     df.index = pd.Index([f"SDDB-{x:06d}" for x in range(len(df))], name="dream_id")
     df.loc[:, "dream_text"] = clean_dream_column(df["dream_text"])
     return remove_short_and_long_dreams(df)
@@ -159,20 +186,10 @@ def load_sddb() -> pd.DataFrame:
 
 def load_sourcedata(
     dreams_only: bool,
-    name: str = "Flying Dreams Database.xlsx",
+    name: str = FLYING_FILE,
     index_col: str = "dream_ID",
-    usecols: list = [
-        "dream_ID",
-        "source",
-        "participant_ID",
-        # "user_info",
-        "sex",
-        "date",
-        "report_type",
-        "thread_keywords",
-        "dream",
-        "GPT_ID500",
-    ],
+    usecols: list = FLYING_COLUMNS,
+    record_manifest: bool = True,
     **kwargs,
 ) -> pd.DataFrame:
     """
@@ -182,16 +199,18 @@ def load_sourcedata(
     - name (str): The name of the Excel file to load. Default is "Flying Dreams Database.xlsx".
     - index_col (str): The column to use as the index. Default is "dream_ID".
     - usecols (list): List of columns to use from the Excel file. Default includes specific columns.
+    - record_manifest (bool): If True, record per-dream hashes of all reports (see `update_manifest`).
+      Only loads of the default file and columns, without extra arguments, are recorded.
     - **kwargs: Additional keyword arguments to pass to `pd.read_excel`.
     Returns:
     - pd.DataFrame: A DataFrame containing the preprocessed dream data.
     """
 
     filepath = source_dir / name
+    with stage("load", name):
+        df = pd.read_excel(filepath, index_col=index_col, usecols=usecols, **kwargs)
     df = (
-        pd.read_excel(filepath, index_col=index_col, usecols=usecols, **kwargs)[
-            usecols[1:]
-        ]
+        df[usecols[1:]]
         .rename(
             columns={
                 "thread_keywords": "title",
@@ -282,10 +301,98 @@ def load_sourcedata(
         .dropna(subset="dream_text")
         .rename_axis("dream_id")
     )
+    df.loc[:, "dream_text"] = clean_dream_column(df["dream_text"])
+    df = remove_short_and_long_dreams(df)
+    if record_manifest and name == FLYING_FILE and list(usecols) == FLYING_COLUMNS and not kwargs:
+        update_manifest(df, dataset="flying")
     if dreams_only:
         df = df.query("report_type=='dream'")
-    df.loc[:, "dream_text"] = clean_dream_column(df["dream_text"])
-    return remove_short_and_long_dreams(df)
+    return df
+
+
+def hash_rows(df: pd.DataFrame) -> pd.Series:
+    """Return a 64-bit hex digest of every row (or value) that is stable across runs."""
+    return pd.util.hash_pandas_object(df, index=False).map("{:016x}".format)
+
+
+def manifest_paths(dataset: str) -> tuple[Path, Path]:
+    """Return the paths of the current and previous manifest of a dataset."""
+    return (
+        deriv_dir / f"data-{dataset}_manifest.json",
+        deriv_dir / f"data-{dataset}_manifest-previous.json",
+    )
+
+
+def update_manifest(df: pd.DataFrame, dataset: str) -> None:
+    """
+    Record a hash of the text and of the metadata of every dream.
+    If the hashes differ from the current manifest, the current manifest is
+    kept as the previous one so the two can be compared (see `diff_manifests`).
+    Updates are serialized between threads, and the new manifest is written to
+    a temporary file first, so readers never see a partial one.
+    Args:
+        df (pd.DataFrame): The cleaned dataset, indexed by dream ID.
+        dataset (str): The dataset name used in the manifest file names.
+    """
+
+    current_path, previous_path = manifest_paths(dataset)
+    manifest = {
+        "text": hash_rows(df["dream_text"]).to_dict(),
+        "meta": hash_rows(df.drop(columns="dream_text").astype(str)).to_dict(),
+    }
+    with _manifest_lock:
+        if current_path.exists():
+            current = load_json(current_path)
+            if current == manifest:
+                return
+            os.replace(current_path, previous_path)
+        current_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = current_path.with_name(f"{current_path.name}.{os.getpid()}.tmp")
+        save_json(manifest, temp_path, indent=None)
+        os.replace(temp_path, current_path)
+
+
+def diff_manifests(old: dict, new: dict) -> dict:
+    """
+    Compare two manifests.
+    Args:
+        old (dict): The older manifest.
+        new (dict): The newer manifest.
+    Returns:
+        dict: Sorted lists of "added", "removed", "modified" (text changed) and
+            "metadata" (only metadata changed) dream IDs.
+    """
+
+    old_ids, new_ids = set(old["text"]), set(new["text"])
+    common = old_ids & new_ids
+    modified = {i for i in common if old["text"][i] != new["text"][i]}
+    metadata = {i for i in common - modified if old["meta"][i] != new["meta"][i]}
+    return {
+        "added": sorted(new_ids - old_ids),
+        "removed": sorted(old_ids - new_ids),
+        "modified": sorted(modified),
+        "metadata": sorted(metadata),
+    }
+
+
+def load_liwc(dataset: str, dic: str, nsegs: int = 1) -> pd.DataFrame:
+    """
+    Load a LIWC output file (see liwc_request.py).
+    Args:
+        dataset (str): The dataset.
+        dic (str): The dictionary ID, e.g. "22" or "vestibular".
+        nsegs (int): The number of segments per dream.
+    Returns:
+        pd.DataFrame: The LIWC scores, indexed by dream_id and Segment.
+    """
+
+    import_path = deriv_dir / f"data-{dataset}_liwc-{dic}_nsegs-{nsegs}.csv"
+    with stage("load", import_path.name):
+        return (
+            pd.read_csv(import_path)
+            .rename(columns={"Row ID": "dream_id"})
+            .set_index(["dream_id", "Segment"])
+        )
 
 
 def load_config() -> dict:
@@ -296,17 +403,29 @@ def load_config() -> dict:
 
 def load_json(filepath: str) -> dict:
     """Load JSON file as a dictionary."""
-    with open(filepath, "r", encoding="utf-8") as f:
+    with stage("load", Path(filepath).name), open(filepath, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
 def save_json(obj: dict, filepath: str, mode: str = "wt", **kwargs) -> None:
     """Save a dictionary as a JSON file."""
     kwargs = {"indent": 4, "sort_keys": False, "ensure_ascii": True} | kwargs
-    with open(filepath, mode, encoding="utf-8") as f:
+    with stage("save", Path(filepath).name), open(filepath, mode, encoding="utf-8") as f:
         json.dump(obj, f, **kwargs)
 
 
+def hash_file(filepath: str, chunk_size: int = 2**20) -> str:
+    """Return the SHA-256 hex digest of a file's content (None if it does not exist)."""
+    filepath = Path(filepath)
+    if not filepath.exists():
+        return None
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def load_txt(filepath: str) -> str:
     """Load a raw text file as a string."""
     with open(filepath, "r", encoding="utf-8") as f:
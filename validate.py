@@ -0,0 +1,220 @@
+"""Check stored ChatGPT completions against each task's expected format.
+
+Failing dream IDs are written to a repair queue that `gpt_request.py --repair`
+re-requests, leaving every valid response untouched.
+
+```shell
+python validate.py --dataset flying --task annotate    #> data-flying_task-annotate_repair.json
+python validate.py --dataset flying --task islucid --choices 5    #> data-flying_task-islucid_choices-5_repair.json
+python validate.py --all                               # Every responses file
+```
+"""
+
+import argparse
+import json
+import re
+
+import pandas as pd
+
+import profiling
+import utils
+from spans import LABELS
+from themes import THEMES
+
+
+# Key of each task in the response of the combined task (see combined.py).
+COMBINED_KEYS = {
+    "isdream": "single_dream",
+    "islucid": "lucid",
+    "thematicT": "techniques",
+    "thematicM": "motivations",
+    "thematicD": "difficulties",
+}
+
+# Appended to the user prompt when re-requesting with `gpt_request.py --strict`.
+STRICT_INSTRUCTIONS = {
+    "isdream": "\n\nRespond with exactly one word, True or False, and nothing else.",
+    "islucid": "\n\nRespond with exactly one word, True or False, and nothing else.",
+    "annotate": (
+        "\n\nRespond with a single valid JSON object with exactly the keys \"text\" and"
+        " \"entities\", and nothing before or after it."
+    ),
+    "thematicT": (
+        "\n\nRespond with a single valid JSON object with every theme above as a key and"
+        " true or false as its value, and nothing before or after it."
+    ),
+}
+STRICT_INSTRUCTIONS["thematicM"] = STRICT_INSTRUCTIONS["thematicD"] = STRICT_INSTRUCTIONS["thematicT"]
+STRICT_INSTRUCTIONS["combined"] = (
+    "\n\nRespond with a single valid JSON object with exactly the five keys above, every"
+    " theme of each question as a key of its object, true or false as every value, and"
+    " nothing before or after it."
+)
+
+
+STEM_PATTERN = re.compile(r"data-(?P<dataset>[^_]+)_task-(?P<task>[^_]+)(?:_choices-(?P<choices>\d+))?")
+
+
+def choices_stem(dataset: str, task: str, choices: int = 1) -> str:
+    """File name stem of a run with a given number of choices per request."""
+    stem = f"data-{dataset}_task-{task}"
+    return stem if choices == 1 else f"{stem}_choices-{choices}"
+
+
+def parse_stem(name: str) -> tuple[str, str, int]:
+    """
+    Split the name of a task's file into its dataset, task and number of choices.
+
+    >>> parse_stem("data-flying_task-islucid_choices-5_responses.json")
+    ('flying', 'islucid', 5)
+    >>> parse_stem("data-sddb_task-thematicT_responses.json")
+    ('sddb', 'thematicT', 1)
+    """
+    match = STEM_PATTERN.match(name)
+    assert match, f"{name} is not named data-<dataset>_task-<task>[_choices-<k>]."
+    return match["dataset"], match["task"], int(match["choices"] or 1)
+
+
+def responses_path(dataset: str, task: str, choices: int = 1):
+    """Path of the responses file of a dataset and task."""
+    return utils.deriv_dir / f"{choices_stem(dataset, task, choices)}_responses.json"
+
+
+def repair_path(dataset: str, task: str, choices: int = 1):
+    """Path of the repair queue of a dataset and task."""
+    return utils.deriv_dir / f"{choices_stem(dataset, task, choices)}_repair.json"
+
+
+def _check_json(content: str) -> dict:
+    """Parse a JSON object, raising ValueError with the reason if it is not one."""
+    if not (content.startswith("{") and content.endswith("}")):
+        raise ValueError("not a JSON object")
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        raise ValueError("invalid JSON")
+
+
+def check_content(content: str, task: str) -> None:
+    """
+    Check the message content of one choice, raising ValueError with the reason if invalid.
+    Args:
+        content (str): The message content.
+        task (str): The task the content answers.
+    """
+
+    if task in ["isdream", "islucid"]:
+        if content not in ["True", "False"]:
+            raise ValueError("not True or False")
+    elif task.startswith("thematic"):
+        ann = _check_json(content)
+        themes = list(THEMES[task[-1]])
+        # Extra themes are ignored when parsing, missing ones are not.
+        if any(theme not in ann for theme in themes):
+            raise ValueError("missing themes")
+        if not all(isinstance(ann[theme], bool) for theme in themes):
+            raise ValueError("non-boolean theme values")
+    elif task == "annotate":
+        ann = _check_json(content)
+        if sorted(ann) != ["entities", "text"]:
+            raise ValueError("wrong keys")
+        if not isinstance(ann["entities"], list) or not all(
+            isinstance(e, dict) and isinstance(e.get("value"), str) for e in ann["entities"]
+        ):
+            raise ValueError("malformed entities")
+        if not all(e.get("label") in LABELS for e in ann["entities"]):
+            raise ValueError("unknown entity labels")
+    elif task == "combined":
+        ann = _check_json(content)
+        if any(key not in ann for key in COMBINED_KEYS.values()):
+            raise ValueError("missing tasks")
+        for subtask, key in COMBINED_KEYS.items():
+            if subtask.startswith("thematic"):
+                themes = list(THEMES[subtask[-1]])
+                if not isinstance(ann[key], dict) or any(theme not in ann[key] for theme in themes):
+                    raise ValueError("missing themes")
+                if not all(isinstance(ann[key][theme], bool) for theme in themes):
+                    raise ValueError("non-boolean theme values")
+            elif not isinstance(ann[key], bool):
+                raise ValueError("non-boolean answer")
+    else:
+        raise ValueError(f"unknown task {task}")
+
+
+def check_completion(completion: dict, task: str) -> str:
+    """
+    Check one stored completion.
+    Args:
+        completion (dict): The completion, as stored in a responses file.
+        task (str): The task it answers.
+    Returns:
+        str: The reason it is invalid, or None if it is valid.
+    """
+
+    choices = completion.get("choices") or []
+    if not choices:
+        return "no choices"
+    for choice in choices:
+        if choice.get("finish_reason") == "length":
+            return "truncated"
+        if choice.get("finish_reason") != "stop":
+            return f"finish reason {choice.get('finish_reason')}"
+        try:
+            check_content(choice["message"]["content"], task)
+        except (ValueError, KeyError, TypeError) as error:
+            return str(error) if isinstance(error, ValueError) else "malformed choice"
+    return None
+
+
+def validate_responses(dataset: str, task: str, dream_ids: list = None, choices: int = 1) -> pd.Series:
+    """
+    Check the stored completions of a dataset and task.
+    Args:
+        dataset (str): The dataset.
+        task (str): The task.
+        dream_ids (list): Only check these dreams (default: all stored ones).
+        choices (int): Choices per request of the run (see consistency.py).
+    Returns:
+        pd.Series: The reason of every invalid completion, indexed by dream ID.
+    """
+
+    completions = utils.load_json(responses_path(dataset, task, choices))
+    if dream_ids is not None:
+        completions = {k: completions[k] for k in dream_ids if k in completions}
+    reasons = {dream_id: check_completion(c, task) for dream_id, c in completions.items()}
+    return (
+        pd.Series(reasons, dtype=object, name="reason")
+        .rename_axis("dream_id")
+        .dropna()
+    )
+
+
+def update_repair_queue(dataset: str, task: str, choices: int = 1) -> pd.Series:
+    """Validate all completions of a dataset and task and save the failing ones as its repair queue."""
+    failures = validate_responses(dataset, task, choices=choices)
+    utils.save_json(failures.to_dict(), repair_path(dataset, task, choices))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", type=str, choices=["dreamviews", "flying", "sddb"])
+    parser.add_argument("-t", "--task", type=str, choices=list(STRICT_INSTRUCTIONS))
+    parser.add_argument("-c", "--choices", type=int, default=1, help="Choices per request of the run.")
+    parser.add_argument("-a", "--all", action="store_true", help="Validate every responses file.")
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args.profile)
+    if not args.all and not (args.dataset and args.task):
+        parser.error("give --dataset and --task, or --all")
+
+    if args.all:
+        runs = [parse_stem(path.name) for path in sorted(utils.deriv_dir.glob("data-*_task-*_responses.json"))]
+    else:
+        runs = [(args.dataset, args.task, args.choices)]
+    for dataset, task, choices in runs:
+        failures = update_repair_queue(dataset, task, choices)
+        n_total = len(utils.load_json(responses_path(dataset, task, choices)))
+        print(f"{choices_stem(dataset, task, choices)}: {len(failures)} of {n_total} completions to repair")
+        for reason, n in failures.value_counts().items():
+            print(f"{n:>8}  {reason}")